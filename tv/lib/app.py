@@ -45,6 +45,9 @@ db = None
 # stores ItemInfo objects so we can quickly fetch them
 item_info_cache = None
 
+# search index for all items in the database
+search_index = None
+
 # command line arguments for thumbnailer (linux)
 movie_data_program_info = None
 
@@ -99,6 +99,9 @@ class Controller:
         app.db.finish_transaction()
         if app.item_info_cache is not None:
             app.item_info_cache.save()
+        if app.search_index is not None:
+            logging.info("Saving search index")
+            app.search_index.save()
         logging.info("Closing Database...")
         if app.db is not None:
             app.db.close()
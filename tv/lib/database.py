@@ -32,6 +32,8 @@ import traceback
 import threading
 
 from miro import app
+from miro import databasepredicate
+from miro import eventloop
 from miro import signals
 
 class DatabaseException(Exception):
@@ -85,6 +87,14 @@ class NotRootDBError(DatabaseStandardError):
     """
     pass
 
+# SQLite can only handle 999 values in a single statement.  Stay a bit under
+# that when building "id IN (...)" queries.
+MAX_SQL_VALUES = 990
+
+# Set to True to double check the results of compiled WHERE clauses against
+# SQLite.  This is slow, but useful when changing databasepredicate.
+CHECK_COMPILED_PREDICATES = False
+
 class NoValue(object):
     """Used as a dummy value so that "None" can be treated as a valid
     value.
@@ -228,6 +238,11 @@ class ViewTrackerManager(object):
         self.table_to_tracker = {}
         # maps joined tables to trackers
         self.joined_table_to_tracker = {}
+        # batch mode state.  pending_changes maps table names to a
+        # (object list, id -> object dict) tuple
+        self.batch_mode = False
+        self.pending_changes = {}
+        self.pending_changes_dc = None
 
     def trackers_for_table(self, table_name):
         try:
@@ -239,23 +254,88 @@ class ViewTrackerManager(object):
     def trackers_for_ddb_class(self, klass):
         return self.trackers_for_table(app.db.table_name(klass))
 
+    def set_batch_mode(self, batch_mode):
+        """Set/Unset batch mode.
+
+        Normally, each object change is checked against every ViewTracker
+        right away, which means one SQL query per tracker per object.  In
+        batch mode, changed objects are collected and then checked together
+        in an urgent call, using one query per tracker.  The signals for the
+        batch are sent using the bulk-* signals for trackers in bulk mode.
+        """
+        if not batch_mode:
+            self.process_pending_changes()
+        self.batch_mode = batch_mode
+
     def update_view_trackers(self, obj):
         """Update view trackers based on an object change."""
 
+        if self.batch_mode:
+            self._add_pending_change(obj)
+            return
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.object_changed(obj)
 
+    def _add_pending_change(self, obj):
+        table_name = app.db.table_name(obj.__class__)
+        if not self.trackers_for_table(table_name):
+            # no trackers to update.  Any tracker created later will query
+            # the database which already has the change.
+            return
+        try:
+            objects, obj_map = self.pending_changes[table_name]
+        except KeyError:
+            objects, obj_map = self.pending_changes[table_name] = ([], {})
+        if obj.id not in obj_map:
+            objects.append(obj)
+        obj_map[obj.id] = obj
+        if self.pending_changes_dc is None:
+            self.pending_changes_dc = eventloop.add_urgent_call(
+                self.process_pending_changes, 'process view tracker changes')
+
+    def _discard_pending_change(self, obj):
+        table_name = app.db.table_name(obj.__class__)
+        try:
+            objects, obj_map = self.pending_changes[table_name]
+        except KeyError:
+            return
+        obj_map.pop(obj.id, None)
+
+    def has_pending_changes(self, table_name):
+        return table_name in self.pending_changes
+
+    def process_pending_changes(self):
+        """Check all objects changed while in batch mode."""
+        if self.pending_changes_dc is not None:
+            self.pending_changes_dc.cancel()
+            self.pending_changes_dc = None
+        pending_changes = self.pending_changes
+        self.pending_changes = {}
+        for table_name, (objects, obj_map) in pending_changes.items():
+            # filter out objects that were removed and duplicate entries
+            objects = [obj for obj in objects
+                    if obj_map.pop(obj.id, None) is not None]
+            for tracker in list(self.trackers_for_table(table_name)):
+                tracker.check_objects(objects)
+
     def bulk_update_view_trackers(self, table_name):
+        # check_all_objects() will handle any pending changes
+        self.pending_changes.pop(table_name, None)
         for tracker in self.trackers_for_table(table_name):
             tracker.check_all_objects()
 
     def bulk_remove_from_view_trackers(self, table_name, objects):
+        if self.has_pending_changes(table_name):
+            for obj in objects:
+                self._discard_pending_change(obj)
         for tracker in self.trackers_for_table(table_name):
             tracker.remove_objects(objects)
 
     def remove_from_view_trackers(self, obj):
         """Update view trackers based on an object change."""
 
+        if self.pending_changes:
+            self._discard_pending_change(obj)
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.remove_object(obj)
 
@@ -271,6 +351,7 @@ class ViewTracker(signals.SignalEmitter):
         self.values = values
         self.joins = joins
         self.bulk_mode = False
+        self.predicate = self._compile_predicate()
         self.current_ids = self._view_object_ids()
         vt_manager = app.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
@@ -288,8 +369,39 @@ class ViewTracker(signals.SignalEmitter):
         """
         self.bulk_mode = bulk_mode
 
+    def _compile_predicate(self):
+        """Try to compile our WHERE clause into a python function.
+
+        This lets us check if an object is in our view without a SQL query.
+
+        :returns: predicate function or None if we need to use SQL
+        """
+        if self.joins:
+            return None
+        table_name = self.table_name
+        def get_schema_item(column_name):
+            return app.db.get_schema_item(table_name, column_name)
+        return databasepredicate.compile_where(table_name, self.where,
+                self.values, get_schema_item)
+
     def _obj_in_view(self, obj):
         """Check if a single object is in our view."""
+        if self.predicate is not None:
+            in_view = self.predicate(obj)
+            if CHECK_COMPILED_PREDICATES:
+                in_view = self._check_predicate_result(obj, in_view)
+            return in_view
+        return self._obj_in_view_sql(obj)
+
+    def _check_predicate_result(self, obj, in_view):
+        sql_in_view = self._obj_in_view_sql(obj)
+        if sql_in_view != in_view:
+            logging.error("compiled WHERE clause mismatch for %s "
+                    "(where: %r, values: %r, compiled: %s, sql: %s)",
+                    obj, self.where, self.values, in_view, sql_in_view)
+        return sql_in_view
+
+    def _obj_in_view_sql(self, obj):
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
@@ -298,6 +410,26 @@ class ViewTracker(signals.SignalEmitter):
         return app.db.query_count(self.table_name, where, values,
                 self.joins) > 0
 
+    def _objs_in_view(self, objects):
+        """Check a list of objects at once.
+
+        :returns: set of ids for the objects that are in our view
+        """
+        if self.predicate is not None:
+            return set(obj.id for obj in objects if self._obj_in_view(obj))
+        id_list = [obj.id for obj in objects]
+        chunk_size = MAX_SQL_VALUES - len(self.values)
+        ids_in_view = set()
+        for start in xrange(0, len(id_list), chunk_size):
+            id_chunk = tuple(id_list[start:start+chunk_size])
+            where = '%s.id IN (%s)' % (self.table_name,
+                    ', '.join('?' for i in xrange(len(id_chunk))))
+            if self.where:
+                where += ' AND (%s)' % (self.where,)
+            ids_in_view.update(app.db.query_ids(self.table_name, where,
+                id_chunk + self.values, joins=self.joins))
+        return ids_in_view
+
     def _view_object_ids(self):
         """Get all object ids in our view."""
         return set(app.db.query_ids(self.table_name,
@@ -328,6 +460,36 @@ class ViewTracker(signals.SignalEmitter):
         elif before and now:
             self.emit('changed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
+    def check_objects(self, objects):
+        """Check a list of changed objects using a single query.
+
+        Signals are emitted using _emit_for_objects(), so trackers in bulk
+        mode get one bulk-* signal for each type of change.
+        """
+        if not objects:
+            return
+        ids_in_view = self._objs_in_view(objects)
+        added = []
+        removed = []
+        changed = []
+        for obj in objects:
+            before = (obj.id in self.current_ids)
+            now = (obj.id in ids_in_view)
+            if before and not now:
+                self.current_ids.remove(obj.id)
+                removed.append(obj)
+            elif now and not before:
+                self.current_ids.add(obj.id)
+                added.append(obj)
+            elif before and now:
+                changed.append(obj)
+        fetch = self.fetcher.fetch_obj_for_ddb_object
+        for signal, signal_objects in (('added', added),
+                ('removed', removed), ('changed', changed)):
+            if signal_objects:
+                self._emit_for_objects(signal,
+                        [fetch(obj) for obj in signal_objects])
+
     def _emit_for_objects(self, signal, objects):
         if self.bulk_mode:
             self.emit('bulk-' + signal, objects)
@@ -361,6 +523,10 @@ class ViewTracker(signals.SignalEmitter):
                 [self.fetcher.fetch_obj(id_) for id_ in removed_ids])
 
     def __len__(self):
+        vt_manager = app.view_tracker_manager
+        if vt_manager.has_pending_changes(self.table_name):
+            # make sure current_ids is up to date
+            vt_manager.process_pending_changes()
         return len(self.current_ids)
 
 
@@ -515,7 +681,11 @@ class AttributeUpdateTracker(object):
         try:
             return instance.__dict__[self.name]
         except KeyError:
-            raise AttributeError(self.name)
+            # The attribute might be a lazy field that we haven't loaded
+            # yet.  See ObjectSchema.lazy_fields
+            if not app.db.load_lazy_fields(instance):
+                raise AttributeError(self.name)
+            return AttributeUpdateTracker.__get__(self, instance, owner)
         except AttributeError:
             if instance is None:
                 raise AttributeError(
@@ -528,6 +698,19 @@ class AttributeUpdateTracker(object):
             instance.changed_attributes.add(self.name)
         instance.__dict__[self.name] = value
 
+class MutableAttributeUpdateTracker(AttributeUpdateTracker):
+    """Used by DDBObject to track changes to mutable attributes.
+
+    Attributes like lists and dicts can be changed in-place, without ever
+    calling __set__.  The only way to do that is to get the attribute first,
+    so we consider the attribute changed whenever it's accessed.
+    """
+
+    def __get__(self, instance, owner):
+        value = AttributeUpdateTracker.__get__(self, instance, owner)
+        instance.changed_attributes.add(self.name)
+        return value
+
 class DDBObject(signals.SignalEmitter):
     """Dynamic Database object
     """
@@ -626,7 +809,7 @@ class DDBObject(signals.SignalEmitter):
         pass
 
     @classmethod
-    def track_attribute_changes(cls, name):
+    def track_attribute_changes(cls, name, mutable=False):
         """Set up tracking when attributes get set.
 
         Call this on a DDBObject subclass to track changes to certain
@@ -646,9 +829,16 @@ class DDBObject(signals.SignalEmitter):
         >> obj.foo = obj.bar = obj.baz = 3
         >>> print obj.changed_attributes
         set(['foo', 'bar'])
+
+        Pass in mutable=True for attributes that can be changed in-place
+        (lists, dicts, sets, ...).  Those are also considered changed
+        whenever they are accessed.
         """
-        # The AttributeUpdateTracker class does all the work
-        setattr(cls, name, AttributeUpdateTracker(name))
+        # The AttributeUpdateTracker classes do all the work
+        if mutable:
+            setattr(cls, name, MutableAttributeUpdateTracker(name))
+        else:
+            setattr(cls, name, AttributeUpdateTracker(name))
 
     def reset_changed_attributes(self):
         self.changed_attributes = set()
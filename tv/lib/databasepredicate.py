@@ -0,0 +1,320 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.databasepredicate`` -- Compile WHERE clauses to python.
+
+ViewTracker needs to check if a changed DDBObject is part of its view.  For
+simple WHERE clauses like ``feed_id=? AND NOT seen``, we can answer that by
+looking at the object's attributes instead of asking SQLite.
+
+compile_where() handles a small subset of SQL:
+
+* column references, optionally qualified with the table name
+* ``=``, ``==``, ``!=``, ``<>``, ``<``, ``<=``, ``>``, ``>=`` against a
+  ``?`` placeholder or a literal
+* ``IS NULL``, ``IS NOT NULL``, ``IN (...)`` and ``NOT IN (...)`` with
+  literals
+* bare numeric/boolean columns used as a truth value
+* ``AND``, ``OR``, ``NOT`` and parentheses
+
+Anything else (joins, LIKE, sub-selects, column to column comparisons, ...)
+makes compile_where() return None and the caller should use SQL instead.
+
+The compiled predicates follow SQL's 3-valued logic, so NULL values behave
+the same way that they do in SQLite.
+"""
+
+import re
+
+from miro import schema
+
+class UnsupportedWhere(ValueError):
+    """Raised when we can't compile a WHERE clause."""
+    pass
+
+# schema items that we know how to compare.  We don't try to handle types
+# that we convert when storing them in the database.
+_NUMERIC_TYPES = (schema.SchemaBool, schema.SchemaInt, schema.SchemaFloat)
+_TEXT_TYPES = (schema.SchemaString, schema.SchemaURL)
+
+_TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<placeholder>\?) |
+    (?P<string>'(?:[^']|'')*') |
+    (?P<number>-?\d+(?:\.\d+)?) |
+    (?P<op>==|!=|<>|<=|>=|=|<|>|\(|\)|,) |
+    (?P<name>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?)
+    )""", re.VERBOSE)
+
+_KEYWORDS = frozenset(['and', 'or', 'not', 'is', 'in', 'null'])
+
+def _tokenize(where):
+    tokens = []
+    pos = 0
+    where = where.rstrip()
+    while pos < len(where):
+        match = _TOKEN_RE.match(where, pos)
+        if match is None or match.end() == pos:
+            raise UnsupportedWhere("Can't parse %r" % where[pos:])
+        pos = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'name' and text.lower() in _KEYWORDS:
+            kind, text = 'keyword', text.lower()
+        tokens.append((kind, text))
+    return tokens
+
+# Functions to implement SQL's 3-valued logic.  None represents NULL.
+
+def _sql_and(left, right):
+    def predicate(obj):
+        left_value = left(obj)
+        if left_value is False:
+            return False
+        right_value = right(obj)
+        if right_value is False:
+            return False
+        if left_value is None or right_value is None:
+            return None
+        return True
+    return predicate
+
+def _sql_or(left, right):
+    def predicate(obj):
+        left_value = left(obj)
+        if left_value is True:
+            return True
+        right_value = right(obj)
+        if right_value is True:
+            return True
+        if left_value is None or right_value is None:
+            return None
+        return False
+    return predicate
+
+def _sql_not(operand):
+    def predicate(obj):
+        value = operand(obj)
+        if value is None:
+            return None
+        return not value
+    return predicate
+
+def _make_comparison(name, compare, operand):
+    def predicate(obj):
+        value = getattr(obj, name)
+        if value is None:
+            return None
+        return compare(value, operand)
+    return predicate
+
+_COMPARISONS = {
+        '=': lambda a, b: a == b,
+        '==': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '<>': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+}
+
+class _WhereParser(object):
+    """Recursive descent parser that builds predicate functions."""
+
+    def __init__(self, table_name, where, values, get_schema_item):
+        self.table_name = table_name
+        self.tokens = _tokenize(where)
+        self.pos = 0
+        self.values = values
+        self.value_pos = 0
+        self.get_schema_item = get_schema_item
+
+    def parse(self):
+        predicate = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise UnsupportedWhere("Extra tokens: %s" %
+                    (self.tokens[self.pos:],))
+        if self.value_pos != len(self.values):
+            raise UnsupportedWhere("Unused values")
+        return predicate
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise UnsupportedWhere("Unexpected end of WHERE clause")
+        self.pos += 1
+        return token
+
+    def accept(self, kind, text):
+        if self.peek() == (kind, text):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, text):
+        if not self.accept(kind, text):
+            raise UnsupportedWhere("Expected %s, got %s" %
+                    (text, self.peek()[1]))
+
+    def parse_or(self):
+        predicate = self.parse_and()
+        while self.accept('keyword', 'or'):
+            predicate = _sql_or(predicate, self.parse_and())
+        return predicate
+
+    def parse_and(self):
+        predicate = self.parse_not()
+        while self.accept('keyword', 'and'):
+            predicate = _sql_and(predicate, self.parse_not())
+        return predicate
+
+    def parse_not(self):
+        if self.accept('keyword', 'not'):
+            return _sql_not(self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        if self.accept('op', '('):
+            predicate = self.parse_or()
+            self.expect('op', ')')
+            return predicate
+        name, schema_item = self.parse_column()
+        kind, text = self.peek()
+        if kind == 'op' and text in _COMPARISONS:
+            self.pos += 1
+            operand = self.parse_operand(schema_item)
+            return _make_comparison(name, _COMPARISONS[text], operand)
+        elif (kind, text) == ('keyword', 'is'):
+            self.pos += 1
+            negate = self.accept('keyword', 'not')
+            self.expect('keyword', 'null')
+            if negate:
+                return lambda obj: getattr(obj, name) is not None
+            else:
+                return lambda obj: getattr(obj, name) is None
+        elif (kind, text) == ('keyword', 'in'):
+            self.pos += 1
+            return self.parse_in_list(name, schema_item)
+        elif (kind, text) == ('keyword', 'not') and \
+                self.tokens[self.pos+1:self.pos+2] == [('keyword', 'in')]:
+            self.pos += 2
+            return _sql_not(self.parse_in_list(name, schema_item))
+        else:
+            # bare column used as a truth value.  SQLite converts TEXT
+            # values to numbers for this, so only allow numeric columns.
+            if not isinstance(schema_item, _NUMERIC_TYPES):
+                raise UnsupportedWhere("Can't use %s as a boolean" % name)
+            return _make_comparison(name, lambda a, b: bool(a), None)
+
+    def parse_in_list(self, name, schema_item):
+        self.expect('op', '(')
+        members = [self.parse_operand(schema_item)]
+        while self.accept('op', ','):
+            members.append(self.parse_operand(schema_item))
+        self.expect('op', ')')
+        members = tuple(members)
+        return _make_comparison(name, lambda a, b: a in b, members)
+
+    def parse_column(self):
+        kind, text = self.next()
+        if kind != 'name':
+            raise UnsupportedWhere("Expected column name, got %s" % text)
+        if '.' in text:
+            table_name, name = text.split('.')
+            if table_name != self.table_name:
+                raise UnsupportedWhere("Column from another table: %s" %
+                        text)
+        else:
+            name = text
+        try:
+            schema_item = self.get_schema_item(name)
+        except KeyError:
+            raise UnsupportedWhere("Unknown column: %s" % text)
+        if not isinstance(schema_item, _NUMERIC_TYPES + _TEXT_TYPES):
+            raise UnsupportedWhere("Can't compare %s columns" %
+                    schema_item.__class__.__name__)
+        return name, schema_item
+
+    def parse_operand(self, schema_item):
+        kind, text = self.next()
+        if kind == 'placeholder':
+            if self.value_pos >= len(self.values):
+                raise UnsupportedWhere("Not enough values")
+            value = self.values[self.value_pos]
+            self.value_pos += 1
+        elif kind == 'string':
+            value = text[1:-1].replace("''", "'").decode('utf-8')
+        elif kind == 'number':
+            if '.' in text:
+                value = float(text)
+            else:
+                value = int(text)
+        else:
+            raise UnsupportedWhere("Expected value, got %s" % text)
+        # SQLite will convert values using the column affinity before
+        # comparing.  Only handle cases where python compares the same way.
+        if isinstance(schema_item, _NUMERIC_TYPES):
+            if not isinstance(value, (int, long, float, bool)):
+                raise UnsupportedWhere("Non-numeric value: %r" % (value,))
+        else:
+            if isinstance(value, str):
+                try:
+                    value = value.decode('ascii')
+                except UnicodeError:
+                    raise UnsupportedWhere("Non-ASCII bytestring")
+            if not isinstance(value, unicode):
+                raise UnsupportedWhere("Non-text value: %r" % (value,))
+        return value
+
+def compile_where(table_name, where, values, get_schema_item):
+    """Compile a WHERE clause into a python function.
+
+    :param table_name: table the WHERE clause is for
+    :param where: WHERE clause, or None to match all objects
+    :param values: values to use for the ``?`` placeholders
+    :param get_schema_item: function that takes a column name and returns
+        its SchemaItem, or throws KeyError
+
+    :returns: function that takes a DDBObject and returns True if it matches
+        the WHERE clause, or None if we can't handle the WHERE clause.
+    """
+    if not where:
+        return lambda obj: True
+    try:
+        predicate = _WhereParser(table_name, where, values,
+                get_schema_item).parse()
+    except UnsupportedWhere:
+        return None
+    # NULL results mean the row doesn't match
+    return lambda obj: predicate(obj) is True
@@ -3380,3 +3380,8 @@ def upgrade162(cursor):
                 "SET active_filters=? "
                 "WHERE type = ? AND id_ = ?",
                 (new_active_filters, type, id_))
+
+def upgrade163(cursor):
+    """Create the search_index_snapshot table"""
+    cursor.execute("CREATE TABLE search_index_snapshot"
+            "(version TEXT, data BLOB)")
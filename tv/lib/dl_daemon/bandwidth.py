@@ -0,0 +1,372 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.dl_daemon.bandwidth -- Bandwidth limits for HTTP downloads.
+
+libtorrent enforces the bandwidth limits for torrents, but HTTP downloads go
+through httpclient, which doesn't know about them.  BandwidthManager fills
+that gap.  While a limit is set and HTTP downloads are running, it splits the
+limit between them every UPDATE_INTERVAL seconds and sets a receive speed
+limit on each of their transfers.
+
+libcurl's speed limits are only approximate, so we also keep a token bucket
+for the total limit.  If the downloads get ahead of it, we pause their
+transfers until it refills.
+
+Part of the total limit is never handed out to downloads.  That leaves room
+for feed updates, thumbnails and other interactive traffic.
+"""
+
+from miro import app
+from miro import eventloop
+from miro import prefs
+from miro.clock import clock
+
+# how often we recalculate the limits, in seconds
+UPDATE_INTERVAL = 0.5
+# fraction of the total limit that we keep free for interactive traffic
+RESERVE_FRACTION = 0.1
+# always keep at least this much bandwidth free (bytes/sec)
+MIN_RESERVE = 8 * 1024
+# never limit a download below this (bytes/sec)
+MIN_TRANSFER_RATE = 1024
+# If a download uses less than this fraction of its share, something else is
+# slowing it down (the server, the network, etc).  We give the part of its
+# share that it's not using to the other downloads.
+UNDERUSED_FRACTION = 0.8
+# how much faster than its current rate we let an underused download go
+DEMAND_GROWTH = 1.5
+# how many seconds worth of data the token bucket holds
+BURST_TIME = 1.0
+
+class TokenBucket(object):
+    """Token bucket for enforcing a bandwidth limit.
+
+    Tokens are added at rate tokens/sec, up to burst tokens.  Each byte we
+    receive uses up a token.  The token count goes negative if we receive
+    more data than the limit allows.
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = now
+
+    def set_rate(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def refill(self, now):
+        elapsed = max(0, now - self.last_refill)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+    def consume(self, amount, now):
+        self.refill(now)
+        self.tokens -= amount
+
+    def deficit_time(self):
+        """Get how long until the bucket is no longer overdrawn (seconds)."""
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / float(self.rate)
+
+def fair_shares(total, demands):
+    """Split bandwidth between downloads using max-min fairness.
+
+    Downloads that can't use an equal share get what they can use.  The rest
+    of the bandwidth is split equally between the other downloads.
+
+    :param total: bandwidth to split
+    :param demands: dict mapping downloads to the most bandwidth they can
+        use, or None if there's no limit
+    :returns: dict mapping downloads to their share
+    """
+    shares = {}
+    remaining = float(total)
+    pending = dict(demands)
+    while pending:
+        equal_share = remaining / len(pending)
+        satisfied = [key for key, demand in pending.items()
+                if demand is not None and demand <= equal_share]
+        if not satisfied:
+            for key in pending:
+                shares[key] = equal_share
+            break
+        for key in satisfied:
+            shares[key] = pending.pop(key)
+            remaining -= shares[key]
+    return shares
+
+class BandwidthManager(object):
+    """Applies the bandwidth limits to HTTP downloads.
+
+    The downloads that we manage need a get_http_clients() method that
+    returns the HTTPClient objects currently downloading their data.
+    """
+    def __init__(self):
+        # limit for all HTTP traffic and for each download (bytes/sec)
+        self.total_limit = None
+        self.download_limit = None
+        self.bucket = None
+        self.shares = {}
+        self.last_update = None
+        self.paused = False
+        # maps HTTPClients to how many bytes they had at our last update
+        self.last_downloaded = {}
+        # maps HTTPClients to the speed limit that we set for them
+        self.client_limits = {}
+        self.paused_clients = set()
+        self.get_downloads = None
+        self.callback_handle = None
+        self.update_dc = None
+
+    def startup(self, get_downloads):
+        """Start managing bandwidth.
+
+        :param get_downloads: function that returns the HTTP downloads to
+            manage
+        """
+        self.get_downloads = get_downloads
+        self.read_limits()
+        self.callback_handle = app.downloader_config_watcher.connect(
+                'changed', self.on_config_changed)
+        self.schedule_update()
+
+    def shutdown(self):
+        self.cancel_update()
+        self.get_downloads = None
+        if self.callback_handle is not None:
+            app.downloader_config_watcher.disconnect(self.callback_handle)
+            self.callback_handle = None
+
+    def download_started(self):
+        """Call this when an HTTP download starts, so that we start limiting
+        it.
+
+        The download might not be returned by get_downloads() yet, so we
+        don't check for running downloads here.  The update will do that.
+        """
+        if self.get_downloads is not None and self.has_limits():
+            self._add_update_timeout()
+
+    def schedule_update(self):
+        """Schedule our next update.
+
+        We only need to run while there's a limit to enforce and downloads
+        to enforce it on.  Otherwise we stay idle until download_started()
+        or a pref change.
+        """
+        if self.should_update():
+            self._add_update_timeout()
+        else:
+            # start over once we're needed again, rather than counting the
+            # idle time in our rates
+            self.last_update = None
+
+    def _add_update_timeout(self):
+        if self.update_dc is None:
+            self.update_dc = eventloop.add_timeout(UPDATE_INTERVAL,
+                    self.do_update, "HTTP bandwidth update")
+
+    def cancel_update(self):
+        if self.update_dc is not None:
+            self.update_dc.cancel()
+            self.update_dc = None
+
+    def has_limits(self):
+        return self.total_limit is not None or self.download_limit is not None
+
+    def should_update(self):
+        if self.get_downloads is None or not self.has_limits():
+            return False
+        for download in self.get_downloads():
+            if download.get_http_clients():
+                return True
+        return False
+
+    def do_update(self):
+        self.update_dc = None
+        try:
+            self.update(self.get_downloads())
+        finally:
+            self.schedule_update()
+
+    def on_config_changed(self, obj, key, value):
+        if key in (prefs.LIMIT_DOWNSTREAM_HTTP.key,
+                prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS.key,
+                prefs.LIMIT_DOWNSTREAM_HTTP_PER_DOWNLOAD.key,
+                prefs.DOWNSTREAM_HTTP_PER_DOWNLOAD_LIMIT_IN_KBS.key):
+            self.read_limits()
+            # Apply the change right away.  If the limits were turned off,
+            # this removes them from our transfers before we go idle.
+            self.cancel_update()
+            self.do_update()
+
+    def read_limits(self):
+        total_limit = download_limit = None
+        if app.config.get(prefs.LIMIT_DOWNSTREAM_HTTP):
+            total_limit = (app.config.get(prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS)
+                    * (2 ** 10))
+        if app.config.get(prefs.LIMIT_DOWNSTREAM_HTTP_PER_DOWNLOAD):
+            download_limit = (app.config.get(
+                prefs.DOWNSTREAM_HTTP_PER_DOWNLOAD_LIMIT_IN_KBS) * (2 ** 10))
+        self.set_limits(total_limit, download_limit)
+
+    def set_limits(self, total_limit, download_limit):
+        """Change the bandwidth limits.
+
+        :param total_limit: limit for all HTTP traffic (bytes/sec), or None
+        :param download_limit: limit for each download (bytes/sec), or None
+        """
+        self.total_limit = total_limit
+        if download_limit is not None:
+            download_limit = max(MIN_TRANSFER_RATE, download_limit)
+        self.download_limit = download_limit
+        budget = self.download_budget()
+        if budget is None:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(budget, budget * BURST_TIME, clock())
+        else:
+            self.bucket.set_rate(budget, budget * BURST_TIME)
+
+    def download_budget(self):
+        """Get the bandwidth that all downloads together can use.
+
+        :returns: bytes/sec, or None if there's no total limit
+        """
+        if self.total_limit is None:
+            return None
+        reserve = max(MIN_RESERVE, self.total_limit * RESERVE_FRACTION)
+        # don't let the reserve take more than half of the limit
+        reserve = min(reserve, self.total_limit / 2.0)
+        return max(MIN_TRANSFER_RATE, self.total_limit - reserve)
+
+    def update(self, downloads, now=None):
+        """Recalculate the limits for downloads and apply them."""
+        if now is None:
+            now = clock()
+        if self.last_update is not None:
+            elapsed = now - self.last_update
+        else:
+            elapsed = 0
+        self.last_update = now
+
+        clients = {}
+        rates = {}
+        last_downloaded = {}
+        total_received = 0
+        for download in downloads:
+            download_clients = download.get_http_clients()
+            if not download_clients:
+                continue
+            clients[download] = download_clients
+            received = 0
+            for client in download_clients:
+                downloaded = client.get_stats().downloaded
+                last = self.last_downloaded.get(client, 0)
+                # downloaded goes down if the transfer starts over
+                received += max(0, downloaded - last)
+                last_downloaded[client] = downloaded
+            if elapsed > 0:
+                rates[download] = received / elapsed
+            total_received += received
+        self.last_downloaded = last_downloaded
+        self._forget_old_clients()
+
+        if not self.has_limits():
+            self.shares = {}
+            self.paused = False
+            self._apply_limits(clients, {}, False)
+            return
+
+        budget = self.download_budget()
+        if budget is None:
+            shares = dict((download, self.download_limit)
+                    for download in clients)
+        else:
+            shares = fair_shares(budget, self._calc_demands(clients, rates))
+        paused = False
+        if self.bucket is not None:
+            self.bucket.consume(total_received, now)
+            # If we're over the limit, pause everything until the next
+            # update.  We keep our paused state if the bucket still hasn't
+            # refilled then.
+            paused = self.bucket.deficit_time() > 0
+        self._apply_limits(clients, shares, paused)
+        self.shares = shares
+        self.paused = paused
+
+    def _calc_demands(self, clients, rates):
+        demands = {}
+        for download, download_clients in clients.items():
+            demand = self.download_limit
+            share = self.shares.get(download)
+            rate = rates.get(download)
+            # Rates are meaningless if we paused everything, since then
+            # every download looks underused.
+            if (share is not None and rate is not None and not self.paused
+                    and rate < share * UNDERUSED_FRACTION):
+                needed = max(rate * DEMAND_GROWTH,
+                        MIN_TRANSFER_RATE * len(download_clients))
+                if demand is None or needed < demand:
+                    demand = needed
+            demands[download] = demand
+        return demands
+
+    def _apply_limits(self, clients, shares, paused):
+        for download, download_clients in clients.items():
+            share = shares.get(download)
+            if share is None:
+                limit = None
+            else:
+                # split the download's share between its transfers (the
+                # segments of a segmented download)
+                limit = max(MIN_TRANSFER_RATE,
+                        int(share / len(download_clients)))
+            for client in download_clients:
+                if self.client_limits.get(client) != limit:
+                    client.set_max_recv_speed(limit)
+                    self.client_limits[client] = limit
+                if paused != (client in self.paused_clients):
+                    client.set_recv_paused(paused)
+                    if paused:
+                        self.paused_clients.add(client)
+                    else:
+                        self.paused_clients.discard(client)
+
+    def _forget_old_clients(self):
+        for client in self.client_limits.keys():
+            if client not in self.last_downloaded:
+                del self.client_limits[client]
+        self.paused_clients.intersection_update(self.last_downloaded)
+
+BANDWIDTH_MANAGER = BandwidthManager()
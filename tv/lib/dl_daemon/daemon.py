@@ -254,6 +254,10 @@ class ControllerDaemon(Daemon):
             prefs.UPSTREAM_LIMIT_IN_KBS,
             prefs.LIMIT_DOWNSTREAM_BT,
             prefs.DOWNSTREAM_BT_LIMIT_IN_KBS,
+            prefs.LIMIT_DOWNSTREAM_HTTP,
+            prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS,
+            prefs.LIMIT_DOWNSTREAM_HTTP_PER_DOWNLOAD,
+            prefs.DOWNSTREAM_HTTP_PER_DOWNLOAD_LIMIT_IN_KBS,
             prefs.BT_MIN_PORT,
             prefs.BT_MAX_PORT,
             prefs.USE_UPNP,
@@ -30,6 +30,7 @@
 import os
 import stat
 import time
+import functools
 from threading import RLock
 from copy import copy
 import sys
@@ -53,6 +54,7 @@ from miro import fileutil
 from miro import app
 from miro import prefs
 
+from miro.dl_daemon import bandwidth
 from miro.dl_daemon import command
 from miro.dl_daemon import daemon
 from miro.util import (
@@ -186,10 +188,15 @@ def get_download_status(dlids=None):
                 pass
     return statuses
 
+def _http_downloaders():
+    return [dler for dler in _downloads.values()
+            if isinstance(dler, HTTPDownloader)]
+
 def startup():
     logging.info("Starting downloaders")
     DOWNLOAD_UPDATER.start_updates()
     TORRENT_SESSION.startup()
+    bandwidth.BANDWIDTH_MANAGER.startup(_http_downloaders)
 
 def shutdown():
     logging.info("Shutting down downloaders...")
@@ -197,6 +204,7 @@ def shutdown():
         _downloads[dlid].shutdown()
     logging.info("Shutting down torrent session...")
     TORRENT_SESSION.shutdown()
+    bandwidth.BANDWIDTH_MANAGER.shutdown()
     logging.info("shutdown() finished")
 
 def restore_downloader(downloader):
@@ -691,8 +699,83 @@ class BGDownloader(object):
             accept = (size <= available)
         return accept
 
+class HTTPSegment(object):
+    """A byte range of a segmented HTTP download.
+
+    :attribute start: offset of the first byte of the segment
+    :attribute end: offset of the last byte of the segment (inclusive)
+    :attribute downloaded: number of bytes flushed to disk, starting from
+        start
+    :attribute client: HTTPClient downloading the segment, or None
+    """
+    def __init__(self, start, end, downloaded=0):
+        self.start = start
+        self.end = end
+        self.downloaded = downloaded
+        self.client = None
+        # value of downloaded when client was started
+        self.client_start = 0
+
+    def __repr__(self):
+        return "<HTTPSegment %s-%s (%s)>" % (self.start, self.end,
+                self.downloaded)
+
+    def length(self):
+        return self.end - self.start + 1
+
+    def is_finished(self):
+        return self.downloaded >= self.length()
+
+def split_segments(total_size, count):
+    """Split a download of total_size bytes into count HTTPSegments."""
+    segment_size = total_size // count
+    segments = []
+    for i in xrange(count):
+        start = i * segment_size
+        if i == count - 1:
+            end = total_size - 1
+        else:
+            end = start + segment_size - 1
+        segments.append(HTTPSegment(start, end))
+    return segments
+
+def encode_segments(segments):
+    """Encode a list of HTTPSegments for the downloader status.
+
+    The status dict can only hold simple values, so we store the segments
+    as a string like u"0-999:500,1000-1999:0".
+    """
+    if segments is None:
+        return None
+    return u','.join(u'%d-%d:%d' % (segment.start, segment.end,
+        segment.downloaded) for segment in segments)
+
+def decode_segments(data):
+    """Decode a string from encode_segments().
+
+    :returns: list of HTTPSegments, or None if data is None or invalid
+    """
+    if not data:
+        return None
+    segments = []
+    try:
+        for part in data.split(u','):
+            byte_range, downloaded = part.split(u':')
+            start, end = byte_range.split(u'-')
+            segments.append(HTTPSegment(int(start), int(end),
+                int(downloaded)))
+    except ValueError:
+        logging.warn("Error decoding HTTP download segments: %r", data)
+        return None
+    return segments
+
 class HTTPDownloader(BGDownloader):
     CHECK_STATS_TIMEOUT = 1.0
+    # Number of range requests that we split a download into when the
+    # server supports them.
+    SEGMENT_COUNT = 4
+    # Don't split downloads into segments smaller than this
+    MIN_SEGMENT_SIZE = 4 * 1024 * 1024
 
     def __init__(self, url=None, dlid=None, restore=None,
                  expectedContentType=None):
@@ -706,10 +789,14 @@ class HTTPDownloader(BGDownloader):
                 restore['totalSize'] = int(restore['totalSize'])
             self.__dict__.update(restore)
             self.restartOnError = True
+            self.segments = decode_segments(restore.get('segments'))
         else:
             BGDownloader.__init__(self, url, dlid)
             self.restartOnError = False
+            self.segments = None
         self.client = None
+        self.segment_url = None
+        self.range_requests_failed = False
         self.rate = 0
         if self.state == u'downloading':
             self.start_download()
@@ -722,6 +809,7 @@ class HTTPDownloader(BGDownloader):
         """Start a download, discarding any existing data"""
         self.currentSize = 0
         self.totalSize = -1
+        self.segments = None
         self.start_download(resume=False)
 
     def start_download(self, resume=True):
@@ -730,13 +818,19 @@ class HTTPDownloader(BGDownloader):
             self.retryDC = None
         if resume:
             resume = self._resume_sanity_check()
+        if not resume:
+            self.segments = None
 
         logging.debug("start_download: %s", self.url)
 
-        self.client = httpclient.grab_url(
-            self.url, self.on_download_finished, self.on_download_error,
-            header_callback=self.on_headers, write_file=self.filename,
-            resume=resume)
+        if self.segments is not None:
+            self._start_segment_clients()
+        else:
+            self.client = httpclient.grab_url(
+                self.url, self.on_download_finished, self.on_download_error,
+                header_callback=self.on_headers, write_file=self.filename,
+                resume=resume, skip_head_request=True)
+        bandwidth.BANDWIDTH_MANAGER.download_started()
         self.update_client()
         eventloop.add_timeout(self.CHECK_STATS_TIMEOUT, self.update_stats,
                 'update http downloader stats')
@@ -748,6 +842,8 @@ class HTTPDownloader(BGDownloader):
         """
         if not os.path.exists(self.filename):
             return False
+        if self.segments is not None:
+            return self._segments_sanity_check()
         # sanity check that the file we're resuming from is the right
         # size.  In particular, before the libcurl change, we would
         # preallocate the entire file, so we need to undo this.
@@ -767,16 +863,48 @@ class HTTPDownloader(BGDownloader):
             return False
         return True
 
+    def get_http_clients(self):
+        """Get the HTTPClients that are downloading our data."""
+        if self.segments is not None:
+            return [segment.client for segment in self.segments
+                    if segment.client is not None]
+        elif self.client is not None:
+            return [self.client]
+        else:
+            return []
+
+    def _segments_sanity_check(self):
+        """Check that the data for our segments is still in our file."""
+        file_size = os.stat(self.filename)[stat.ST_SIZE]
+        for segment in self.segments:
+            if (segment.downloaded < 0 or
+                    segment.downloaded > segment.length() or
+                    segment.start + segment.downloaded > file_size):
+                logging.warn("Segment data missing, not resuming.  "
+                        "url: %s, path: %s.", self.url, self.filename)
+                return False
+        return True
+
     def destroy_client(self):
         """update the stats before we throw away the client.
         """
         self.update_stats()
         self.client = None
+        if self.segments is not None:
+            for segment in self.segments:
+                segment.client = None
 
     def cancel_request(self, remove_file=False):
         if self.client is not None:
             self.client.cancel(remove_file=remove_file)
             self.destroy_client()
+        if self.segments is not None:
+            clients = [segment.client for segment in self.segments
+                    if segment.client is not None]
+            for client in clients:
+                client.cancel(remove_file=remove_file)
+            if clients:
+                self.destroy_client()
         # if it's in a retrying state, we want to nix that, too
         if self.retryDC:
             self.retryDC.cancel()
@@ -792,6 +920,7 @@ class HTTPDownloader(BGDownloader):
                 pass
         self.currentSize = 0
         self.totalSize = -1
+        self.segments = None
 
     def handle_temporary_error(self, short_reason, reason):
         self.cancel_request()
@@ -825,8 +954,117 @@ class HTTPDownloader(BGDownloader):
             ext_content_type = info.get('content-type')
         self.shortFilename = check_filename_extension(self.shortFilename,
                 ext_content_type)
+        if self._should_use_segments(info):
+            self._start_segmented_download(info)
+
+    def _should_use_segments(self, info):
+        """Check if we should switch to downloading in segments.
+
+        We only do this for downloads that we're starting from scratch, where
+        the server tells us the size and that it supports range requests.
+        """
+        return (self.SEGMENT_COUNT > 1 and
+                self.segments is None and
+                not self.range_requests_failed and
+                info['status'] == 200 and
+                info.get('accept-ranges', '').lower() == 'bytes' and
+                'content-length' in info and
+                info['total-size'] == info['content-length'] and
+                (self.totalSize >=
+                    self.SEGMENT_COUNT * self.MIN_SEGMENT_SIZE))
+
+    def _start_segmented_download(self, info):
+        """Replace our single transfer with range requests for each
+        segment.
+        """
+        logging.debug("starting segmented download: %s", self.url)
+        self.cancel_request()
+        # Use the URL that we were redirected to, so that each segment
+        # doesn't have to follow the redirects again.
+        self.segment_url = info['redirected-url']
+        self.segments = split_segments(self.totalSize, self.SEGMENT_COUNT)
+        self.currentSize = 0
+        try:
+            # preallocate the file so the segments can write anywhere in it
+            f = fileutil.open_file(self.filename, 'ab')
+            try:
+                f.truncate(self.totalSize)
+            finally:
+                f.close()
+        except (OSError, IOError):
+            self.segments = None
+            self.handle_network_error(httpclient.WriteError(self.filename))
+            return
+        self._start_segment_clients()
+
+    def _start_segment_clients(self):
+        if self.segment_url is not None:
+            url = self.segment_url
+        else:
+            url = self.url
+        for segment in self.segments:
+            if segment.is_finished() or segment.client is not None:
+                continue
+            segment.client_start = segment.downloaded
+            byte_range = (segment.start + segment.downloaded, segment.end)
+            segment.client = httpclient.grab_url(url,
+                    functools.partial(self.on_segment_finished, segment),
+                    functools.partial(self.on_segment_error, segment),
+                    write_file=self.filename, byte_range=byte_range)
+        if self._all_segments_finished():
+            # We restored a download where all the data has arrived, but
+            # we never finished it.
+            eventloop.add_idle(self._finish_segmented_download,
+                    'finish segmented download')
+
+    def _all_segments_finished(self):
+        for segment in self.segments:
+            if not segment.is_finished():
+                return False
+        return True
+
+    def on_segment_finished(self, segment, response):
+        if segment.client is None or self.segments is None:
+            # segment was canceled
+            return
+        segment.client = None
+        segment.downloaded = segment.length()
+        if self._all_segments_finished():
+            self._finish_segmented_download()
+
+    def _finish_segmented_download(self):
+        if self.state != u'downloading' or self.segments is None:
+            return
+        self.destroy_client()
+        self.segments = None
+        self.segment_url = None
+        self.currentSize = self.totalSize
+        self._finish_download()
+
+    def on_segment_error(self, segment, error):
+        if segment.client is None or self.segments is None:
+            # segment was canceled
+            return
+        # stop the other segments.  This also saves how far each segment
+        # got, so that we can resume them later.
+        self.cancel_request()
+        if isinstance(error, httpclient.ResumeFailed):
+            # the server doesn't support ranges after all, download the
+            # file normally
+            logging.info("range request failed, restarting download: %s",
+                    self.url)
+            self.range_requests_failed = True
+            self.start_new_download()
+        else:
+            self._handle_download_error(error)
 
     def on_download_error(self, error):
+        if self.segments is not None:
+            # our transfer was replaced by segment transfers
+            return
+        self._handle_download_error(error)
+
+    def _handle_download_error(self, error):
         if isinstance(error, httpclient.ResumeFailed):
             # try starting from scratch
             self.currentSize = 0
@@ -843,7 +1081,13 @@ class HTTPDownloader(BGDownloader):
             self.handle_network_error(error)
 
     def on_download_finished(self, response):
+        if self.segments is not None:
+            # our transfer was replaced by segment transfers
+            return
         self.destroy_client()
+        self._finish_download()
+
+    def _finish_download(self):
         self.state = u"finished"
         self.endTime = clock()
         # bug 14131 -- if there's nothing here, treat it like a temporary
@@ -864,25 +1108,56 @@ class HTTPDownloader(BGDownloader):
     def get_status(self):
         data = BGDownloader.get_status(self)
         data['dlerType'] = 'HTTP'
+        data['segments'] = encode_segments(self.segments)
         return data
 
     def update_stats(self):
         """Update the download rate and eta based on receiving length
         bytes.
         """
-        if self.client is None or self.state != u'downloading':
+        if self.state != u'downloading':
             return
-        stats = self.client.get_stats()
-        if stats.status_code in (200, 206):
-            # Only upload currentSize/rate if we are currently
-            # downloading something.  Don't change them before the
-            # transfer starts, while we are handling redirects, etc.
-            self.currentSize = stats.downloaded + stats.initial_size
-            self.rate = stats.download_rate
+        if self.segments is not None:
+            if not self._update_segment_stats():
+                return
+        elif self.client is None:
+            return
+        else:
+            stats = self.client.get_stats()
+            if stats.status_code in (200, 206):
+                # Only upload currentSize/rate if we are currently
+                # downloading something.  Don't change them before the
+                # transfer starts, while we are handling redirects, etc.
+                self.currentSize = stats.downloaded + stats.initial_size
+                self.rate = stats.download_rate
         eventloop.add_timeout(self.CHECK_STATS_TIMEOUT, self.update_stats,
                 'update http downloader stats')
         DOWNLOAD_UPDATER.queue_update(self)
 
+    def _update_segment_stats(self):
+        """Update currentSize and rate from all of our segments.
+
+        :returns: True if any segments are still downloading
+        """
+        active = False
+        rate = 0
+        for segment in self.segments:
+            if segment.client is None:
+                continue
+            active = True
+            stats = segment.client.get_stats()
+            if stats.status_code == 206:
+                # Only count data that's on disk.  Our file is preallocated,
+                # so if we saved more than that and crashed, we would resume
+                # after a hole of zeros.
+                segment.downloaded = min(segment.length(),
+                        segment.client_start + stats.flushed)
+                rate += stats.download_rate
+        self.currentSize = sum(segment.downloaded
+                for segment in self.segments)
+        self.rate = rate
+        return active
+
     def pause(self):
         """Pauses the download.
         """
@@ -909,6 +1184,7 @@ class HTTPDownloader(BGDownloader):
             # downloaded data
             self.cancel_request(remove_file=True)
         self.currentSize = 0
+        self.segments = None
         self.state = u"stopped"
         self.update_client()
 
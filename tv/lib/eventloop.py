@@ -36,6 +36,7 @@ TODO: handle user setting clock back
 """
 
 import threading
+import collections
 import errno
 import select
 import socket
@@ -45,6 +46,8 @@ import logging
 import traceback
 from miro import app
 from miro import config
+from miro import eventloopstats
+from miro import eventpoller
 from miro import trapcall
 from miro import signals
 from miro import util
@@ -55,6 +58,9 @@ from miro.plat.utils import thread_body
 
 cumulative = {}
 
+# timing statistics for the event loop.  See get_stats_report()
+stats = eventloopstats.EventLoopStats()
+
 class DelayedCall(object):
     def __init__(self, function, name, args, kwargs):
         self.function = function
@@ -62,6 +68,8 @@ class DelayedCall(object):
         self.args = args
         self.kwargs = kwargs
         self.canceled = False
+        # time that we should run at, used to calculate the latency
+        self.scheduled_time = clock()
 
     def _unlink(self):
         """Removes the references that this object has to the outside
@@ -82,6 +90,8 @@ class DelayedCall(object):
             success = trapcall.trap_call(when, self.function, *self.args,
                     **self.kwargs)
             end = clock()
+            stats.record_call(self.name, start - self.scheduled_time,
+                    end - start)
             if end-start > 0.5:
                 logging.timing("%s too slow (%.3f secs)",
                                self.name, end-start)
@@ -109,6 +119,7 @@ class Scheduler(object):
             kwargs = {}
         scheduled_time = clock() + delay
         dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs)
+        dc.scheduled_time = scheduled_time
         heapq.heappush(self.heap, (scheduled_time, dc))
         return dc
 
@@ -166,35 +177,155 @@ class CallQueue(object):
             self.process_next_idle()
 
 
+# Lanes for call_in_thread().  Calls in higher priority lanes run first, and
+# lower priority lanes can only use some of the threads.  This way a bunch of
+# background work can't stop interactive calls from running.
+LANE_INTERACTIVE = 'interactive'
+LANE_IO = 'io'
+LANE_BACKGROUND = 'background'
+
+class ThreadPoolStats(object):
+    """Statistics for thread pool calls with the same name.
+
+    Times are in seconds.
+    """
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.finished = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_run_time = 0.0
+        self.max_run_time = 0.0
+
+    def copy(self):
+        rv = ThreadPoolStats()
+        rv.__dict__.update(self.__dict__)
+        return rv
+
+    def __repr__(self):
+        return ("<ThreadPoolStats queued: %s running: %s finished: %s "
+                "wait: %.3f (max %.3f) run: %.3f (max %.3f)>" % (
+                    self.queued, self.running, self.finished,
+                    self.total_wait_time, self.max_wait_time,
+                    self.total_run_time, self.max_run_time))
+
 class ThreadPool(object):
     """The thread pool is used to handle calls like gethostbyname()
     that block and there's no asynchronous workaround.  What we do
     instead is call them in a separate thread and return the result in
     a callback that executes in the event loop.
+
+    The pool starts with MIN_THREADS threads and grows up to MAX_THREADS
+    when calls are waiting and no threads are free.  Extra threads exit
+    after they've been idle for IDLE_TIMEOUT seconds.
+
+    Each call is put in a lane (see LANES).  Free threads take calls from
+    the first lane that has a call waiting, as long as that lane is using
+    less than LANE_LIMITS[lane] threads.
     """
-    THREADS = 3
+    MIN_THREADS = 3
+    MAX_THREADS = 10
+    IDLE_TIMEOUT = 30
+    LANES = (LANE_INTERACTIVE, LANE_IO, LANE_BACKGROUND)
+    LANE_LIMITS = {
+        LANE_INTERACTIVE: MAX_THREADS,
+        LANE_IO: MAX_THREADS - 2,
+        LANE_BACKGROUND: 3,
+    }
 
     def __init__(self, event_loop):
         self.event_loop = event_loop
-        self.queue = Queue.Queue()
+        self.condition = threading.Condition()
+        self.queues = dict((lane, collections.deque()) for lane in self.LANES)
+        self.running = dict((lane, 0) for lane in self.LANES)
+        self.stats = {}
         self.threads = []
+        self.idle_thread_count = 0
+        # incremented by close_threads(), threads from a previous
+        # generation exit as soon as they can.
+        self.generation = 0
+        self.started = False
 
     def init_threads(self):
-        while len(self.threads) < ThreadPool.THREADS:
-            t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
-                                 target=thread_body,
-                                 args=[self.thread_loop])
-            t.setDaemon(True)
-            t.start()
-            self.threads.append(t)
-
-    def thread_loop(self):
+        self.condition.acquire()
+        try:
+            self.started = True
+            while len(self.threads) < self.MIN_THREADS:
+                self._start_thread()
+        finally:
+            self.condition.release()
+
+    def _start_thread(self):
+        # NOTE: self.condition must be held
+        t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
+                             target=thread_body,
+                             args=[self.thread_loop, self.generation])
+        t.setDaemon(True)
+        self.threads.append(t)
+        t.start()
+
+    def _get_stats(self, name):
+        # NOTE: self.condition must be held
+        try:
+            return self.stats[name]
+        except KeyError:
+            stats = self.stats[name] = ThreadPoolStats()
+            return stats
+
+    def _next_call(self):
+        # NOTE: self.condition must be held
+        for lane in self.LANES:
+            if (self.queues[lane] and
+                    self.running[lane] < self.LANE_LIMITS[lane]):
+                return lane, self.queues[lane].popleft()
+        return None, None
+
+    def _wait_for_call(self, generation):
+        """Wait for a call to run.
+
+        :returns: (lane, call_info) tuple or (None, None) if the thread
+            should exit.
+        """
+        self.condition.acquire()
+        try:
+            while generation == self.generation:
+                lane, call_info = self._next_call()
+                if call_info is not None:
+                    self.running[lane] += 1
+                    return lane, call_info
+                # only extra threads use a timeout.  Condition.wait() polls
+                # when it has one.
+                if len(self.threads) > self.MIN_THREADS:
+                    timeout = self.IDLE_TIMEOUT
+                else:
+                    timeout = None
+                self.idle_thread_count += 1
+                start = clock()
+                try:
+                    self.condition.wait(timeout)
+                finally:
+                    self.idle_thread_count -= 1
+                if (timeout is not None and clock() - start >= timeout and
+                        len(self.threads) > self.MIN_THREADS):
+                    break
+            try:
+                self.threads.remove(threading.currentThread())
+            except ValueError:
+                pass # close_threads() already removed us
+            return None, None
+        finally:
+            self.condition.release()
+
+    def thread_loop(self, generation):
         while True:
-            next_item = self.queue.get()
-            if next_item == "QUIT":
+            lane, call_info = self._wait_for_call(generation)
+            if call_info is None:
                 break
-            else:
-                callback, errback, func, name, args, kwargs, = next_item
+            (callback, errback, func, name, args, kwargs,
+                    queue_time) = call_info
+            start = clock()
+            self._call_started(name, start - queue_time)
             try:
                 result = func(*args, **kwargs)
             except KeyboardInterrupt:
@@ -204,22 +335,94 @@ class ThreadPool(object):
                               func, name, args, kwargs,
                               "".join(traceback.format_exc()))
                 func = errback
-                name = 'Thread Pool Errback (%s)' % name
+                callback_name = 'Thread Pool Errback (%s)' % name
                 args = (exc,)
             else:
                 func = callback
-                name = 'Thread Pool Callback (%s)' % name
+                callback_name = 'Thread Pool Callback (%s)' % name
                 args = (result,)
+            finally:
+                self._call_finished(lane, name, clock() - start)
             if not self.event_loop.quit_flag:
-                self.event_loop.idle_queue.add_idle(func, name, args=args)
+                self.event_loop.idle_queue.add_idle(func, callback_name,
+                        args=args)
                 self.event_loop.wakeup()
 
+    def _call_started(self, name, wait_time):
+        self.condition.acquire()
+        try:
+            stats = self._get_stats(name)
+            stats.queued -= 1
+            stats.running += 1
+            stats.total_wait_time += wait_time
+            stats.max_wait_time = max(stats.max_wait_time, wait_time)
+        finally:
+            self.condition.release()
+
+    def _call_finished(self, lane, name, run_time):
+        self.condition.acquire()
+        try:
+            self.running[lane] -= 1
+            stats = self._get_stats(name)
+            stats.running -= 1
+            stats.finished += 1
+            stats.total_run_time += run_time
+            stats.max_run_time = max(stats.max_run_time, run_time)
+            # a lane limit may have been stopping other calls from running
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
     def queue_call(self, callback, errback, function, name, *args, **kwargs):
-        self.queue.put((callback, errback, function, name, args, kwargs))
+        self.queue_call_in_lane(LANE_IO, callback, errback, function, name,
+                *args, **kwargs)
+
+    def queue_call_in_lane(self, lane, callback, errback, function, name,
+            *args, **kwargs):
+        if lane not in self.queues:
+            raise ValueError("Unknown lane: %r" % (lane,))
+        self.condition.acquire()
+        try:
+            self.queues[lane].append((callback, errback, function, name,
+                args, kwargs, clock()))
+            self._get_stats(name).queued += 1
+            if (self.started and
+                    self.running[lane] < self.LANE_LIMITS[lane] and
+                    self.idle_thread_count < self.queue_depth() and
+                    len(self.threads) < self.MAX_THREADS):
+                self._start_thread()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def queue_depth(self, lane=None):
+        """Get the number of calls waiting to be run."""
+        if lane is not None:
+            return len(self.queues[lane])
+        return sum(len(queue) for queue in self.queues.itervalues())
+
+    def get_stats(self):
+        """Get statistics for calls that have been queued.
+
+        :returns: dict mapping call names to ThreadPoolStats objects
+        """
+        self.condition.acquire()
+        try:
+            return dict((name, stats.copy())
+                    for name, stats in self.stats.iteritems())
+        finally:
+            self.condition.release()
 
     def close_threads(self):
-        for x in xrange(len(self.threads)):
-            self.queue.put("QUIT")
+        self.condition.acquire()
+        try:
+            self.generation += 1
+            self.started = False
+            threads = self.threads
+            self.threads = []
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
         # Why is there a timeout on the join() here, what's wrong?  On
         # shutdown, the system waits for the eventloop to finish using 
         # eventloop.join() but eventloop calls close_threads() which wait
@@ -227,8 +430,8 @@ class ThreadPool(object):
         # in a blocking operation which is exactly the point of having them
         # so eventloop.join() in turn blocks.  So if it doesn't clean up
         # in time let the daemon flag in the Thread() do its job.  See #16584.
-        while len(self.threads) > 0:
-            x = self.threads.pop()
+        while len(threads) > 0:
+            x = threads.pop()
             try:
                 x.join(0.5)
             except StandardError:
@@ -244,6 +447,35 @@ class SimpleEventLoop(signals.SignalEmitter):
         self.quit_flag = False
         self.wake_sender, self.wake_receiver = util.make_dummy_socket_pair()
         self.loop_ready = threading.Event()
+        # Subclasses should keep the poller up to date by calling
+        # set_fd_events(), or implement update_poller()
+        self.poller = eventpoller.create_poller()
+        self.poller.register(self.wake_receiver.fileno(), eventpoller.READ)
+
+    def set_fd_events(self, fd, events):
+        """Set the events to wait for on a file descriptor.
+
+        events should be a combination of eventpoller.READ and
+        eventpoller.WRITE, or 0 to stop waiting on fd.
+        """
+        self.poller.register(fd, events)
+
+    def update_poller(self):
+        """Called before we poll for events.
+
+        Subclasses that can't keep the poller registrations up to date can
+        override this to update them all at once.
+        """
+        pass
+
+    def record_poll_wait(self, wait_time):
+        """Called with the time we spent waiting in poll().
+
+        The main event loop overrides this to keep timing statistics.
+        Other loops (like the libcurl thread) don't, so that their waits
+        don't get mixed into the main loop's report.
+        """
+        pass
 
     def loop(self):
         self.loop_ready.set()
@@ -251,26 +483,36 @@ class SimpleEventLoop(signals.SignalEmitter):
         self.emit('thread-started', threading.currentThread())
         self.emit('thread-did-start')
 
+        wake_fd = self.wake_receiver.fileno()
         while not self.quit_flag:
             self.emit('begin-loop')
             timeout = self.calc_timeout()
-            readfds, writefds, excfds = self.calc_fds()
-            readfds.append(self.wake_receiver.fileno())
+            self.update_poller()
+            poll_start = clock()
             try:
-                read_fds_ready, write_fds_ready, exc_fds_ready = \
-                        select.select(readfds, writefds, excfds, timeout)
+                events = self.poller.poll(timeout)
             except select.error, (err, detail):
                 if err == errno.EINTR:
                     logging.warning ("eventloop: %s", detail)
+                    events = []
                 else:
                     self.emit('end-loop')
                     raise
+            self.record_poll_wait(clock() - poll_start)
             if self.quit_flag:
                 self.emit('end-loop')
                 break
-            if self.wake_receiver.fileno() in read_fds_ready:
-                self._slurp_waker_data()
-            self.process_events(read_fds_ready, write_fds_ready, exc_fds_ready)
+            read_fds_ready = []
+            write_fds_ready = []
+            for fd, fd_events in events:
+                if fd == wake_fd:
+                    self._slurp_waker_data()
+                    continue
+                if fd_events & eventpoller.READ:
+                    read_fds_ready.append(fd)
+                if fd_events & eventpoller.WRITE:
+                    write_fds_ready.append(fd)
+            self.process_events(read_fds_ready, write_fds_ready, [])
             self.emit('end-loop')
 
     def wakeup(self):
@@ -300,18 +542,34 @@ class EventLoop(SimpleEventLoop):
         self.removed_write_callbacks = set()
 
     def add_read_callback(self, sock, callback):
-        self.read_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.read_callbacks[fd] = callback
+        self._update_fd_events(fd)
 
     def remove_read_callback(self, sock):
-        del self.read_callbacks[sock.fileno()]
-        self.removed_read_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.read_callbacks[fd]
+        self.removed_read_callbacks.add(fd)
+        self._update_fd_events(fd)
 
     def add_write_callback(self, sock, callback):
-        self.write_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.write_callbacks[fd] = callback
+        self._update_fd_events(fd)
 
     def remove_write_callback(self, sock):
-        del self.write_callbacks[sock.fileno()]
-        self.removed_write_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.write_callbacks[fd]
+        self.removed_write_callbacks.add(fd)
+        self._update_fd_events(fd)
+
+    def _update_fd_events(self, fd):
+        events = 0
+        if fd in self.read_callbacks:
+            events |= eventpoller.READ
+        if fd in self.write_callbacks:
+            events |= eventpoller.WRITE
+        self.set_fd_events(fd, events)
 
     def call_in_thread(self, callback, errback, function, name,
                        *args, **kwargs):
@@ -323,6 +581,7 @@ class EventLoop(SimpleEventLoop):
         self.idles_for_next_loop.append((function, name, args, kwargs))
 
     def process_events(self, read_fds_ready, write_fds_ready, exc_fds_ready):
+        self._record_queue_depths()
         self._process_urgent_events()
         if self.quit_flag:
             return
@@ -335,8 +594,16 @@ class EventLoop(SimpleEventLoop):
             if self.quit_flag:
                 break
 
-    def calc_fds(self):
-        return (self.read_callbacks.keys(), self.write_callbacks.keys(), [])
+    def record_poll_wait(self, wait_time):
+        stats.record_poll_wait(wait_time)
+
+    def _record_queue_depths(self):
+        stats.record_queue_depth('idle queue', self.idle_queue.queue.qsize())
+        stats.record_queue_depth('urgent queue',
+                self.urgent_queue.queue.qsize())
+        stats.record_queue_depth('timeouts', len(self.scheduler.heap))
+        stats.record_queue_depth('thread pool',
+                self.threadpool.queue_depth())
 
     def calc_timeout(self):
         return self.scheduler.next_timeout()
@@ -398,6 +665,7 @@ class EventLoop(SimpleEventLoop):
                     success = trapcall.trap_call(when, function)
                     if not success:
                         del map_[fd]
+                        self._update_fd_events(fd)
                     return success
                 yield callback_event
 
@@ -484,6 +752,37 @@ def call_in_thread(callback, errback, function, name, *args, **kwargs):
     _eventloop.call_in_thread(
         callback, errback, function, name, *args, **kwargs)
 
+def call_in_thread_lane(lane, callback, errback, function, name, *args,
+        **kwargs):
+    """Like call_in_thread(), but use a specific thread pool lane.
+
+    lane should be LANE_INTERACTIVE, LANE_IO or LANE_BACKGROUND.
+    call_in_thread() uses LANE_IO.
+    """
+    _eventloop.threadpool.queue_call_in_lane(lane,
+        callback, errback, function, name, *args, **kwargs)
+
+def get_stats_report(count=20):
+    """Get a text report of the event loop timing statistics.
+
+    See eventloopstats.EventLoopStats.get_report().
+    """
+    return stats.get_report(count)
+
+def log_stats_periodically(interval):
+    """Log the event loop timing statistics every interval seconds."""
+    def log_stats():
+        logging.timing("Event loop stats:\n%s", get_stats_report())
+        add_timeout(interval, log_stats, "log event loop stats")
+    add_timeout(interval, log_stats, "log event loop stats")
+
+def thread_pool_stats():
+    """Get statistics for the thread pool.
+
+    :returns: dict mapping call names to ThreadPoolStats objects
+    """
+    return _eventloop.threadpool.get_stats()
+
 lt = None
 
 profile_file = None
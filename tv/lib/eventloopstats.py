@@ -0,0 +1,188 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.eventloopstats`` -- Timing statistics for the event loop.
+
+EventLoopStats keeps track of:
+
+* dispatch latency for each callback name.  This is the time between when a
+  callback was scheduled to run and when it actually started.
+* run time for each callback name
+* the time the event loop spent waiting for events
+* queue depths for the idle queue, urgent queue, timeouts and thread pool
+
+Times are stored in histograms, so we can tell a callback that's always a bit
+slow from one that's usually fast but sometimes blocks the event loop for
+seconds.
+"""
+
+import bisect
+
+# Upper bounds for histogram buckets, in seconds.  The last bucket holds
+# everything larger than BUCKETS[-1].
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Maximum number of callback names to track.  Calls after that are lumped
+# together as OTHER_NAME.
+MAX_NAMES = 1000
+OTHER_NAME = '<other>'
+
+class Histogram(object):
+    """Histogram of times."""
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, fraction):
+        """Get an upper bound for a percentile.
+
+        :param fraction: percentile to get, between 0.0 and 1.0
+        :returns: the upper bound of the bucket that the percentile falls in
+        """
+        target = fraction * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if seen >= target and seen > 0:
+                if i < len(BUCKETS):
+                    return min(BUCKETS[i], self.max)
+                break
+        return self.max
+
+    def format(self):
+        return "n=%d total=%.3f mean=%.4f p50<=%.3f p99<=%.3f max=%.3f" % (
+                self.count, self.total, self.mean(), self.percentile(0.5),
+                self.percentile(0.99), self.max)
+
+class CallStats(object):
+    """Latency and run time histograms for a callback name."""
+    def __init__(self):
+        self.latency = Histogram()
+        self.run_time = Histogram()
+
+class QueueDepthStats(object):
+    """Tracks the depth of a queue each time we sample it."""
+    def __init__(self):
+        self.last = 0
+        self.max = 0
+        self.total = 0
+        self.samples = 0
+
+    def add(self, depth):
+        self.last = depth
+        self.total += depth
+        self.samples += 1
+        if depth > self.max:
+            self.max = depth
+
+    def mean(self):
+        if self.samples == 0:
+            return 0.0
+        return float(self.total) / self.samples
+
+class EventLoopStats(object):
+    """Statistics for an event loop.
+
+    The record_* methods should be called from the event loop thread.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.poll_wait = Histogram()
+        self.queue_depths = {}
+
+    def record_call(self, name, latency, run_time):
+        try:
+            call_stats = self.calls[name]
+        except KeyError:
+            if len(self.calls) >= MAX_NAMES:
+                name = OTHER_NAME
+            call_stats = self.calls.get(name)
+            if call_stats is None:
+                call_stats = self.calls[name] = CallStats()
+        call_stats.latency.add(latency)
+        call_stats.run_time.add(run_time)
+
+    def record_poll_wait(self, wait_time):
+        self.poll_wait.add(wait_time)
+
+    def record_queue_depth(self, queue_name, depth):
+        try:
+            depth_stats = self.queue_depths[queue_name]
+        except KeyError:
+            depth_stats = self.queue_depths[queue_name] = QueueDepthStats()
+        depth_stats.add(depth)
+
+    def get_report(self, count=20):
+        """Get a text report of the statistics.
+
+        :param count: number of callbacks to include in the report.  We
+            include the callbacks with the most total run time and the ones
+            with the highest maximum latency.
+        """
+        lines = ['poll wait: %s' % self.poll_wait.format()]
+        queue_names = self.queue_depths.keys()
+        queue_names.sort()
+        for queue_name in queue_names:
+            depth_stats = self.queue_depths[queue_name]
+            lines.append('%s depth: last=%d mean=%.1f max=%d' % (queue_name,
+                depth_stats.last, depth_stats.mean(), depth_stats.max))
+        by_run_time = self.calls.items()
+        by_run_time.sort(key=lambda item: item[1].run_time.total,
+                reverse=True)
+        lines.append('-' * 40)
+        lines.append('Slowest callbacks (by total run time):')
+        for name, call_stats in by_run_time[:count]:
+            lines.append(name)
+            lines.append('    run time: %s' % call_stats.run_time.format())
+            lines.append('    latency:  %s' % call_stats.latency.format())
+        by_latency = self.calls.items()
+        by_latency.sort(key=lambda item: item[1].latency.max, reverse=True)
+        lines.append('-' * 40)
+        lines.append('Most delayed callbacks (by max latency):')
+        for name, call_stats in by_latency[:count]:
+            lines.append('%s: %s' % (name, call_stats.latency.format()))
+        return '\n'.join(lines)
@@ -0,0 +1,238 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.eventpoller`` -- Wait for events on file descriptors.
+
+Pollers keep track of which file descriptors we want to read from or write
+to.  Registrations stay around between calls to poll(), so the event loops
+only need to tell the poller when they change.
+
+We use epoll when it's available and fall back to select() otherwise.
+select() is O(n) for each call and can't handle file descriptors larger than
+FD_SETSIZE (usually 1024), but it works everywhere.
+"""
+
+import errno
+import select
+
+# event flags
+READ = 1
+WRITE = 2
+
+class Poller(object):
+    """Base class for pollers.
+
+    Subclasses should implement _add(), _modify(), _remove() and poll().
+    """
+    def __init__(self):
+        # maps file descriptors to the event flags that we care about
+        self.fd_events = {}
+
+    def register(self, fd, events):
+        """Set the events we want to wait for on a file descriptor.
+
+        :param fd: file descriptor to watch
+        :param events: READ, WRITE or READ | WRITE.  0 unregisters fd.
+        """
+        if not events:
+            self.unregister(fd)
+            return
+        old_events = self.fd_events.get(fd)
+        if old_events == events:
+            return
+        self.fd_events[fd] = events
+        if old_events is None:
+            self._add(fd, events)
+        else:
+            self._modify(fd, events)
+
+    def unregister(self, fd):
+        """Stop watching a file descriptor.
+
+        It's okay to call this for file descriptors that aren't registered or
+        that have already been closed.
+        """
+        if self.fd_events.pop(fd, None) is not None:
+            self._remove(fd)
+
+    def set_fds(self, read_fds, write_fds, keep_fds=()):
+        """Replace all registrations.
+
+        This is for event loops that only know which fds they care about
+        right before they call poll().
+
+        :param keep_fds: fds to leave registered as they are
+        """
+        new_fd_events = dict((fd, READ) for fd in read_fds)
+        for fd in write_fds:
+            new_fd_events[fd] = new_fd_events.get(fd, 0) | WRITE
+        for fd in keep_fds:
+            if fd in self.fd_events:
+                new_fd_events[fd] = self.fd_events[fd]
+        for fd in self.fd_events.keys():
+            if fd not in new_fd_events:
+                self.unregister(fd)
+        for fd, events in new_fd_events.iteritems():
+            self.register(fd, events)
+
+    def poll(self, timeout):
+        """Wait for events.
+
+        :param timeout: seconds to wait or None to wait forever.
+        :returns: list of (fd, events) tuples.  Errors and hangups are
+            reported as all the events that we're watching fd for.
+        :raises select.error: if the system call fails.  The error number
+            is EINTR if a signal interrupted it.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def _add(self, fd, events):
+        raise NotImplementedError()
+
+    def _modify(self, fd, events):
+        raise NotImplementedError()
+
+    def _remove(self, fd):
+        raise NotImplementedError()
+
+class SelectPoller(Poller):
+    """Poller that uses select()."""
+
+    def __init__(self):
+        Poller.__init__(self)
+        self.read_fds = set()
+        self.write_fds = set()
+
+    def _add(self, fd, events):
+        if events & READ:
+            self.read_fds.add(fd)
+        if events & WRITE:
+            self.write_fds.add(fd)
+
+    def _modify(self, fd, events):
+        self._remove(fd)
+        self._add(fd, events)
+
+    def _remove(self, fd):
+        self.read_fds.discard(fd)
+        self.write_fds.discard(fd)
+
+    def poll(self, timeout):
+        read_ready, write_ready, exc_ready = select.select(
+                list(self.read_fds), list(self.write_fds), [], timeout)
+        events = dict((fd, READ) for fd in read_ready)
+        for fd in write_ready:
+            events[fd] = events.get(fd, 0) | WRITE
+        return events.items()
+
+class EpollPoller(Poller):
+    """Poller that uses epoll (linux only)."""
+
+    def __init__(self):
+        Poller.__init__(self)
+        self.epoll = select.epoll()
+        _set_close_on_exec(self.epoll.fileno())
+
+    def _epoll_mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.EPOLLIN
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def _add(self, fd, events):
+        try:
+            self.epoll.register(fd, self._epoll_mask(events))
+        except IOError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.epoll.modify(fd, self._epoll_mask(events))
+
+    def _modify(self, fd, events):
+        try:
+            self.epoll.modify(fd, self._epoll_mask(events))
+        except IOError, e:
+            # epoll forgets about fds when they get closed.  If the fd
+            # number has been reused, we need to register it again.
+            if e.errno != errno.ENOENT:
+                raise
+            self.epoll.register(fd, self._epoll_mask(events))
+
+    def _remove(self, fd):
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            # fd was already closed
+            pass
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        try:
+            epoll_events = self.epoll.poll(timeout)
+        except IOError, e:
+            raise select.error(e.errno, e.strerror)
+        rv = []
+        for fd, mask in epoll_events:
+            events = 0
+            if mask & (select.EPOLLERR | select.EPOLLHUP):
+                events = self.fd_events.get(fd, 0)
+            if mask & select.EPOLLIN:
+                events |= READ
+            if mask & select.EPOLLOUT:
+                events |= WRITE
+            if events:
+                rv.append((fd, events))
+        return rv
+
+    def close(self):
+        self.epoll.close()
+
+def _set_close_on_exec(fd):
+    try:
+        import fcntl
+    except ImportError:
+        return
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+# Poller class to use.  None means pick the best one for the platform.
+poller_class = None
+
+def create_poller():
+    """Create a new poller object."""
+    if poller_class is not None:
+        return poller_class()
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    return SelectPoller()
@@ -69,7 +69,7 @@ from miro import fileutil
 from miro.plat.utils import filename_to_unicode, make_url_safe, unmake_url_safe
 from miro.plat.filebundle import is_file_bundle
 from miro import filetypes
-from miro.item import FeedParserValues
+from miro.feedparservalues import FeedParserValues, ParsedFeed
 from miro import searchengines
 from miro import workerprocess
 from miro.clock import clock
@@ -89,29 +89,6 @@ def default_feed_icon_url():
 def default_feed_icon_path():
     return resources.path(DEFAULT_FEED_ICON)
 
-class _RateLimiter(object):
-    """Helper class used by create_items_for_parsed() to avoid hogging the
-    GIL.
-
-    This class helps ensure that a potentially long-running operation doesn't
-    take more than a fixed-percentage of the CPU.  It's not really a great
-    solution, but it's the simplest way for 4.0.2
-    """
-    def __init__(self):
-        self.last_time = time.time()
-
-    def check_for_sleep(self):
-        new_time = time.time()
-        elapsed = self.last_time - time.time()
-        if elapsed < 0.1:
-            return # don't sleep until a decent of time has passed.
-        # We want to yield at least 10% of the CPU.  Sleep for 10% of the time
-        # we took since the last check
-        sleep_time = elapsed / 10.0
-        time.sleep(sleep_time)
-        # get ready for the next check() call
-        self.last_time = time.time()
-
 # Notes on character set encoding of feeds:
 #
 # The parsing libraries built into Python mostly use byte strings
@@ -223,15 +200,15 @@ def _on_config_change(obj, key, value):
         for feed in Feed.make_view():
             update_freq = 0
             try:
-                update_freq = feed.parsed["feed"]["ttl"]
-            except (AttributeError, KeyError):
+                update_freq = feed.parsed.ttl
+            except AttributeError:
                 pass
             feed.set_update_frequency(update_freq)
 
 def run_feedparser(html, callback, errback):
     if _RUN_FEED_PARSER_INLINE:
         try:
-            rv = feedparserutil.parse(html)
+            rv = ParsedFeed(feedparserutil.parse(html))
         except StandardError, e:
             errback(e)
         else:
@@ -1154,6 +1131,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if isinstance(self.actualFeed, DirectoryWatchFeedImpl):
             move_items_to = None
         self.cancel_update_events()
+        feedupdate.forget_feed(self)
         if self.download is not None:
             self.download.cancel()
             self.download = None
@@ -1192,6 +1170,14 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
     def has_downloading_items(self):
         return self.num_downloading() > 0
 
+    def get_newest_item_time(self):
+        """Get the creation time of our newest item, or None if we don't
+        have any items.
+        """
+        for item in models.Item.newest_created_in_feed_view(self.id):
+            return item.creationTime
+        return None
+
     def __str__(self):
         return "Feed - %s" % stringify(self.get_title())
 
@@ -1208,8 +1194,9 @@ class ThrottledUpdateFeedImpl(FeedImpl):
                     self.update)
         else:
             if self.updateFreq > 0:
-                feedupdate.schedule_update(self.updateFreq, self.ufeed,
-                        self.update)
+                delay = feedupdate.next_update_delay(self.ufeed,
+                        self.updateFreq)
+                feedupdate.schedule_update(delay, self.ufeed, self.update)
 
 class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     """
@@ -1219,8 +1206,11 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
         FeedImpl.setup_new(self, url, ufeed, title)
         self.schedule_update_events(0)
 
-    def _handle_new_entry(self, entry, fp_values, channel_title):
-        """Handle getting a new entry from a feed."""
+    def _handle_new_entry(self, fp_values, channel_title):
+        """Handle getting a new entry from a feed.
+
+        :returns: the Item for the entry, or None if we didn't keep one
+        """
         enclosure = fp_values.first_video_enclosure
         if ((self.url.startswith('file://') and enclosure
              and enclosure['url'].startswith('file://'))):
@@ -1233,42 +1223,46 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                     channel_title=channel_title)
             if not item.matches_search(self.ufeed.searchTerm):
                 item.remove()
+                return None
+        return item
 
     def remember_old_items(self):
         self.old_items = set(self.items)
+        # Items that we matched in our last update, keyed by the content
+        # hash of the ParsedFeed.  See _parsed_feed_unchanged()
+        self.last_parsed_items = getattr(self, 'parsed_items', {})
+        self.parsed_items = {}
 
     def create_items_for_parsed(self, parsed):
-        """Update the feed using parsed XML passed in"""
+        """Update the feed using a ParsedFeed
+
+        :returns: the number of new items
+        """
         app.bulk_sql_manager.start()
         try:
-            self._create_items_for_parsed(parsed)
+            return self._create_items_for_parsed(parsed)
         finally:
             app.bulk_sql_manager.finish()
 
     def _create_items_for_parsed(self, parsed):
-        rate_limiter = _RateLimiter()
-        channel_title = None
-        try:
-            channel_title = parsed["feed"]["title"]
-        except KeyError:
-            try:
-                channel_title = parsed["channel"]["title"]
-            except KeyError:
-                pass
-
+        channel_title = parsed.channel_title
         if channel_title != None and self._allow_feed_to_override_title():
             self.title = channel_title
-        if (parsed.feed.has_key('image') and
-                parsed.feed.image.has_key('url') and
+        if (parsed.thumbnail_url is not None and
                 self._allow_feed_to_override_thumbnail()):
-            self.thumbURL = parsed.feed.image.url
+            self.thumbURL = parsed.thumbnail_url
             self.ufeed.icon_cache.request_update(is_vital=True)
 
+        if self._parsed_feed_unchanged(parsed):
+            return 0
+        search_term = self.ufeed.searchTerm
+        matched_items = set()
+        new_count = 0
+
         items_byid = {}
         items_byURLTitle = {}
         items_nokey = []
         for item in self.items:
-            rate_limiter.check_for_sleep()
             try:
                 items_byid[item.get_rss_id()] = item
             except KeyError:
@@ -1276,10 +1270,7 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
             by_url_title_key = (item.url, item.entry_title)
             if by_url_title_key != (None, None):
                 items_byURLTitle[by_url_title_key] = item
-        for entry in parsed.entries:
-            rate_limiter.check_for_sleep()
-            entry = self.add_scraped_thumbnail(entry)
-            fp_values = FeedParserValues(entry)
+        for fp_values in parsed.entries:
             new = True
             if fp_values.data['rss_id'] is not None:
                 id_ = fp_values.data['rss_id']
@@ -1289,6 +1280,7 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                         item.update_from_feed_parser_values(fp_values)
                     new = False
                     self.old_items.discard(item)
+                    matched_items.add(item)
             if new:
                 by_url_title_key = (fp_values.data['url'],
                         fp_values.data['entry_title'])
@@ -1299,6 +1291,7 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                             item.update_from_feed_parser_values(fp_values)
                         new = False
                         self.old_items.discard(item)
+                        matched_items.add(item)
             if new:
                 for item in items_nokey:
                     if fp_values.compare_to_item(item):
@@ -1309,10 +1302,38 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                                 item.update_from_feed_parser_values(fp_values)
                                 new = False
                                 self.old_items.discard(item)
+                                matched_items.add(item)
                         except StandardError:
                             pass
             if new and fp_values.first_video_enclosure is not None:
-                self._handle_new_entry(entry, fp_values, channel_title)
+                item = self._handle_new_entry(fp_values, channel_title)
+                if item is not None:
+                    matched_items.add(item)
+                    new_count += 1
+        self.parsed_items[parsed.content_hash] = (search_term, matched_items)
+        return new_count
+
+    def _parsed_feed_unchanged(self, parsed):
+        """Check if we can skip matching a ParsedFeed against our items.
+
+        If we got the same content last update, our search term is the same
+        and all the items we matched then are still in the feed, then
+        matching again would just match the same items.  In that case, we
+        only need to keep them out of old_items.
+        """
+        try:
+            search_term, matched_items = self.last_parsed_items[
+                    parsed.content_hash]
+        except KeyError:
+            return False
+        if search_term != self.ufeed.searchTerm:
+            return False
+        for item in matched_items:
+            if not item.id_exists() or item.feed_id != self.ufeed_id:
+                return False
+        self.old_items.difference_update(matched_items)
+        self.parsed_items[parsed.content_hash] = (search_term, matched_items)
+        return True
 
     def _allow_feed_to_override_title(self):
         """Should the RSS feed override the default title?
@@ -1378,16 +1399,6 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
         for time_, item in candidates[:extra]:
             item.remove()
 
-    def add_scraped_thumbnail(self, entry):
-        # skip this if the entry already has a thumbnail.
-        if entry.has_key('thumbnail'):
-            return entry
-        if entry.has_key('enclosures'):
-            for enc in entry['enclosures']:
-                if enc.has_key('thumbnail'):
-                    return entry
-        return entry
-
 class RSSFeedImpl(RSSFeedImplBase):
     def setup_new(self, url, ufeed, title=None, initialHTML=None, etag=None,
                   modified=None):
@@ -1397,22 +1408,28 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.modified = modified
         self.download = None
 
-    @returns_unicode
-    def get_base_href(self):
+    def _get_parsed_link(self):
         try:
             return self.parsed.link
         except AttributeError:
+            return None
+
+    @returns_unicode
+    def get_base_href(self):
+        link = self._get_parsed_link()
+        if link is None:
             return FeedImpl.get_base_href(self)
+        return link
 
     @returns_unicode
     def get_link(self):
         """Returns a link to a webpage associated with the feed
         """
         self.ufeed.confirm_db_thread()
-        try:
-            return self.parsed.link
-        except AttributeError:
+        link = self._get_parsed_link()
+        if link is None:
             return u""
+        return link
 
     def feedparser_finished(self):
         self.updating = False
@@ -1423,26 +1440,25 @@ class RSSFeedImpl(RSSFeedImplBase):
         if not self.ufeed.id_exists():
             return
         logging.warning("Error updating feed: %s: %s", self.url, e)
+        feedupdate.record_error(self.ufeed)
         self.feedparser_finished()
 
     def feedparser_callback(self, parsed):
         self.ufeed.confirm_db_thread()
         if not self.ufeed.id_exists():
             return
-        if len(parsed.entries) == len(parsed.feed) == 0:
+        if parsed.is_empty:
             logging.warn("Empty feed, not updating: %s", self.url)
+            feedupdate.record_update(self.ufeed, 0)
             self.feedparser_finished()
             return
         start = clock()
         self.parsed = parsed
         self.remember_old_items()
-        self.create_items_for_parsed(parsed)
+        new_count = self.create_items_for_parsed(parsed)
+        feedupdate.record_update(self.ufeed, new_count)
 
-        try:
-            updateFreq = self.parsed["feed"]["ttl"]
-        except KeyError:
-            updateFreq = 0
-        self.set_update_frequency(updateFreq)
+        self.set_update_frequency(self.parsed.ttl)
 
         self.feedparser_finished()
         end = clock()
@@ -1489,6 +1505,7 @@ class RSSFeedImpl(RSSFeedImplBase):
             return
         logging.warn("WARNING: error in Feed.update for %s -- %s",
             self.ufeed, stringify(error))
+        feedupdate.record_error(self.ufeed)
         self.schedule_update_events(-1)
         self.updating = False
         self.ufeed.signal_change(needs_save=False)
@@ -1499,6 +1516,7 @@ class RSSFeedImpl(RSSFeedImplBase):
         if info.get('status') == 304:
             logging.debug("RSSFeedImpl: _update_callback: "
                           "status 304 (%s)", self.ufeed)
+            feedupdate.record_not_modified(self.ufeed)
             self.schedule_update_events(-1)
             self.updating = False
             self.ufeed.signal_change()
@@ -1524,10 +1542,12 @@ class RSSFeedImpl(RSSFeedImplBase):
         """Returns the URL of the license associated with the feed
         """
         try:
-            return self.parsed["feed"]["license"]
-        except (AttributeError, KeyError):
-            pass
-        return u""
+            license_ = self.parsed.license
+        except AttributeError:
+            license_ = None
+        if license_ is None:
+            return u""
+        return license_
 
     def on_remove(self):
         if self.download is not None:
@@ -1552,6 +1572,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         self.modified = {}
         self.download_dc = {}
         self.updating = 0
+        self.reset_update_results()
         self.urls = self.calc_urls()
 
     def setup_restored(self):
@@ -1560,8 +1581,26 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         RSSFeedImplBase.setup_restored(self)
         self.download_dc = {}
         self.updating = 0
+        self.reset_update_results()
         self.urls = self.calc_urls()
 
+    def reset_update_results(self):
+        """Reset what we know about the update of each of our URLs.
+
+        We combine the results and record them with feedupdate once, when
+        all the URLs are done.
+        """
+        self.update_new_count = 0
+        self.update_succeeded = False
+        self.update_failed = False
+
+    def record_update_results(self):
+        if self.update_succeeded:
+            feedupdate.record_update(self.ufeed, self.update_new_count)
+        elif self.update_failed:
+            feedupdate.record_error(self.ufeed)
+        self.reset_update_results()
+
     def calc_urls(self):
         """Calculate the list of URLs to parse.
 
@@ -1571,6 +1610,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
 
     def check_update_finished(self):
         if self.updating == 0:
+            self.record_update_results()
             self.update_finished()
             self.schedule_update_events(-1)
 
@@ -1593,6 +1633,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         else:
             logging.warning("Error updating feed: %s (%s)",
                             self.url, url)
+        self.update_failed = True
         self.feedparser_finished(url, True)
 
     def feedparser_callback(self, parsed, url):
@@ -1600,7 +1641,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         if not self.ufeed.id_exists() or url not in self.download_dc:
             return
         start = clock()
-        self.create_items_for_parsed(parsed)
+        self.update_new_count += self.create_items_for_parsed(parsed)
+        self.update_succeeded = True
         self.feedparser_finished(url)
         end = clock()
         if end - start > 1.0:
@@ -1619,6 +1661,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             return
         if self.updating:
             return
+        self.reset_update_results()
         self.remember_old_items()
         for url in self.urls:
             etag = self.etag.get(url)
@@ -1636,6 +1679,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             return
         logging.warn("WARNING: error in Feed.update for %s (%s) -- %s",
                      self.ufeed, stringify(url), stringify(error))
+        self.update_failed = True
         self.schedule_update_events(-1)
         self.updating -= 1
         self.check_update_finished()
@@ -1647,6 +1691,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         if info.get('status') == 304:
             logging.debug("RSSMultiFeedBase: _update_callback: "
                           "status 304 (%s)", self.ufeed)
+            # not modified counts as a successful update with no new entries
+            self.update_succeeded = True
             self.schedule_update_events(-1)
             self.updating -= 1
             self.check_update_finished()
@@ -2389,7 +2435,7 @@ class SearchFeedImpl(RSSMultiFeedBase):
         self.update()
         self.ufeed.signal_change()
 
-    def _handle_new_entry(self, entry, fp_values, channel_title):
+    def _handle_new_entry(self, fp_values, channel_title):
         """Handle getting a new entry from a feed."""
         url = fp_values.data['url']
         if url is not None:
@@ -2399,21 +2445,24 @@ class SearchFeedImpl(RSSMultiFeedBase):
                     if ((item.get_feed_url() == 'dtv:searchDownloads'
                          and item.get_url() == url)):
                         try:
-                            if entry["id"] == item.get_rss_id():
+                            if ((fp_values.data['rss_id'] is not None and
+                                 fp_values.data['rss_id'] ==
+                                 item.get_rss_id())):
                                 item.set_feed(self.ufeed.id)
                                 if not fp_values.compare_to_item(item):
                                     item.update_from_feed_parser_values(fp_values)
-                                return
+                                return item
                         except KeyError:
                             pass
-                        title = entry.get("title")
+                        title = fp_values.data['entry_title']
                         oldtitle = item.entry_title
                         if title == oldtitle:
                             item.set_feed(self.ufeed.id)
                             if not fp_values.compare_to_item(item):
                                 item.update_from_feed_parser_values(fp_values)
-                            return
-        RSSMultiFeedBase._handle_new_entry(self, entry, fp_values, channel_title)
+                            return item
+        return RSSMultiFeedBase._handle_new_entry(self, fp_values,
+                channel_title)
 
     def update_finished(self):
         self.searching = False
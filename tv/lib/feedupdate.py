@@ -31,13 +31,132 @@
 
 Our basic strategy is to limit the number of feeds that are
 simultaniously updating at any given time.  Right now the limit is set
-to 3.
+to 3, and to 2 for feeds on the same host.
+
+We also try to learn how often each feed publishes new entries and update
+quiet feeds less often (see FeedUpdateHistory).  We don't save the update
+histories.  On startup, we start each feed's history from data that's in the
+database: when the feed was created and when its newest item was created.
 """
 
+import random
+import time
+
 from miro import eventloop
 from miro import datastructures
+from miro import download_utils
 
 MAX_UPDATES = 3
+MAX_UPDATES_PER_HOST = 2
+
+# We poll a feed this many times for each publish interval that we've seen.
+POLLS_PER_PUBLISH_INTERVAL = 4
+# Weight for the newest interval when averaging publish intervals
+PUBLISH_INTERVAL_WEIGHT = 0.3
+# Never wait more than this many times the feed's update frequency.  This
+# is also the limit for backing off after errors.
+MAX_INTERVAL_FACTOR = 8
+# Randomly change delays by up to this fraction so that feeds added at the
+# same time don't keep updating at the same time.
+JITTER = 0.1
+
+class FeedUpdateHistory(object):
+    """Tracks what happened when we updated a feed.
+
+    We use this to calculate when to update it next.  Feeds that have
+    published recently get updated at their normal frequency.  As a feed
+    stays quiet, we update it less and less often.
+
+    :ivar publish_interval: average time between updates with new entries,
+        or None if we haven't seen that twice yet
+    :ivar last_new_entries: last time an update had new entries
+    :ivar error_count: number of errors in a row
+    """
+    def __init__(self, now=None, last_new_entries=None):
+        if now is None:
+            now = time.time()
+        self.publish_interval = None
+        self.last_new_entries = last_new_entries
+        # start counting quiet time from when we first saw the feed
+        self.first_update = now
+        self.error_count = 0
+
+    @classmethod
+    def for_feed(cls, feed):
+        """Create a FeedUpdateHistory for a feed using data from the DB.
+
+        We count quiet time from when the feed was created and take the
+        creation time of the newest item as the last time that we saw new
+        entries.
+        """
+        newest_item_time = feed.get_newest_item_time()
+        if newest_item_time is not None:
+            newest_item_time = _timestamp(newest_item_time)
+        return cls(_timestamp(feed.created), newest_item_time)
+
+    def record_update(self, new_entries, now=None):
+        """Record a successful update.
+
+        :param new_entries: number of new entries we got
+        """
+        if now is None:
+            now = time.time()
+        self.error_count = 0
+        if new_entries <= 0:
+            return
+        if self.last_new_entries is not None:
+            interval = now - self.last_new_entries
+            if self.publish_interval is None:
+                self.publish_interval = interval
+            else:
+                self.publish_interval = (
+                        PUBLISH_INTERVAL_WEIGHT * interval +
+                        (1 - PUBLISH_INTERVAL_WEIGHT) * self.publish_interval)
+        self.last_new_entries = now
+
+    def record_not_modified(self, now=None):
+        """Record an update where the server told us nothing changed."""
+        self.record_update(0, now)
+
+    def record_error(self):
+        self.error_count += 1
+
+    def next_delay(self, update_freq, now=None):
+        """Calculate how long to wait before the next update.
+
+        :param update_freq: the feed's normal update frequency.  We never
+            update more often than this.
+        :returns: delay in seconds, without jitter
+        """
+        if now is None:
+            now = time.time()
+        max_delay = update_freq * MAX_INTERVAL_FACTOR
+        if self.error_count > 0:
+            return min(update_freq * (2 ** self.error_count), max_delay)
+        if self.last_new_entries is None:
+            quiet_time = now - self.first_update
+        else:
+            quiet_time = now - self.last_new_entries
+        if self.publish_interval is None:
+            interval = quiet_time
+        else:
+            interval = max(self.publish_interval, quiet_time)
+        delay = interval / POLLS_PER_PUBLISH_INTERVAL
+        return min(max(delay, update_freq), max_delay)
+
+def _timestamp(dt):
+    """Convert a local datetime to a timestamp like time.time() returns."""
+    return time.mktime(dt.timetuple())
+
+def _feed_host(feed):
+    """Get the host to use for the per-host limit, or None."""
+    try:
+        scheme, host, port, path = download_utils.parse_url(feed.get_url())
+    except StandardError:
+        return None
+    if scheme not in ('http', 'https') or not host:
+        return None
+    return host
 
 class FeedUpdateQueue(object):
     def __init__(self):
@@ -45,6 +164,33 @@ class FeedUpdateQueue(object):
         self.timeouts = {}
         self.callback_handles = {}
         self.currently_updating = set()
+        # maps feed ids to FeedUpdateHistory objects
+        self.histories = {}
+        # maps hosts to the number of feeds updating from them
+        self.host_counts = {}
+        self.feed_hosts = {}
+
+    def get_history(self, feed):
+        try:
+            return self.histories[feed.id]
+        except KeyError:
+            history = FeedUpdateHistory.for_feed(feed)
+            self.histories[feed.id] = history
+            return history
+
+    def forget_feed(self, feed):
+        """Cancel any pending update for a removed feed and drop its
+        history.
+        """
+        self.cancel_update(feed)
+        self.histories.pop(feed.id, None)
+
+    def next_update_delay(self, feed, update_freq):
+        delay = self.get_history(feed).next_delay(update_freq)
+        delay *= random.uniform(1 - JITTER, 1 + JITTER)
+        # clamp after adding the jitter, so that we never update more often
+        # than update_freq
+        return min(max(delay, update_freq), update_freq * MAX_INTERVAL_FACTOR)
 
     def schedule_update(self, delay, feed, update_callback):
         name = "Feed update (%s)" % feed.get_title()
@@ -68,21 +214,37 @@ class FeedUpdateQueue(object):
         for callback_handle in self.callback_handles.pop(feed.id):
             feed.disconnect(callback_handle)
         self.currently_updating.remove(feed)
+        host = self.feed_hosts.pop(feed.id)
+        if host is not None:
+            self.host_counts[host] -= 1
+            if self.host_counts[host] == 0:
+                del self.host_counts[host]
         # call run_update_queue in an idle to avoid re-updating the feed that
         # just finished.  That could cause weird effects since we are in the
         # update-finished callback right now.  See #16277
         eventloop.add_idle(self.run_update_queue, 'run feed update queue')
 
     def run_update_queue(self):
-        while (len(self.update_queue) > 0 and 
-               len(self.currently_updating) < MAX_UPDATES):
+        # Go through the queue once.  Feeds that we can't start because
+        # their host is too busy go back on the queue in the same order.
+        for i in xrange(len(self.update_queue)):
+            if len(self.currently_updating) >= MAX_UPDATES:
+                break
             feed, update_callback = self.update_queue.dequeue()
             if feed in self.currently_updating:
                 continue
+            host = _feed_host(feed)
+            if (host is not None and
+                    self.host_counts.get(host, 0) >= MAX_UPDATES_PER_HOST):
+                self.update_queue.enqueue((feed, update_callback))
+                continue
             handle = feed.connect('update-finished', self.update_finished)
             handle2 = feed.connect('removed', self.update_finished)
             self.callback_handles[feed.id] = (handle, handle2)
             self.currently_updating.add(feed)
+            self.feed_hosts[feed.id] = host
+            if host is not None:
+                self.host_counts[host] = self.host_counts.get(host, 0) + 1
             update_callback()
 
 global_update_queue = FeedUpdateQueue()
@@ -91,8 +253,32 @@ def cancel_update(feed):
     """Cancel any pending updates for feed."""
     global_update_queue.cancel_update(feed)
 
+def forget_feed(feed):
+    """Forget about a feed that's been removed."""
+    global_update_queue.forget_feed(feed)
+
 def schedule_update(delay, feed, update_callback):
     """Schedules a feed to be updated sometime around delay seconds in
     the future.
     """
     global_update_queue.schedule_update(delay, feed, update_callback)
+
+def next_update_delay(feed, update_freq):
+    """Get the delay until the next regular update for a feed.
+
+    This is based on the feed's update frequency and its update history,
+    plus some random jitter.
+    """
+    return global_update_queue.next_update_delay(feed, update_freq)
+
+def record_update(feed, new_entries):
+    """Record that we updated feed and got new_entries new entries."""
+    global_update_queue.get_history(feed).record_update(new_entries)
+
+def record_not_modified(feed):
+    """Record that the server told us that feed hasn't changed."""
+    global_update_queue.get_history(feed).record_not_modified()
+
+def record_error(feed):
+    """Record that there was an error updating feed."""
+    global_update_queue.get_history(feed).record_error()
@@ -1088,6 +1088,10 @@ class Application:
     def force_feedparser_processing(self):
         messages.ForceFeedparserProcessing().send_to_backend()
 
+    def event_loop_stats(self):
+        """Printout timing statistics for the backend event loop."""
+        messages.QueryEventLoopStats().send_to_backend()
+
     def _printout_memory_stats(self, title):
         # base_classes is a list of base classes that we care about.  If you
         # want to check memory usage for a different class, add it to the
@@ -1563,6 +1567,9 @@ class WidgetsMessageHandler(messages.MessageHandler):
                 globals(), locals(), self._profile_info[1])
         self._profile_info = None
 
+    def handle_event_loop_stats(self, message):
+        logging.debug('EVENT LOOP STATS:\n%s', message.report)
+
     def handle_current_search_info(self, message):
         app.search_manager.set_search_info(message.engine, message.text)
         self._saw_pre_startup_message('search-info')
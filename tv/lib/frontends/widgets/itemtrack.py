@@ -115,7 +115,10 @@ class ItemListTracker(signals.SignalEmitter):
         self.item_list = itemlist.ItemList()
         self.id = id_
         self.is_tracking = False
-        self.search_filter = SearchFilter()
+        if type_ in DATABASE_LIST_TYPES:
+            self.search_filter = SearchFilter(database_searcher)
+        else:
+            self.search_filter = SearchFilter()
         self.saw_initial_list = False
 
     def connect(self, name, func, *extra_args):
@@ -163,6 +166,9 @@ class ItemListTracker(signals.SignalEmitter):
                 self.on_item_list)
         app.info_updater.item_changed_callbacks.remove(self.type, self.id,
                 self.on_items_changed)
+        # remove our items from the search index
+        self.search_filter.reset()
+        self.saw_initial_list = False
         self.is_tracking = False
 
     def on_item_list(self, message):
@@ -245,19 +251,131 @@ class ManualItemListTracker(ItemListTracker):
     def _send_track_items_message(self):
         messages.TrackItemsManually(self.id, self.info_list).send_to_backend()
 
+class DatabaseItemSearcher(object):
+    """Searcher for SearchFilters on lists of database items.
+
+    DatabaseItemSearcher has the same interface as search.ItemSearcher, but
+    it doesn't index items itself.  Instead it uses the index of all
+    database items that the backend keeps (app.search_index), which is ready
+    right after startup.  If that index isn't ready, we fall back to checking
+    each item with search.list_matches().
+
+    All lists of database items share one DatabaseItemSearcher, so
+    add_item() and remove_item() count references.  An item stays in our
+    fallback list until every list that added it has removed it.
+
+    We run in the frontend thread, but app.search_index belongs to the
+    backend.  We only call its search() and is_ready() methods, which lock
+    the index and are safe to call from any thread.
+    """
+    def __init__(self):
+        # map item id -> number of references
+        self._refcounts = {}
+        # map item id -> latest ItemInfo
+        self._infos = {}
+
+    def __len__(self):
+        return len(self._infos)
+
+    def add_item(self, item_info):
+        """Add a reference to an item."""
+        self._refcounts[item_info.id] = self._refcounts.get(item_info.id,
+                0) + 1
+        self._infos[item_info.id] = item_info
+
+    def update_item(self, item_info):
+        """Update the ItemInfo for an item.
+
+        Raises a KeyError if the item is not referenced.
+        """
+        if item_info.id not in self._infos:
+            raise KeyError(item_info.id)
+        self._infos[item_info.id] = item_info
+
+    def remove_item(self, item_id):
+        """Release a reference to an item.
+
+        Raises a KeyError if the item is not referenced.
+        """
+        self._refcounts[item_id] -= 1
+        if self._refcounts[item_id] == 0:
+            del self._refcounts[item_id]
+            del self._infos[item_id]
+
+    def search(self, search_text, ids=None):
+        """Search through our items.
+
+        :param search_text: search_text to search with
+        :param ids: if given, only return results from this set of ids
+
+        :returns: set of ids that match the search
+        """
+        if ids is None:
+            ids = self._infos
+        if app.search_index is not None and app.search_index.is_ready():
+            return app.search_index.search(search_text, ids)
+        infos = (self._infos[id_] for id_ in ids)
+        return set(info.id for info in search.list_matches(infos,
+            search_text))
+
+    def search_ranked(self, search_text, ids=None, limit=None):
+        """Search through our items and rank the results.
+
+        See search.score_item() for how results are ranked.
+
+        :param search_text: search_text to search with
+        :param ids: if given, only return results from this set of ids
+        :param limit: if given, only return this many of the best matches
+
+        :returns: list of ids that match the search, best matches first
+        """
+        infos = [self._infos[id_] for id_ in self.search(search_text, ids)]
+        return [info.id for info in search.rank_items(infos, search_text,
+            limit)]
+
+# Item list types that contain database items.  Their SearchFilters use
+# database_searcher.
+DATABASE_LIST_TYPES = frozenset([
+    'downloading', 'videos', 'music', 'others', 'search', 'folder-contents',
+    'feed', 'playlist',
+])
+
+# Searcher shared by the SearchFilters for lists of database items.
+database_searcher = DatabaseItemSearcher()
+
 class SearchFilter(object):
     """SearchFilter filter out non-matching items from item lists
+
+    Each SearchFilter keeps track of the items in its list and adds them to
+    its searcher.  Call reset() to remove them.
+
+    Lists of database items share a DatabaseItemSearcher, which searches the
+    index that the backend keeps for all database items.  Other lists (shares,
+    devices, ...) get their own search.ItemSearcher by default, since their
+    item ids can collide with database ids and with each other.
     """
-    def __init__(self):
-        self.searcher = search.ItemSearcher()
+    def __init__(self, searcher=None):
+        if searcher is None:
+            searcher = search.ItemSearcher()
+        self.searcher = searcher
         self.query = ''
-        self.all_items = {} # maps id to item info
+        # map item id -> latest ItemInfo for the items in our list
+        self.infos = {}
         self.matching_ids = set()
         self._pending_changes = datastructures.Fifo()
         self._index_pass_scheduled = False
 
     def is_filtering(self):
-        return len(self.all_items) > len(self.matching_ids)
+        return len(self.infos) > len(self.matching_ids)
+
+    def reset(self):
+        """Remove all our items from the search index."""
+        while len(self._pending_changes) > 0:
+            self._pending_changes.dequeue()
+        for id_ in self.infos:
+            self.searcher.remove_item(id_)
+        self.infos = {}
+        self.matching_ids = set()
 
     def filter_initial_list(self, items):
         """Filter a list of incoming items.
@@ -266,15 +384,17 @@ class SearchFilter(object):
 
         :returns: list of items that match our search
         """
+        # If we get multiple initial lists, the last one replaces the
+        # others (see #16089)
+        self.reset()
         if not self.query:
             # special case, just send out the list and calculate the index
             # later
             self._pending_changes.enqueue((items, [], []))
             self._schedule_indexing()
             return items
-        self._ensure_index_ready()
         self._add_items(items)
-        self.matching_ids = self.searcher.search(self.query)
+        self.matching_ids = self._search()
         return [i for i in items if i.id in self.matching_ids]
 
     def filter_changes(self, added, changed, removed):
@@ -298,7 +418,7 @@ class SearchFilter(object):
         self._update_items(changed)
         self._remove_ids(removed)
 
-        matches = self.searcher.search(self.query)
+        matches = self._search()
         old_matches = self.matching_ids
 
         added_filtered = [i for i in added if i.id in matches]
@@ -324,43 +444,63 @@ class SearchFilter(object):
         """
         self._ensure_index_ready()
         self.query = query
-        matches = self.searcher.search(self.query)
+        matches = self._search()
         added = matches - self.matching_ids
         removed = self.matching_ids - matches
         self.matching_ids = matches
-        added_infos = [self.all_items[id_] for id_ in added]
+        added_infos = [self.infos[id_] for id_ in added]
         return added_infos, removed
 
+    def search_ranked(self, limit=None):
+        """Get the items that match our search, best matches first.
+
+        See search.score_item() for how results are ranked.
+
+        :param limit: if given, only return this many of the best matches
+
+        :returns: list of ItemInfos
+        """
+        self._ensure_index_ready()
+        infos = [self.infos[id_] for id_ in self.matching_ids]
+        return search.rank_items(infos, self.query, limit)
+
+    def _search(self):
+        return self.searcher.search(self.query, self.infos)
+
     def _add_items(self, items):
         for item in items:
-            self.all_items[item.id] = item
-            self.searcher.add_item(item)
+            if item.id in self.infos:
+                # we already have the item, just update it
+                self.searcher.update_item(item)
+            else:
+                self.searcher.add_item(item)
+            self.infos[item.id] = item
 
     def _update_items(self, items):
         for item in items:
-            self.all_items[item.id] = item
-            try:
-                self.searcher.update_item(item)
-            except KeyError:
+            if item.id not in self.infos:
                 # This happens when the item is not in the index
                 # As a precaution, try out best to recover, log the error,
                 # then just add the item.  (see #17152 for details).
                 app.widgetapp.handle_soft_failure("Item Track update",
                         "Tried to update item not in index: %s" % item.id,
-                        with_exception=True)
+                        with_exception=False)
                 self.searcher.add_item(item)
+            else:
+                self.searcher.update_item(item)
+            self.infos[item.id] = item
 
     def _remove_ids(self, id_list):
         for id_ in id_list:
-            del self.all_items[id_]
-            try:
-                self.searcher.remove_item(id_)
-            except KeyError:
+            if id_ not in self.infos:
                 # This happens when the item is not in the index.  As a
                 # precaution, try to recover.  log the error, then keep going.
                 app.widgetapp.handle_soft_failure("Item Track update",
                         "Tried to update item not in index: %s" % id_,
-                        with_exception=True)
+                        with_exception=False)
+                continue
+            del self.infos[id_]
+            self.searcher.remove_item(id_)
 
     def _ensure_index_ready(self):
         if len(self._pending_changes) > 0:
@@ -369,7 +509,7 @@ class SearchFilter(object):
                 self._add_items(added)
                 self._update_items(changed)
                 self._remove_ids(removed)
-            self.matching_ids = self.searcher.search(self.query)
+            self.matching_ids = self._search()
 
     def _schedule_indexing(self):
         if not self._index_pass_scheduled:
@@ -388,4 +528,4 @@ class SearchFilter(object):
         if len(self._pending_changes) > 0:
             self._schedule_indexing()
         else:
-            self.matching_ids = self.searcher.search(self.query)
+            self.matching_ids = self._search()
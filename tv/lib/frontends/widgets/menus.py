@@ -399,6 +399,7 @@ def get_menu():
                 MenuItem(_("Test Soft Crash Reporter"),
                     "TestSoftCrashReporter"),
                 MenuItem(_("Memory Stats"), "MemoryStats"),
+                MenuItem(_("Event Loop Stats"), "EventLoopStats"),
                 MenuItem(_("Force Feedparser Processing"),
                     "ForceFeedparserProcessing"),
                 ])
@@ -742,6 +743,10 @@ def on_test_soft_crash_reporter():
 def on_memory_stats():
     app.widgetapp.memory_stats()
 
+@action_handler("EventLoopStats")
+def on_event_loop_stats():
+    app.widgetapp.event_loop_stats()
+
 @action_handler("ForceFeedparserProcessing")
 def on_memory_stats():
     app.widgetapp.force_feedparser_processing()
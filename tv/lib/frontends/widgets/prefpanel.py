@@ -638,6 +638,44 @@ class DownloadsPanel(PanelBuilder):
 
         vbox.pack_start(grid.make_table())
 
+        grid = dialogwidgets.ControlGrid()
+        grid.pack(dialogwidgets.heading(_("HTTP downloads:")),
+                  grid.ALIGN_LEFT, span=3)
+        grid.end_line(spacing=12)
+
+        max_kbs = sys.maxint / (2**10)
+        cbx = widgetset.Checkbox(_('Limit total bandwidth to:'))
+        limit = widgetset.TextEntry()
+        limit.set_width(5)
+        limit_error = build_error_image()
+        attach_boolean(cbx, prefs.LIMIT_DOWNSTREAM_HTTP, (limit,))
+        attach_integer(limit, prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS,
+                       limit_error,
+                       create_value_checker(min_=0, max_=max_kbs))
+
+        grid.pack(cbx)
+        grid.pack(limit)
+        grid.pack_label(_("KB/s"))
+        grid.pack(limit_error)
+        grid.end_line(spacing=6)
+
+        cbx = widgetset.Checkbox(_('Limit each download to:'))
+        limit = widgetset.TextEntry()
+        limit.set_width(5)
+        limit_error = build_error_image()
+        attach_boolean(cbx, prefs.LIMIT_DOWNSTREAM_HTTP_PER_DOWNLOAD,
+                       (limit,))
+        attach_integer(limit, prefs.DOWNSTREAM_HTTP_PER_DOWNLOAD_LIMIT_IN_KBS,
+                       limit_error,
+                       create_value_checker(min_=0, max_=max_kbs))
+
+        grid.pack(cbx)
+        grid.pack(limit)
+        grid.pack_label(_("KB/s"))
+        grid.pack(limit_error)
+        grid.end_line(spacing=12)
+        vbox.pack_start(widgetutil.align_left(grid.make_table()))
+
         grid = dialogwidgets.ControlGrid()
         grid.pack(dialogwidgets.heading(_("Bittorrent:")),
                   grid.ALIGN_LEFT, span=3)
@@ -48,6 +48,7 @@ import pycurl
 from miro import app
 from miro import download_utils
 from miro import eventloop
+from miro import eventpoller
 from miro import fileutil
 from miro import httpauth
 from miro import net
@@ -56,6 +57,7 @@ from miro import signals
 from miro import util
 from miro.gtcache import gettext as _
 from miro.xhtmltools import url_encode_dict, multipart_encode
+from miro.clock import clock
 from miro.plat import utils
 from miro.plat.resources import get_osname
 from miro.net import NetworkError, ConnectionError, ConnectionTimeout
@@ -67,6 +69,18 @@ except:
 
 REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
+# Max number of idle libcurl handles that we keep around to reuse
+MAX_POOLED_HANDLES = 16
+# Max number of connections to a single host.  Transfers past this wait for
+# a connection to free up.
+MAX_HOST_CONNECTIONS = 6
+# Max number of open connections that libcurl keeps around to reuse
+MAX_CACHED_CONNECTIONS = 32
+# How often byte range transfers sync their data to disk, in seconds.  Their
+# file is preallocated, so we can't tell which bytes made it to disk by
+# looking at the file size.  The fsync() calls run in LibCURLManager's file
+# sync thread, so they don't block the libcurl thread.
+FLUSH_INTERVAL = 1.0
 
 _logged_noproxy_error = False
 
@@ -213,6 +227,13 @@ class TransferOptions(object):
         self.write_file = write_file
         self.requires_cookies = False
         self.head_request = False
+        # If skip_head_request is set, we don't send a HEAD request before
+        # downloading to write_file.  Instead we check the response headers
+        # of the GET and only write the body if the response is good.
+        self.skip_head_request = False
+        # byte_range is a (start, end) tuple.  If set, we only request those
+        # bytes and write them into write_file starting at offset start.
+        self.byte_range = None
         self.invalid_url = False
         # _cancel_on_body_data is an internal attribute used for grab_headers.
         self._cancel_on_body_data = False
@@ -237,22 +258,23 @@ class TransferOptions(object):
             self.invalid_url = True
             return
 
-    def build_handle(self, out_headers):
-        """Build a libCURL handle.  This should only be called inside the
+    def build_handle(self, out_headers, handle):
+        """Setup a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param handle: new or reset handle from CurlHandlePool
         """
         if self.etag is not None:
             out_headers['etag'] = self.etag
         if self.modified is not None:
             out_headers['If-Modified-Since'] = self.modified
 
-        handle = self._init_handle()
+        self._init_handle(handle)
         self._setup_post(handle, out_headers)
         self._setup_headers(handle, out_headers)
         return handle
 
-    def _init_handle(self):
-        handle = pycurl.Curl()
+    def _init_handle(self, handle):
         handle.setopt(pycurl.USERAGENT, user_agent())
         handle.setopt(pycurl.FOLLOWLOCATION, 1)
         handle.setopt(pycurl.MAXREDIRS, REDIRECTION_LIMIT)
@@ -272,7 +294,6 @@ class TransferOptions(object):
         if self.head_request:
             handle.setopt(pycurl.NOBODY, 1)
         self._setup_proxy(handle)
-        return handle
 
     def _setup_proxy(self, handle):
         if not app.config.get(prefs.HTTP_PROXY_ACTIVE):
@@ -344,6 +365,9 @@ class CurlTransfer(object):
         self.auth_attempts = {'http': 0, 'proxy': 0}
         self.canceled = False
         self.last_url = None
+        # receive speed limit in bytes/sec, or None for no limit
+        self.max_recv_speed = None
+        self.recv_paused = False
 
         self.stats = TransferStats()
         self._lookup_auth()
@@ -352,6 +376,7 @@ class CurlTransfer(object):
     def _reset_transfer_data(self):
         self.headers = {}
         self.handle = None
+        self.handle_reused = False
         self.current_auth_type = None
         self.buffer = StringIO()
         self.saw_temporary_redirect = False
@@ -362,6 +387,12 @@ class CurlTransfer(object):
         self.status_code = None
         self.trying_head_request = False
         self.saw_head_success = False
+        self.write_error = None
+        # bytes written to our file and bytes that we know are on disk
+        self.bytes_written = self.bytes_flushed = 0
+        self.last_flush = clock()
+        # token for the sync that's running in the file sync thread, or None
+        self.pending_sync = None
 
     def _send_new_request(self):
         self._reset_transfer_data()
@@ -384,6 +415,33 @@ class CurlTransfer(object):
         curl_manager.remove_transfer(self, remove_file)
         self.canceled = True
 
+    def set_max_recv_speed(self, max_recv_speed):
+        self.max_recv_speed = max_recv_speed
+        curl_manager.update_transfer(self)
+
+    def set_recv_paused(self, paused):
+        self.recv_paused = paused
+        curl_manager.update_transfer(self)
+
+    def apply_recv_settings(self):
+        """Apply max_recv_speed and recv_paused to our handle.  This should
+        only be called inside the LibCURLManager thread, while the handle is
+        part of a transfer.
+        """
+        self._setup_max_recv_speed()
+        if hasattr(self.handle, 'pause'):
+            if self.recv_paused:
+                self.handle.pause(pycurl.PAUSE_RECV)
+            else:
+                self.handle.pause(pycurl.PAUSE_CONT)
+
+    def _setup_max_recv_speed(self):
+        if self.max_recv_speed is not None:
+            self.handle.setopt(pycurl.MAX_RECV_SPEED_LARGE,
+                    int(self.max_recv_speed))
+        else:
+            self.handle.setopt(pycurl.MAX_RECV_SPEED_LARGE, 0)
+
     def handle_http_auth(self):
         url = self.options.url
         location = (_("Website"), url)
@@ -455,7 +513,8 @@ class CurlTransfer(object):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
         """
-        self.handle = self.options.build_handle(self.out_headers)
+        self.handle, self.handle_reused = curl_manager.handle_pool.get_handle()
+        self.options.build_handle(self.out_headers, self.handle)
         # don't authenticate SSL certificates see #15180
         self.handle.setopt(pycurl.SSL_VERIFYPEER, 0)
 
@@ -463,6 +522,15 @@ class CurlTransfer(object):
         self._setup_proxy_auth()
         if self.options._cancel_on_body_data:
             self.handle.setopt(pycurl.WRITEFUNCTION, self._write_func_abort)
+        elif (self.options.write_file is not None and
+                self.options.byte_range is not None):
+            self.handle.setopt(pycurl.RANGE,
+                    '%d-%d' % self.options.byte_range)
+            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_to_file)
+        elif (self.options.write_file is not None and
+                self.options.skip_head_request):
+            self._setup_resume()
+            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_to_file)
         elif self.options.write_file is not None:
             if not self.saw_head_success:
                 # try a HEAD request first to see if the request will work.
@@ -473,6 +541,7 @@ class CurlTransfer(object):
                 self.trying_head_request = True
             else:
                 self.handle.setopt(pycurl.URL, self.last_url)
+                self._setup_resume()
                 self._open_file()
                 self.handle.setopt(pycurl.WRITEDATA, self._filehandle)
         elif self.content_check_callback is not None:
@@ -480,6 +549,7 @@ class CurlTransfer(object):
         else:
             self.handle.setopt(pycurl.WRITEFUNCTION, self.buffer.write)
         self.handle.setopt(pycurl.HEADERFUNCTION, self.header_func)
+        self._setup_max_recv_speed()
         if self.should_debug_request():
             logging.warn("debugging request: %s", self.options.url)
             self.handle.setopt(pycurl.VERBOSE, 1)
@@ -529,24 +599,63 @@ class CurlTransfer(object):
         if rv == False or isinstance(rv, Exception):
             curl_manager.remove_transfer(self)
 
+    def _setup_resume(self):
+        if not self.options.resume:
+            return
+        try:
+            path = self.options.write_file
+            self.resume_from = int(os.stat(path)[stat.ST_SIZE])
+        except OSError:
+            # file doesn't exist, just skip resuming
+            pass
+        else:
+            self.handle.setopt(pycurl.RESUME_FROM, self.resume_from)
+
     def _open_file(self):
-        if self.options.resume:
+        if self.options.byte_range is not None:
+            mode = 'r+b'
+        elif self.options.resume:
             mode = 'ab'
-            try:
-                path = self.options.write_file
-                self.resume_from = int(os.stat(path)[stat.ST_SIZE])
-            except OSError:
-                # file doesn't exist, just skip resuming
-                pass
-            else:
-                self.handle.setopt(pycurl.RESUME_FROM, self.resume_from)
         else:
             mode = 'wb'
         try:
             self._filehandle = fileutil.open_file(self.options.write_file, mode)
+            if self.options.byte_range is not None:
+                self._filehandle.seek(self.options.byte_range[0])
         except IOError:
             raise WriteError(self.options.write_file)
 
+    def _write_to_file(self, data):
+        """WRITEFUNCTION used when we skip the HEAD request.
+
+        header_func has already parsed the status line of the response that
+        this data belongs to.  If it's not a response that we will call our
+        callback for (error pages, auth failures, etc), we throw away the
+        data, so that it never ends up in our file.
+        """
+        if self.options.byte_range is not None and self.status_code == 200:
+            # The server is ignoring our range and sending the whole file.
+            self.write_error = ResumeFailed(self.options.host)
+            return 0
+        if not self.check_response_code(self.status_code):
+            return
+        try:
+            if self._filehandle is None:
+                self._open_file()
+            self._filehandle.write(data)
+            if self.options.byte_range is not None:
+                self.bytes_written += len(data)
+                if (self.pending_sync is None and
+                        clock() - self.last_flush >= FLUSH_INTERVAL):
+                    self._start_sync()
+        except (IOError, OSError, WriteError), e:
+            if not isinstance(e, WriteError):
+                e = WriteError(self.options.write_file)
+            self.write_error = e
+            # returning a different length than we were passed makes
+            # libcurl abort the transfer with E_WRITE_ERROR
+            return 0
+
     def should_debug_request(self):
         # return True here to debug HTTP requests in the log file
         return False
@@ -623,6 +732,8 @@ class CurlTransfer(object):
                     args=(self._make_callback_info(),))
 
     def check_response_code(self, code):
+        if self.options.byte_range is not None:
+            return code == 206
         expected_codes = set([200])
         if self.options.resume:
             expected_codes.add(206)
@@ -668,13 +779,24 @@ class CurlTransfer(object):
                 info['body'] = self.buffer.getvalue()
 
         if self.check_response_code(info['status']):
-            if not self.trying_head_request:
-                self.call_callback(info)
-            else:
+            if self.trying_head_request:
                 # we tried a HEAD request and it worked, now we can do the
                 # transfer for real
                 self._send_new_request()
                 self.saw_head_success = True
+            elif (self.options.write_file is not None and
+                    self._filehandle is None and
+                    self.options.skip_head_request):
+                # We didn't get any body data, but we should still create
+                # the file like we would have after the HEAD request.
+                try:
+                    self._open_file()
+                except WriteError, e:
+                    self.call_errback(e)
+                else:
+                    self.call_callback(info)
+            else:
+                self.call_callback(info)
         elif info['status'] == 401:
             self.handle_http_auth()
         elif info['status'] in (405, 501):
@@ -740,6 +862,18 @@ class CurlTransfer(object):
                 clean=True)
 
     def on_error(self, code, handle):
+        if self.write_error is not None:
+            self.call_errback(self.write_error)
+            return
+        if (code == pycurl.E_HTTP_RANGE_ERROR and
+                self.options.skip_head_request and
+                self.status_code is not None and
+                not self.check_response_code(self.status_code)):
+            # libcurl applies RESUME_FROM to any response, so a 401 or 404
+            # page for a resumed transfer looks like a range error.  Handle
+            # the response code like we would have after a HEAD request.
+            self.on_finished()
+            return
         if code in (pycurl.E_URL_MALFORMAT, pycurl.E_UNSUPPORTED_PROTOCOL):
             error = MalformedURL(self.options.url)
         elif code == pycurl.E_COULDNT_CONNECT:
@@ -773,7 +907,22 @@ class CurlTransfer(object):
         self.call_errback(error)
 
     def call_callback(self, info):
+        if (self._filehandle is not None and
+                self.options.byte_range is not None):
+            # The callback marks our byte range as finished, so wait until
+            # the data is on disk to call it.
+            try:
+                self._start_sync(lambda: self._schedule_callback(info))
+            except (IOError, OSError), e:
+                logging.warn("Error flushing %s: %s",
+                        self.options.write_file, e)
+            else:
+                self._cleanup_filehandle()
+                return
         self._cleanup_filehandle()
+        self._schedule_callback(info)
+
+    def _schedule_callback(self, info):
         eventloop.add_idle(self.callback, 'curl transfer callback',
                 args=(info,))
 
@@ -782,6 +931,33 @@ class CurlTransfer(object):
         eventloop.add_idle(self.errback, 'curl transfer errback',
                            args=(error,))
 
+    def _start_sync(self, on_synced=None):
+        """Start syncing the data we've written to disk.
+
+        We flush our buffer here, then the file sync thread calls fsync() on
+        a copy of our file descriptor.  bytes_flushed is only updated once
+        that's done, so that the status we save for a byte range never covers
+        data that a crash could lose.
+
+        :param on_synced: function to call in the libcurl thread after the
+            sync
+        """
+        self._filehandle.flush()
+        fd = os.dup(self._filehandle.fileno())
+        self.pending_sync = token = object()
+        self.last_flush = clock()
+        curl_manager.sync_file(fd, self._on_sync_finished, token,
+                self.bytes_written, on_synced)
+
+    def _on_sync_finished(self, success, token, bytes_written, on_synced):
+        if token is self.pending_sync:
+            # only count the sync if it's for our current request
+            self.pending_sync = None
+            if success:
+                self.bytes_flushed = bytes_written
+        if on_synced is not None:
+            on_synced()
+
     def _cleanup_filehandle(self):
         if self._filehandle is not None:
             self._filehandle.close()
@@ -801,6 +977,12 @@ class CurlTransfer(object):
         stats.upload_rate = int(getinfo(pycurl.SPEED_UPLOAD))
         stats.status_code = self.status_code
         stats.initial_size = self.resume_from
+        stats.handle_reused = self.handle_reused
+        stats.flushed = self.bytes_flushed
+        if self.status_code is not None:
+            # NUM_CONNECTS is the number of new connections libcurl made for
+            # the transfer.  0 means that it reused an open connection.
+            stats.connection_reused = (getinfo(pycurl.NUM_CONNECTS) == 0)
 
         return stats
 
@@ -831,6 +1013,12 @@ class TransferStats(object):
         download_rate -- download rate in bytes/second
         upload_rate -- upload rate in bytes/second
         initial_size -- bytes that we starting downloading from
+        handle_reused -- did we reuse a libcurl handle from an earlier
+                         transfer?
+        connection_reused -- did libcurl reuse an open connection (or None
+                             if we haven't connected yet)
+        flushed -- bytes of a byte range transfer that have been flushed to
+                   disk
     """
     def __init__(self):
         self.downloaded = self.download_total = 0
@@ -838,6 +1026,78 @@ class TransferStats(object):
         self.download_rate = self.upload_rate = 0
         self.initial_size = 0
         self.status_code = None
+        self.handle_reused = False
+        self.connection_reused = None
+        self.flushed = 0
+
+def _make_curl_share():
+    """Make a CurlShare object for our handles to use.
+
+    This lets all of our handles share DNS results, cookies and SSL sessions.
+    We don't share the connection cache here, the handles that are added to
+    our multi object already share its connection cache.
+    """
+    share = pycurl.CurlShare()
+    for name in ('LOCK_DATA_DNS', 'LOCK_DATA_COOKIE', 'LOCK_DATA_SSL_SESSION'):
+        if hasattr(pycurl, name):
+            share.setopt(pycurl.SH_SHARE, getattr(pycurl, name))
+    return share
+
+class CurlHandlePool(object):
+    """Pool of libcurl handles that we can reuse for new transfers.
+
+    Reusing handles saves us from building new ones for each transfer and
+    lets libcurl keep the caches that it stores in the handle.
+
+    This should only be used inside the LibCURLManager thread.
+
+    Attributes:
+        created_count -- number of handles that we've created
+        reused_count -- number of times that we've reused a handle
+    """
+    def __init__(self, share=None, max_size=MAX_POOLED_HANDLES):
+        self.share = share
+        self.max_size = max_size
+        self.idle_handles = []
+        self.created_count = 0
+        self.reused_count = 0
+
+    def get_handle(self):
+        """Get a handle for a new transfer.
+
+        :returns: (handle, reused) tuple.  reused is True if the handle was
+            used for a previous transfer.
+        """
+        if self.idle_handles:
+            handle = self.idle_handles.pop()
+            self.reused_count += 1
+            reused = True
+        else:
+            handle = pycurl.Curl()
+            self.created_count += 1
+            reused = False
+        if self.share is not None:
+            handle.setopt(pycurl.SHARE, self.share)
+        return handle, reused
+
+    def release_handle(self, handle):
+        """Put a handle back in the pool once its transfer is done.
+
+        The handle must not be in a multi object.
+        """
+        if len(self.idle_handles) < self.max_size and hasattr(handle,
+                'reset'):
+            # reset() clears our options and callbacks, but keeps libcurl's
+            # caches.
+            handle.reset()
+            self.idle_handles.append(handle)
+        else:
+            handle.close()
+
+    def close(self):
+        for handle in self.idle_handles:
+            handle.close()
+        self.idle_handles = []
 
 class LibCURLManager(eventloop.SimpleEventLoop):
     """Manage a set of CurlTransfers.
@@ -847,6 +1107,11 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+
+    If pycurl supports it, we use libcurl's socket interface.  libcurl tells
+    us when the sockets it wants to watch change, which we pass on to our
+    poller.  Otherwise, we fall back to calling perform() and getting the
+    sockets from fdset() each time through the loop.
     """
 
     def __init__(self):
@@ -855,25 +1120,85 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
+        self.transfers_to_update = Queue.Queue()
         self.after_perform_callbacks = []
+        self.use_socket_action = hasattr(pycurl, 'M_SOCKETFUNCTION')
+        # time when libcurl wants us to call socket_action() with
+        # SOCKET_TIMEOUT, or None
+        self.socket_timeout = None
+        if self.use_socket_action:
+            self.multi.setopt(pycurl.M_SOCKETFUNCTION, self.on_socket_change)
+            self.multi.setopt(pycurl.M_TIMERFUNCTION, self.on_timer_change)
+        # these options depend on the libcurl version
+        if hasattr(pycurl, 'M_MAX_HOST_CONNECTIONS'):
+            self.multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS,
+                    MAX_HOST_CONNECTIONS)
+        if hasattr(pycurl, 'M_MAXCONNECTS'):
+            self.multi.setopt(pycurl.M_MAXCONNECTS, MAX_CACHED_CONNECTIONS)
+        self.share = _make_curl_share()
+        self.handle_pool = CurlHandlePool(self.share)
+        # number of transfers that finished and how many of them reused a
+        # connection.  See get_stats_report()
+        self.finished_count = 0
+        self.connection_reused_count = 0
+        # files for the file sync thread to sync and syncs that it finished.
+        # See sync_file()
+        self.files_to_sync = Queue.Queue()
+        self.finished_syncs = Queue.Queue()
 
     def start(self):
         self.thread = threading.Thread(target=utils.thread_body,
                                        args=[self.loop],
                                        name="LibCURL Event Loop")
         self.thread.start()
+        self.sync_thread = threading.Thread(target=utils.thread_body,
+                                            args=[self.sync_loop],
+                                            name="LibCURL File Sync")
+        self.sync_thread.start()
 
     def stop(self):
         self.quit_flag = True
         self.wakeup()
         self.thread.join()
+        self.files_to_sync.put(None)
+        self.sync_thread.join()
+
+    def sync_file(self, fd, callback, *args):
+        """Sync a file descriptor to disk, then close it.
+
+        os.fsync() can block for a long time, so we call it in the file sync
+        thread.  Afterwards, callback(success, *args) gets called in the
+        libcurl thread.
+        """
+        self.files_to_sync.put((fd, callback, args))
+
+    def sync_loop(self):
+        while True:
+            sync_info = self.files_to_sync.get()
+            if sync_info is None:
+                break
+            fd, callback, args = sync_info
+            try:
+                os.fsync(fd)
+            except OSError, e:
+                logging.warn("Error syncing file: %s", e)
+                success = False
+            else:
+                success = True
+            finally:
+                os.close(fd)
+            self.finished_syncs.put((callback, success, args))
+            self.wakeup()
 
     def loop(self):
         eventloop.SimpleEventLoop.loop(self)
         for transfer in self.transfer_map.values():
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
+        self.handle_pool.close()
         self.multi.close()
+        if hasattr(self.share, 'close'):
+            self.share.close()
 
     def add_transfer(self, transfer):
         self.transfers_to_add.put(transfer)
@@ -883,14 +1208,46 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         self.transfers_to_remove.put((transfer, remove_file))
         self.wakeup()
 
+    def update_transfer(self, transfer):
+        """Apply changes to a transfer's receive speed settings."""
+        self.transfers_to_update.put(transfer)
+        self.wakeup()
+
     def call_after_perform(self, callback):
         self.after_perform_callbacks.append(callback)
 
-    def calc_fds(self):
-        return self.multi.fdset()
+    def on_socket_change(self, what, fd, multi, socketp):
+        """Called by libcurl when the events it wants for a socket change.
+        """
+        events = 0
+        if what != pycurl.POLL_REMOVE:
+            if what & pycurl.POLL_IN:
+                events |= eventpoller.READ
+            if what & pycurl.POLL_OUT:
+                events |= eventpoller.WRITE
+        self.set_fd_events(fd, events)
+
+    def on_timer_change(self, timeout_ms):
+        """Called by libcurl when it wants a timeout."""
+        if timeout_ms < 0:
+            self.socket_timeout = None
+        else:
+            self.socket_timeout = clock() + timeout_ms / 1000.0
+
+    def update_poller(self):
+        if not self.use_socket_action:
+            readfds, writefds, excfds = self.multi.fdset()
+            self.poller.set_fds(readfds, writefds,
+                    keep_fds=[self.wake_receiver.fileno()])
 
     def calc_timeout(self):
-        timeout = self.multi.timeout()
+        if self.use_socket_action:
+            if self.socket_timeout is None:
+                timeout = -1
+            else:
+                timeout = max(0, self.socket_timeout - clock()) * 1000
+        else:
+            timeout = self.multi.timeout()
         if timeout < 0:
             # libcurl documentation says this means to wait "not too long"
             # Let's try 2 seconds
@@ -900,22 +1257,56 @@ class LibCURLManager(eventloop.SimpleEventLoop):
 
     def process_events(self, readfds, writefds, excfds):
         self.process_queues()
+        if self.use_socket_action:
+            self.process_socket_actions(readfds, writefds)
+        else:
+            while True:
+                rv, num_handles = self.multi.perform()
+                self.after_perform()
+                if rv != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+        self.process_queues()
+        self.check_finished()
+
+    def process_socket_actions(self, readfds, writefds):
+        fd_masks = dict((fd, pycurl.CSELECT_IN) for fd in readfds)
+        for fd in writefds:
+            fd_masks[fd] = fd_masks.get(fd, 0) | pycurl.CSELECT_OUT
+        for fd, mask in fd_masks.items():
+            self.socket_action(fd, mask)
+        if (self.socket_timeout is not None and
+                clock() >= self.socket_timeout):
+            self.socket_timeout = None
+            self.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+        self.after_perform()
+
+    def socket_action(self, fd, mask):
         while True:
-            rv, num_handles = self.multi.perform()
-            self.update_stats()
-            for callback in self.after_perform_callbacks:
-                trap_call('after perform callback', callback)
-            self.after_perform_callbacks = []
+            rv, num_handles = self.multi.socket_action(fd, mask)
             if rv != pycurl.E_CALL_MULTI_PERFORM:
                 break
-        self.process_queues()
-        self.check_finished()
+
+    def after_perform(self):
+        self.update_stats()
+        for callback in self.after_perform_callbacks:
+            trap_call('after perform callback', callback)
+        self.after_perform_callbacks = []
 
     def update_stats(self):
         for transfer in self.transfer_map.values():
             transfer.update_stats()
 
     def process_queues(self):
+        while True:
+            try:
+                callback, success, args = self.finished_syncs.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                callback(success, *args)
+            except StandardError:
+                logging.stacktrace("Error handling finished file sync")
+
         while True:
             try:
                 transfer = self.transfers_to_add.get_nowait()
@@ -924,10 +1315,17 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             try:
                 transfer.build_handle()
             except NetworkError, e:
+                if transfer.handle is not None:
+                    self.release_handle(transfer, transfer.handle)
                 transfer.call_errback(e)
                 continue
             self.transfer_map[transfer.handle] = transfer
             self.multi.add_handle(transfer.handle)
+            if transfer.recv_paused:
+                # The transfer was paused, then sent a new request (auth
+                # retry, GET after a HEAD request, etc).  Keep the new handle
+                # paused too.
+                transfer.apply_recv_settings()
 
         while True:
             try:
@@ -935,30 +1333,82 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             except Queue.Empty:
                 break
             transfer.on_cancel(remove_file)
+            handle = transfer.handle
             try:
-                del self.transfer_map[transfer.handle]
+                del self.transfer_map[handle]
             except KeyError:
                 continue
-            self.multi.remove_handle(transfer.handle)
+            self.multi.remove_handle(handle)
+            self.release_handle(transfer, handle)
+
+        while True:
+            try:
+                transfer = self.transfers_to_update.get_nowait()
+            except Queue.Empty:
+                break
+            # Only touch the handle if it's still part of the transfer.
+            # New handles get the speed limit in build_handle() and the
+            # paused state when they're added above.
+            if self.transfer_map.get(transfer.handle) is transfer:
+                transfer.apply_recv_settings()
 
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
+            transfer = None
             try:
-                self.pop_transfer(handle).on_finished()
+                transfer = self.pop_transfer(handle)
+                transfer.on_finished()
             except StandardError:
                 logging.stacktrace("Error calling on_finished()")
+            finally:
+                # only give the handle back if it was ours to give
+                if transfer is not None:
+                    self.release_handle(transfer, handle)
         for handle, code, message in errors:
+            transfer = None
             try:
-                self.pop_transfer(handle).on_error(code, handle)
+                transfer = self.pop_transfer(handle)
+                transfer.on_error(code, handle)
             except StandardError:
                 logging.stacktrace("Error calling on_error()")
+            finally:
+                if transfer is not None:
+                    self.release_handle(transfer, handle)
 
     def pop_transfer(self, handle):
         transfer = self.transfer_map.pop(handle)
         self.multi.remove_handle(handle)
+        # get the final stats before we give up the handle.  Stats are only
+        # informational, so don't let a problem here keep the transfer from
+        # finishing.
+        try:
+            transfer.update_stats()
+        except StandardError:
+            logging.stacktrace("Error getting transfer stats")
+        else:
+            self.finished_count += 1
+            if transfer.stats.connection_reused:
+                self.connection_reused_count += 1
         return transfer
 
+    def release_handle(self, transfer, handle):
+        """Put a handle that transfer is done with back in our pool."""
+        if transfer.handle is handle:
+            # If transfer sent a new request, it already has a new handle.
+            # Otherwise make sure that it doesn't touch the handle once
+            # another transfer is using it.
+            transfer.handle = None
+        self.handle_pool.release_handle(handle)
+
+    def get_stats_report(self):
+        """Get a text report of our handle and connection reuse."""
+        pool = self.handle_pool
+        return ('handles: created=%d reused=%d\n'
+                'connections: transfers=%d reused=%d' % (
+                    pool.created_count, pool.reused_count,
+                    self.finished_count, self.connection_reused_count))
+
 class HTTPClient(object):
     """HTTP client for a grab_url call.
 
@@ -972,6 +1422,17 @@ class HTTPClient(object):
     def cancel(self, remove_file=False):
         self.transfer.cancel(remove_file)
 
+    def set_max_recv_speed(self, max_recv_speed):
+        """Limit how fast we receive data.
+
+        :param max_recv_speed: limit in bytes/sec, or None for no limit
+        """
+        self.transfer.set_max_recv_speed(max_recv_speed)
+
+    def set_recv_paused(self, paused):
+        """Pause/unpause receiving data, without canceling the transfer."""
+        self.transfer.set_recv_paused(paused)
+
     def get_stats(self):
         """Get the current download/upload stats
 
@@ -991,7 +1452,7 @@ def sanitize_url(url):
 def grab_url(url, callback, errback, header_callback=None,
         content_check_callback=None, write_file=None, etag=None, modified=None,
         default_mime_type=None, resume=False, post_vars=None,
-        post_files=None):
+        post_files=None, skip_head_request=False, byte_range=None):
     """Quick way to download a network resource
 
     grab_url is a simple interface to the HTTPClient class.
@@ -1012,6 +1473,12 @@ def grab_url(url, callback, errback, header_callback=None,
     :param post_vars: dictionary of variables to send as POST data
     :param post_files: files to send as POST data (see
         xhtmltools.multipart_encode for the format)
+    :param skip_head_request: if True and write_file is set, don't send a
+        HEAD request to check the URL before downloading.  The body of the
+        GET is only written to write_file if the response status is good.
+    :param byte_range: (start, end) tuple of the bytes to download.  The end
+        is inclusive.  If set, write_file must already exist and the data is
+        written into it starting at offset start.
 
     The callback will be passed a dictionary that contains all the HTTP
     headers, as well as the following keys:
@@ -1036,6 +1503,8 @@ def grab_url(url, callback, errback, header_callback=None,
     else:
         options = TransferOptions(url, etag, modified, resume, post_vars,
                 post_files, write_file)
+        options.skip_head_request = skip_head_request
+        options.byte_range = byte_range
         transfer = CurlTransfer(options, callback, errback, header_callback,
                 content_check_callback)
         transfer.start()
@@ -1085,6 +1554,12 @@ def grab_headers(url, callback, errback):
     transfer.start()
     return HTTPClient(transfer)
 
+def get_stats_report():
+    """Get a text report of libcurl handle and connection reuse."""
+    if curl_manager is None:
+        return ''
+    return curl_manager.get_stats_report()
+
 def init_libcurl():
     pycurl.global_init(pycurl.GLOBAL_ALL)
 
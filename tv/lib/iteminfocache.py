@@ -42,24 +42,166 @@ Miro is running and between runs.  This results in 2 speedups:
     need to build IconCache objects and Feed objects in order to create
     ItemInfos).
 
-The general strategy is to just dumbly pickle the data and if we notice any
-errors, or if the DB version changes, throw away the cache and rebuild.  We
-use a lot of direct SQL queries in this code, borrowing app.db's cursor.  This
-is slightly naughty, but results in fast peformance.
+The general strategy is to store the data in a simple record format (see
+encode_record()).  If the DB version changes, we throw away the cache and
+rebuild it.  If we notice errors in individual rows, we just rebuild those.
+We use a lot of direct SQL queries in this code, borrowing app.db's cursor.
+This is slightly naughty, but results in fast peformance.
 """
 
 import cPickle
 import itertools
 import logging
+import struct
+import zlib
 
 from miro import app
-from miro import dbupgradeprogress
+from miro import database
 from miro import eventloop
 from miro import itemsource
+from miro import messages
 from miro import models
 from miro import schema
 from miro import signals
 
+# Record format for the item_info_cache table.
+#
+# Each row stores a header (format version and flags) followed by a pickled
+# tuple: (values, extra, children).  values contains the ItemInfo attributes
+# listed in RECORD_FIELDS, in that order.  This avoids storing the class
+# reference and attribute names for every row.  extra is a dict that holds
+# any other attributes.  children contains records for the ItemInfo's
+# children.
+#
+# If an ItemInfo is missing one of the RECORD_FIELDS, values is empty and
+# everything gets stored in extra.
+#
+# Bump RECORD_FORMAT whenever the format or RECORD_FIELDS changes.
+RECORD_FORMAT = 1
+RECORD_HEADER = struct.Struct("!BB")
+# flags for the record header
+RECORD_COMPRESSED = 1 << 0
+# records larger than this many bytes are zlib compressed.  Typical records
+# are 0.5-1.5KB and decompressing one takes 2-3 times as long as unpickling
+# it, so we only compress records with unusually long values (mostly
+# descriptions), where the space savings are worth it.
+COMPRESS_THRESHOLD = 4096
+
+RECORD_FIELDS = (
+    'id', 'name', 'title_tag', 'description', 'feed_id', 'feed_name',
+    'feed_url', 'state', 'release_date', 'size', 'duration', 'resume_time',
+    'permalink', 'commentslink', 'payment_link', 'has_shareable_url',
+    'can_be_saved', 'pending_manual_dl', 'pending_auto_dl', 'item_viewed',
+    'downloaded', 'is_external', 'video_watched', 'video_path', 'thumbnail',
+    'thumbnail_url', 'file_format', 'license', 'file_url',
+    'is_container_item', 'is_file_item', 'is_playable', 'file_type',
+    'subtitle_encoding', 'media_type_checked', 'seeding_status', 'mime_type',
+    'date_added', 'last_played', 'last_watched', 'downloaded_time',
+    'expiration_date', 'download_info', 'leechers', 'seeders', 'up_rate',
+    'down_rate', 'up_total', 'down_total', 'up_down_ratio', 'remote',
+    'device', 'source_type', 'play_count', 'skip_count', 'auto_rating',
+    'is_playing', 'album', 'album_artist', 'artist', 'track', 'album_tracks',
+    'year', 'genre', 'rating', 'cover_art', 'has_drm', 'show', 'episode_id',
+    'episode_number', 'season_number', 'kind', 'metadata_version',
+    'mdp_state',
+)
+
+# Attributes that often have the same value for many items.  When decoding,
+# we share a single string object between all of them to save memory.
+INTERNED_FIELDS = frozenset([
+    'feed_name', 'feed_url', 'state', 'thumbnail', 'file_format', 'license',
+    'file_type', 'subtitle_encoding', 'seeding_status', 'mime_type',
+    'source_type', 'album', 'album_artist', 'artist', 'genre', 'show',
+    'kind',
+])
+
+class RecordError(ValueError):
+    """Raised when we can't decode an item_info_cache record."""
+    pass
+
+def _info_to_record(info):
+    extra = info.__getstate__()
+    children = [_info_to_record(child)
+            for child in extra.pop('children', [])]
+    try:
+        values = tuple([extra.pop(name) for name in RECORD_FIELDS])
+    except KeyError:
+        # missing a field, just store everything in extra.
+        extra = info.__getstate__()
+        extra.pop('children', None)
+        values = ()
+    return (values, extra, children)
+
+def encode_record(info):
+    """Convert an ItemInfo into a record to store in the database."""
+    data = cPickle.dumps(_info_to_record(info), cPickle.HIGHEST_PROTOCOL)
+    flags = 0
+    if len(data) > COMPRESS_THRESHOLD:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            data = compressed
+            flags |= RECORD_COMPRESSED
+    return RECORD_HEADER.pack(RECORD_FORMAT, flags) + data
+
+class RecordDecoder(object):
+    """Converts records from the item_info_cache table into ItemInfos.
+
+    Strings in INTERNED_FIELDS are shared between all ItemInfos created by a
+    RecordDecoder, so it's best to use a single one for a whole load.
+    """
+    def __init__(self):
+        self.interned = {}
+
+    def decode(self, blob):
+        """Convert a record into an ItemInfo.
+
+        :raises RecordError: record is corrupt or uses a different format
+        """
+        data = str(blob)
+        if len(data) < RECORD_HEADER.size:
+            raise RecordError("record too short")
+        format_version, flags = RECORD_HEADER.unpack(
+                data[:RECORD_HEADER.size])
+        if format_version != RECORD_FORMAT:
+            raise RecordError("unknown record format: %s" % format_version)
+        data = data[RECORD_HEADER.size:]
+        try:
+            if flags & RECORD_COMPRESSED:
+                data = zlib.decompress(data)
+            return self._record_to_info(cPickle.loads(data))
+        except (zlib.error, cPickle.UnpicklingError, EOFError, ValueError,
+                TypeError, IndexError, KeyError, AttributeError,
+                ImportError), e:
+            raise RecordError("corrupt record: %s" % e)
+
+    def decode_rows(self, rows):
+        """Decode rows from the item_info_cache table.
+
+        :param rows: iterable of (id, record) tuples, for example a cursor
+        :returns: generator that yields (id, ItemInfo) tuples
+        """
+        for id_, blob in rows:
+            yield id_, self.decode(blob)
+
+    def _record_to_info(self, record):
+        values, extra, children = record
+        if values:
+            if len(values) != len(RECORD_FIELDS):
+                raise RecordError("wrong number of fields")
+            d = dict(itertools.izip(RECORD_FIELDS, values))
+            d.update(extra)
+        else:
+            d = extra
+        interned = self.interned
+        for name in INTERNED_FIELDS:
+            value = d.get(name)
+            if isinstance(value, basestring):
+                d[name] = interned.setdefault(value, value)
+        d['children'] = [self._record_to_info(child) for child in children]
+        info = messages.ItemInfo.__new__(messages.ItemInfo)
+        info.__setstate__(d)
+        return info
+
 class ItemInfoCache(signals.SignalEmitter):
     """ItemInfoCache stores the latest ItemInfo objects for each item
 
@@ -68,6 +210,12 @@ class ItemInfoCache(signals.SignalEmitter):
     costly.  This object allows us to shortcut both of those steps.  The main
     use of this is quickly handling the TrackItems message.
 
+    ItemInfos are loaded progressively.  load() just figures out which items
+    we need infos for.  After that, we load the infos that get requested
+    right away and load the rest in chunks from idle callbacks.  If a row in
+    the item_info_cache table is missing or can't be decoded, we rebuild the
+    ItemInfo for that item from the Item object.
+
     ItemInfoCache also provides signals to track when ItemInfos get
     added/change/removed from the system
 
@@ -79,6 +227,8 @@ class ItemInfoCache(signals.SignalEmitter):
 
     # how often should we save cache data to the DB? (in seconds)
     SAVE_INTERVAL = 30
+    # how many infos should we load in each idle callback?
+    LOAD_CHUNK_SIZE = 250
     VERSION_KEY = 'item_info_cache_db_version'
 
     def __init__(self):
@@ -94,33 +244,37 @@ class ItemInfoCache(signals.SignalEmitter):
         # inside this method, we're at least ready to shutdown cleanly
         # (see #17729)
         self._reset_changes()
-        did_failsafe_load = False
-        try:
-            self._quick_load()
-        except (StandardError, cPickle.UnpicklingError), e:
-            logging.warn("Error loading item info cache: %s", e)
-        if self.id_to_info is None:
-            self._failsafe_load()
-            # the current data is suspect, delete it
-            app.db.cursor.execute("DELETE FROM item_info_cache")
-            did_failsafe_load = True
-        app.db.set_variable(self.VERSION_KEY, self.version())
         self._save_dc = None
-        if did_failsafe_load:
-            # Need to save the cache data we just created
-            self._infos_added = self.id_to_info.copy()
-            self.schedule_save_to_db()
+        self._load_dc = None
+        self.id_to_info = {}
+        app.db.cursor.execute("SELECT id FROM item")
+        self._unloaded_ids = set(row[0] for row in app.db.cursor)
+        # ids that we couldn't load or rebuild.  We try to rebuild them again
+        # when they're needed.
+        self._failed_ids = set()
+        saved_db_version = app.db.get_variable(self.VERSION_KEY)
+        if saved_db_version == self.version():
+            self._rows_valid = True
+            # throw away rows for items that don't exist anymore
+            app.db.cursor.execute("DELETE FROM item_info_cache "
+                    "WHERE id NOT IN (SELECT id FROM item)")
+        else:
+            # all the data is suspect, delete it
+            self._rows_valid = False
+            app.db.cursor.execute("DELETE FROM item_info_cache")
+            app.db.set_variable(self.VERSION_KEY, self.version())
         self.loaded = True
+        self._schedule_load_chunk()
 
     def version(self):
-        return "%s-%s" % (schema.VERSION,
-                          itemsource.DatabaseItemSource.VERSION)
+        return "%s-%s-%s" % (schema.VERSION,
+                             itemsource.DatabaseItemSource.VERSION,
+                             RECORD_FORMAT)
 
     def _info_to_blob(self, info):
-        return buffer(cPickle.dumps(info))
+        return buffer(encode_record(info))
 
-    def _blob_to_info(self, blob):
-        info = cPickle.loads(str(blob))
+    def _reset_download_stats(self, info):
         # Download stats are no longer valid, reset them
         info.leechers = None
         info.seeders = None
@@ -129,41 +283,108 @@ class ItemInfoCache(signals.SignalEmitter):
         if info.download_info is not None:
             info.download_info.rate = 0
             info.download_info.eta = 0
-        return info
 
-    def _quick_load(self):
-        """Load ItemInfos using the item_info_cache table
+    def is_fully_loaded(self):
+        return not self._unloaded_ids
 
-        This is much faster than _failsafe_load(), but could result in errors.
-        """
-        saved_db_version = app.db.get_variable(self.VERSION_KEY)
-        if saved_db_version == self.version():
-            quick_load_values = {}
-            app.db.cursor.execute("SELECT id, pickle FROM item_info_cache")
-            for row in app.db.cursor:
-                quick_load_values[row[0]] = self._blob_to_info(row[1])
-            # double check that we have the right number of rows
-            if len(quick_load_values) == self._db_item_count():
-                self.id_to_info = quick_load_values
-
-    def _db_item_count(self):
-        app.db.cursor.execute("SELECT COUNT(*) from item")
-        return app.db.cursor.fetchone()[0]
-
-    def _failsafe_load(self):
-        """Load ItemInfos using Item objects.
-
-        This is much slower than _quick_load(), but more robust.
+    def _schedule_load_chunk(self):
+        if self._load_dc is None and self._unloaded_ids:
+            self._load_dc = eventloop.add_idle(self._load_chunk,
+                    'load item info cache')
+
+    def _load_chunk(self):
+        self._load_dc = None
+        if app.item_info_cache is not self:
+            # we've been replaced by a new ItemInfoCache, stop loading
+            return
+        chunk = list(itertools.islice(self._unloaded_ids,
+            self.LOAD_CHUNK_SIZE))
+        self._load_or_rebuild_infos(chunk)
+        self._schedule_load_chunk()
+
+    def _load_or_rebuild_infos(self, id_list):
+        """Load ItemInfos like _load_infos(), but handle errors.
+
+        If _load_infos() fails, we rebuild the infos one at a time.  Any ids
+        that we still can't rebuild get moved to _failed_ids so that we don't
+        keep failing on them.
         """
+        try:
+            self._load_infos(id_list)
+        except StandardError:
+            logging.warn("Error loading item infos, rebuilding them one at "
+                    "a time", exc_info=True)
+            for id_ in id_list:
+                if id_ in self._unloaded_ids:
+                    self._rebuild_failed_info(id_)
+
+    def _rebuild_failed_info(self, id_):
+        """Try to rebuild an ItemInfo that we couldn't load."""
+        self._failed_ids.discard(id_)
+        self._unloaded_ids.add(id_)
+        try:
+            self._rebuild_infos([id_])
+        except StandardError:
+            logging.warn("Error rebuilding item info for %s", id_,
+                    exc_info=True)
+            self._unloaded_ids.discard(id_)
+            self._failed_ids.add(id_)
 
-        self.id_to_info = {}
+    def _load_infos(self, id_list):
+        """Make sure ItemInfos for a list of item ids are loaded.
 
-        count = itertools.count(1)
-        total_count = self._db_item_count()
-        for item in models.Item.make_view():
+        We first try the item_info_cache table, then build the ItemInfo from
+        the Item for any rows that are missing or corrupt.
+        """
+        id_list = [id_ for id_ in id_list if id_ in self._unloaded_ids]
+        if not id_list:
+            return
+        if self._rows_valid:
+            self._load_rows(id_list)
+        missing = [id_ for id_ in id_list if id_ in self._unloaded_ids]
+        if missing:
+            self._rebuild_infos(missing)
+
+    def _load_rows(self, id_list):
+        decoder = RecordDecoder()
+        for start in xrange(0, len(id_list), self.LOAD_CHUNK_SIZE):
+            chunk = id_list[start:start+self.LOAD_CHUNK_SIZE]
+            app.db.cursor.execute("SELECT id, pickle FROM item_info_cache "
+                    "WHERE id IN (%s)" % ', '.join(str(id_) for id_ in chunk))
+            for id_, blob in app.db.cursor.fetchall():
+                try:
+                    info = decoder.decode(blob)
+                except RecordError, e:
+                    logging.warn("Error loading item info for %s: %s", id_,
+                            e)
+                    continue
+                self._reset_download_stats(info)
+                self.id_to_info[id_] = info
+                self._unloaded_ids.discard(id_)
+
+    def _rebuild_infos(self, id_list):
+        """Build ItemInfos from Item objects and save them to the DB.
+
+        This is much slower than loading the infos from the item_info_cache
+        table, but more robust.
+        """
+        # We need the lazy fields for every item, so load them all at once
+        # rather than one item at a time.
+        app.db.ensure_objects_loaded(models.Item, id_list, load_lazy=True)
+        for id_ in id_list:
+            if id_ not in self._unloaded_ids:
+                # loading the item called signal_change() or remove()
+                continue
+            try:
+                item = models.Item.get_by_id(id_)
+            except database.ObjectNotFoundError:
+                self._unloaded_ids.discard(id_)
+                continue
             info = itemsource.DatabaseItemSource._item_info_for(item)
-            self.id_to_info[info.id] = info
-            dbupgradeprogress.infocache_progress(count.next(), total_count)
+            self.id_to_info[id_] = info
+            self._unloaded_ids.discard(id_)
+            self._infos_changed[id_] = info
+        self.schedule_save_to_db()
 
     def schedule_save_to_db(self):
         if self._save_dc is None:
@@ -176,16 +397,10 @@ class ItemInfoCache(signals.SignalEmitter):
         self._infos_deleted = set()
 
     def save(self):
-        app.db.cursor.execute("BEGIN TRANSACTION")
-        try:
+        with app.db.raw_transaction():
             self._run_inserts()
             self._run_updates()
             self._run_deletes()
-        except StandardError:
-            app.db.cursor.execute("ROLLBACK TRANSACTION")
-            raise
-        else:
-            app.db.cursor.execute("COMMIT TRANSACTION")
         self._reset_changes()
 
     def _run_inserts(self):
@@ -199,8 +414,11 @@ class ItemInfoCache(signals.SignalEmitter):
     def _run_updates(self):
         if not self._infos_changed:
             return
-        sql = "UPDATE item_info_cache SET PICKLE=? WHERE id=?"
-        values = ((self._info_to_blob(info), id) for (id, info) in
+        # We don't always know if the row exists (for example when
+        # repairing a missing row), so use INSERT OR REPLACE.
+        sql = "INSERT OR REPLACE INTO item_info_cache (id, pickle) " \
+                "VALUES (?, ?)"
+        values = ((id, self._info_to_blob(info)) for (id, info) in
                 self._infos_changed.iteritems())
         app.db.cursor.executemany(sql, values)
 
@@ -216,37 +434,66 @@ class ItemInfoCache(signals.SignalEmitter):
 
         This method is optimized to avoid constructing Item objects.
         """
+        self._load_or_rebuild_infos(list(self._unloaded_ids))
+        for id_ in list(self._failed_ids):
+            self._rebuild_failed_info(id_)
         return self.id_to_info.values()
 
+    def get_infos(self, id_list):
+        """Get the ItemInfos for a list of item ids.
+
+        This is faster than calling get_info() for each id, since we can load
+        any infos that aren't loaded yet in one go.
+        """
+        self._load_infos(id_list)
+        return [self.get_info(id_) for id_ in id_list]
+
     def get_info(self, id_):
         """Get the ItemInfo for a given item id"""
         try:
             return self.id_to_info[id_]
         except KeyError:
-            app.controller.failed_soft("getting item info",
-                    "KeyError: %d" % id_, with_exception=True)
-            item = models.Item.get_by_id(id_)
-            info = itemsource.DatabaseItemSource._item_info_for(item)
-            self.id_to_info[id_] = info
-            return info
+            pass
+        if id_ in self._unloaded_ids or id_ in self._failed_ids:
+            if id_ in self._unloaded_ids:
+                self._load_infos([id_])
+            else:
+                self._rebuild_failed_info(id_)
+            try:
+                return self.id_to_info[id_]
+            except KeyError:
+                pass
+        app.controller.failed_soft("getting item info",
+                "KeyError: %d" % id_, with_exception=True)
+        item = models.Item.get_by_id(id_)
+        info = itemsource.DatabaseItemSource._item_info_for(item)
+        self.id_to_info[id_] = info
+        return info
 
     def item_created(self, item):
         info = itemsource.DatabaseItemSource._item_info_for(item)
         self.id_to_info[item.id] = info
         if not self.loaded:
-            # bail out here if the item was created while we were doing a
-            # failsafe load
+            # bail out here if the item was created before we loaded
             return
+        self._unloaded_ids.discard(item.id)
+        self._failed_ids.discard(item.id)
         self._infos_added[item.id] = info
         self.schedule_save_to_db()
         self.emit("added", info)
 
     def item_changed(self, item):
         if not self.loaded:
-            # signal_change() called in Item.setup_restored(), while we were
-            # doing a failsafe load
+            # signal_change() called before we loaded
             return
-        if item.id not in self.id_to_info:
+        if item.id in self._unloaded_ids or item.id in self._failed_ids:
+            # signal_change() called for an item whose info we haven't
+            # loaded.  Since the item is changing, there's no need to load
+            # the old info, just calculate the new one.  This also repairs
+            # infos that we failed to load.
+            self._unloaded_ids.discard(item.id)
+            self._failed_ids.discard(item.id)
+        elif item.id not in self.id_to_info:
             # signal_change() called inside setup_new(), just ignor it
             return
         info = itemsource.DatabaseItemSource._item_info_for(item)
@@ -261,17 +508,35 @@ class ItemInfoCache(signals.SignalEmitter):
 
     def item_removed(self, item):
         if not self.loaded:
-            # Item.remove() called in Item.setup_restored() while we were
-            # doing a failsafe load
-            del self.id_to_info[item.id]
+            # Item.remove() called before we loaded
+            self.id_to_info.pop(item.id, None)
             return
+        if item.id in self._unloaded_ids or item.id in self._failed_ids:
+            # We never loaded the info for the item.  The item's row is
+            # already gone, but DDBObject.remove() loaded its lazy fields
+            # first, so we can build the info from the item.
+            self._unloaded_ids.discard(item.id)
+            self._failed_ids.discard(item.id)
+            try:
+                self.id_to_info[item.id] = \
+                        itemsource.DatabaseItemSource._item_info_for(item)
+            except StandardError:
+                # We can't emit the removed signal without an info, but we
+                # can still delete the cache row.
+                logging.warn("Error building item info for removed item %s",
+                        item.id, exc_info=True)
+                self._infos_changed.pop(item.id, None)
+                self._infos_deleted.add(item.id)
+                self.schedule_save_to_db()
+                return
         try:
             info = self.id_to_info.pop(item.id)
         except KeyError:
-            # We are upgrading from a version without an info cache, and an
-            # item was expired, but it didn't exist in the cache before.
-            logging.info('Item %s removed but no corresponding info exists',
-                          item.id)
+            # We are upgrading from a version without an info cache, and
+            # an item was expired, but it didn't exist in the cache
+            # before.
+            logging.info('Item %s removed but no corresponding info '
+                    'exists', item.id)
             return
 
         if item.id in self._infos_added:
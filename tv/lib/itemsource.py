@@ -140,7 +140,7 @@ class DatabaseItemSource(ItemSource):
     # bump this whenever you change the ItemInfo class, or change one of the
     # functions that ItemInfo uses to get it's attributes (for example
     # Item.get_description()).
-    VERSION = 34
+    VERSION = 35
 
     def __init__(self, view):
         ItemSource.__init__(self)
@@ -242,7 +242,7 @@ class DatabaseItemSource(ItemSource):
         return messages.ItemInfo(item.id, **info)
 
     def fetch_all(self):
-        return [self._get_info(id_) for id_ in self.view]
+        return app.item_info_cache.get_infos(list(self.view))
 
     def _get_info(self, id_):
         return app.item_info_cache.get_info(id_)
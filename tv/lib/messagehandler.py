@@ -44,6 +44,7 @@ from miro import downloader
 from miro import eventloop
 from miro import feed
 from miro import guide
+from miro import httpclient
 from miro import fileutil
 from miro import commandline
 from miro import item
@@ -55,6 +56,7 @@ from miro import singleclick
 from miro import subscription
 from miro import tabs
 from miro import opml
+from miro import workerprocess
 from miro.widgetstate import DisplayState, ViewState, GlobalState
 from miro.feed import Feed, lookup_feed
 from miro.gtcache import gettext as _
@@ -795,6 +797,16 @@ class BackendMessageHandler(messages.MessageHandler):
         messages.CurrentSearchInfo(search_feed.engine,
                 search_feed.query).send_to_frontend()
 
+    def handle_query_event_loop_stats(self, message):
+        report = eventloop.get_stats_report()
+        worker_report = workerprocess.get_stats_report()
+        if worker_report:
+            report += '\n\nWorker process tasks:\n' + worker_report
+        http_report = httpclient.get_stats_report()
+        if http_report:
+            report += '\n\nHTTP client:\n' + http_report
+        messages.EventLoopStats(report).send_to_frontend()
+
     def handle_track_channels(self, message):
         if not self.channel_tracker:
             self.channel_tracker = ChannelTracker()
@@ -899,6 +899,11 @@ class ForceFeedparserProcessing(BackendMessage):
     """
     pass
 
+class QueryEventLoopStats(BackendMessage):
+    """Ask the backend to send an EventLoopStats message.
+    """
+    pass
+
 # Frontend Messages
 
 class JettisonTabs(FrontendMessage):
@@ -1094,6 +1099,33 @@ class GuideInfo(object):
     def __repr__(self):
         return '<miro.messages.GuideInfo(%i) "%s">' % (self.id, self.name)
 
+class _derived_attribute(object):
+    """Descriptor for an ItemInfo attribute calculated from other attributes.
+
+    The value is calculated the first time it's accessed, then stored in the
+    ItemInfo's _derived dict.  Setting the attribute overrides the calculated
+    value.
+    """
+    def __init__(self, calc_func):
+        self.calc_func = calc_func
+        self.name = calc_func.__name__
+        self.__doc__ = calc_func.__doc__
+
+    def __get__(self, info, owner):
+        if info is None:
+            return self
+        try:
+            return info._derived[self.name]
+        except KeyError:
+            value = info._derived[self.name] = self.calc_func(info)
+            return value
+
+    def __set__(self, info, value):
+        info._derived[self.name] = value
+
+    def __delete__(self, info):
+        info._derived.pop(self.name, None)
+
 class ItemInfo(object):
     """Tracks the state of an item
 
@@ -1169,76 +1201,143 @@ class ItemInfo(object):
 
     html_stripper = util.HTMLStripper()
 
+    # Attributes that we calculate from other attributes are stored in
+    # _derived rather than __dict__.  This keeps them out of the pickled data
+    # and out of the __dict__ comparisons that the trackers use to detect
+    # changes.
+    __slots__ = ('__dict__', '__weakref__', '_derived')
+
+    def __new__(cls, *args, **kwargs):
+        self = object.__new__(cls)
+        self._derived = {}
+        return self
+
     def __repr__(self):
         return "<ItemInfo %r>" % self.id
 
     def __getstate__(self):
         d = self.__dict__.copy()
         d['device'] = None
-        del d['description_stripped']
-        del d['search_terms']
         return d
 
     def __setstate__(self, d):
+        # protocol 0 pickles don't call __new__()
+        self._derived = {}
         self.__dict__.update(d)
-        self.description_stripped = ItemInfo.html_stripper.strip(
-                self.description)
-        self.search_terms = search.calc_search_terms(self)
 
     def __init__(self, id_, **kwargs):
         self.id = id_
+        # allow callers to pass in pre-calculated derived values
+        for name in ItemInfo.derived_attributes:
+            if name in kwargs:
+                self._derived[name] = kwargs.pop(name)
 
         self.__dict__.update(kwargs) # we're just a thin wrapper around some
                                      # data
 
-        # stuff we can calculate from other attributes
-        if not hasattr(self, 'description_stripped'):
-            self.description_stripped = ItemInfo.html_stripper.strip(
-                self.description)
-        if not hasattr(self, 'search_terms'):
-            self.search_terms = search.calc_search_terms(self)
-        self.name_sort_key = util.name_sort_key(self.name)
-        self.album_sort_key = util.name_sort_key(self.album)
-        self.artist_sort_key = util.name_sort_key(self.artist)
+    # stuff we can calculate from other attributes.  These get calculated
+    # the first time they're accessed.
+
+    @_derived_attribute
+    def description_stripped(self):
+        return ItemInfo.html_stripper.strip(self.description)
+
+    @_derived_attribute
+    def search_terms(self):
+        return search.calc_search_terms(self)
+
+    @_derived_attribute
+    def name_sort_key(self):
+        return util.name_sort_key(self.name)
+
+    @_derived_attribute
+    def album_sort_key(self):
+        return util.name_sort_key(self.album)
+
+    @_derived_attribute
+    def artist_sort_key(self):
+        return util.name_sort_key(self.artist)
+
+    @_derived_attribute
+    def album_artist_sort_key(self):
         if self.album_artist:
-            self.album_artist_sort_key = util.name_sort_key(self.album_artist)
+            return util.name_sort_key(self.album_artist)
         else:
-            self.album_artist_sort_key = self.artist_sort_key
-        # pre-calculate things that get displayed in list view
-        self.description_oneline = (
-                self.description_stripped[0].replace('\n', '$'))
-        self.display_date = displaytext.date_slashes(self.release_date)
-        self.display_duration = displaytext.duration(self.duration)
-        self.display_duration_short = displaytext.short_time_string(
-                self.duration)
-        self.display_size = displaytext.size_string(self.size)
-        self.display_date_added = displaytext.date_slashes(self.date_added)
-        self.display_last_played = displaytext.date_slashes(self.last_played)
-        self.display_track = displaytext.integer(self.track)
-        self.display_year = displaytext.integer(self.year)
-        self.display_torrent_details = self.calc_torrent_details()
-        self.display_drm = self.has_drm and _("Locked") or u""
+            return self.artist_sort_key
+
+    # things that get displayed in list view
+
+    @_derived_attribute
+    def description_oneline(self):
+        return self.description_stripped[0].replace('\n', '$')
+
+    @_derived_attribute
+    def display_date(self):
+        return displaytext.date_slashes(self.release_date)
+
+    @_derived_attribute
+    def display_duration(self):
+        return displaytext.duration(self.duration)
+
+    @_derived_attribute
+    def display_duration_short(self):
+        return displaytext.short_time_string(self.duration)
+
+    @_derived_attribute
+    def display_size(self):
+        return displaytext.size_string(self.size)
+
+    @_derived_attribute
+    def display_date_added(self):
+        return displaytext.date_slashes(self.date_added)
+
+    @_derived_attribute
+    def display_last_played(self):
+        return displaytext.date_slashes(self.last_played)
+
+    @_derived_attribute
+    def display_track(self):
+        return displaytext.integer(self.track)
+
+    @_derived_attribute
+    def display_year(self):
+        return displaytext.integer(self.year)
+
+    @_derived_attribute
+    def display_torrent_details(self):
+        return self.calc_torrent_details()
+
+    @_derived_attribute
+    def display_drm(self):
+        return self.has_drm and _("Locked") or u""
+
+    @_derived_attribute
+    def display_kind(self):
         # FIXME: display_kind changes here need also be applied in itemedit
         if self.kind == 'movie':
-            self.display_kind = _("Movie")
+            return _("Movie")
         elif self.kind == 'show':
-            self.display_kind = _("Show")
+            return _("Show")
         elif self.kind == 'clip':
-            self.display_kind = _("Clip")
+            return _("Clip")
         elif self.kind == 'podcast':
-            self.display_kind = _("Podcast")
+            return _("Podcast")
         else:
-            self.display_kind = None
+            return None
 
+    @_derived_attribute
+    def display_eta(self):
+        if self.state == 'downloading' and self.download_info.eta > 0:
+            return displaytext.time_string(self.download_info.eta)
+        else:
+            return ''
+
+    @_derived_attribute
+    def display_rate(self):
         if self.state == 'downloading':
-            dl_info = self.download_info
-            if dl_info.eta > 0:
-                self.display_eta = displaytext.time_string(dl_info.eta)
-            else:
-                self.display_eta = ''
-            self.display_rate = displaytext.download_rate(dl_info.rate)
+            return displaytext.download_rate(self.download_info.rate)
         else:
-            self.display_rate = self.display_eta = ''
+            return ''
 
     def calc_torrent_details(self):
         if not self.download_info or not self.download_info.torrent:
@@ -1261,6 +1360,9 @@ class ItemInfo(object):
              "ratio": self.up_down_ratio})
         return details
 
+ItemInfo.derived_attributes = frozenset(name for name, value in
+        ItemInfo.__dict__.items() if isinstance(value, _derived_attribute))
+
 class DownloadInfo(object):
     """Tracks the download state of an item.
 
@@ -1482,6 +1584,14 @@ class WatchedFoldersChanged(FrontendMessage):
         self.changed = changed
         self.removed = removed
 
+class EventLoopStats(FrontendMessage):
+    """Sends the backend's event loop timing statistics to the frontend.
+
+    report is a text report from eventloop.get_stats_report().
+    """
+    def __init__(self, report):
+        self.report = report
+
 class CurrentSearchInfo(FrontendMessage):
     """Informs the frontend of the current search settings.
     """
@@ -32,7 +32,6 @@ import os.path
 import re
 import subprocess
 import tempfile
-import time
 import traceback
 import threading
 import Queue
@@ -45,16 +44,13 @@ from miro import signals
 from miro import util
 from miro import fileutil
 from miro.plat.utils import (movie_data_program_info,
-                             thread_body)
+                             thread_body, get_logical_cpu_count)
 from miro.errors import Shutdown
 
 # Time in seconds that we wait for the utility to execute.  If it goes
 # longer than this, we assume it's hung and kill it.
 MOVIE_DATA_UTIL_TIMEOUT = 30
 
-# Time to sleep while we're polling the external movie command
-SLEEP_DELAY = 0.1
-
 DURATION_RE = re.compile("Miro-Movie-Data-Length: (\d+)")
 TYPE_RE = re.compile("Miro-Movie-Data-Type: (audio|video|other)")
 THUMBNAIL_SUCCESS_RE = re.compile("Miro-Movie-Data-Thumbnail: Success")
@@ -118,20 +114,50 @@ class MovieDataInfo(object):
 class ProcessHung(StandardError): pass
 
 class MovieDataUpdater(signals.SignalEmitter):
+    """Runs the movie data program on items.
+
+    Items get processed by a pool of worker threads, each one running a
+    single movie data program at a time.  The size of the pool is set by
+    the MAX_CONCURRENT_MOVIE_DATA pref.
+    """
     def __init__ (self):
         signals.SignalEmitter.__init__(self, 'begin-loop', 'end-loop',
                 'queue-empty')
         self.in_shutdown = False
         self.in_progress = set()
         self.queue = Queue.Queue()
-        self.thread = None
-
-    def start_thread(self):
-        self.thread = threading.Thread(name='Movie Data Thread',
-                                       target=thread_body,
-                                       args=[self.thread_loop])
-        self.thread.setDaemon(True)
-        self.thread.start()
+        self.threads = []
+        # movie data processes that are currently running.  We kill these
+        # on shutdown.
+        self.running_processes = set()
+        self.running_processes_lock = threading.Lock()
+        # The worker threads all emit our signals.  SignalEmitter isn't
+        # thread safe, so we serialize the emits with emit_lock.  The loop
+        # signals pass loop_context to their handlers, which can use it to
+        # store per-thread state (for example OS X autorelease pools).
+        self.emit_lock = threading.Lock()
+        self.loop_context = threading.local()
+        # how many worker threads we started and how many are waiting for an
+        # item.  We only emit queue-empty once every worker is idle.  These
+        # must only be changed while holding emit_lock.
+        self.worker_total = 0
+        self.idle_workers = 0
+
+    def worker_count(self):
+        count = int(app.config.get(prefs.MAX_CONCURRENT_MOVIE_DATA))
+        if count <= 0:
+            count = get_logical_cpu_count()
+        return max(count, 1)
+
+    def start_threads(self):
+        self.worker_total = self.worker_count()
+        for i in xrange(self.worker_total):
+            thread = threading.Thread(name='Movie Data Thread %d' % i,
+                                      target=thread_body,
+                                      args=[self.thread_loop])
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
 
     def process_with_movie_data_program(self, mdi):
         command_line, env = mdi.program_info
@@ -173,11 +199,27 @@ class MovieDataUpdater(signals.SignalEmitter):
         """Simple contextmanager to ensure that whatever happens in a
         thread_loop, we signal begin/end properly.
         """
-        self.emit('begin-loop')
+        self.emit_from_worker('begin-loop', self.loop_context)
         try:
             yield
         finally:
-            self.emit('end-loop')
+            self.emit_from_worker('end-loop', self.loop_context)
+
+    def emit_from_worker(self, name, *args):
+        with self.emit_lock:
+            self.emit(name, *args)
+
+    def worker_idle(self):
+        """Called by a worker thread when it finds the queue empty.
+
+        If every other worker is also idle, we're done with all the queued
+        items, so emit queue-empty.
+        """
+        with self.emit_lock:
+            self.idle_workers += 1
+            if (self.idle_workers == self.worker_total and
+                    self.queue.empty()):
+                self.emit('queue-empty')
 
     def thread_loop(self):
         try:
@@ -191,8 +233,10 @@ class MovieDataUpdater(signals.SignalEmitter):
         try:
             mdi = self.queue.get(block=False)
         except Queue.Empty:
-            self.emit('queue-empty')
+            self.worker_idle()
             mdi = self.queue.get(block=True)
+            with self.emit_lock:
+                self.idle_workers -= 1
         # IMPORTANT: once we have popped an MDI off the queue, its mdp_state
         # *must* be set (by update_finished or update_failed) unless we shut
         # down before we could process it
@@ -216,7 +260,6 @@ class MovieDataUpdater(signals.SignalEmitter):
             app.metadata_progress_updater.path_processed(mdi.video_path)
 
     def run_movie_data_program(self, command_line, env):
-        start_time = time.time()
         # create tempfiles to catch output for the movie data program.  Using
         # a pipe fails if the movie data program outputs enough to fill up the
         # buffers (see #17059)
@@ -227,27 +270,47 @@ class MovieDataUpdater(signals.SignalEmitter):
                 startupinfo=util.no_console_startupinfo())
         # close stdin since we won't write to it.
         pipe.stdin.close()
-        while pipe.poll() is None and not self.in_shutdown:
-            time.sleep(SLEEP_DELAY)
-            if time.time() - start_time > MOVIE_DATA_UTIL_TIMEOUT:
-                logging.warning("Movie data process hung, killing it")
+        # Wait for the process to exit, rather than polling it.  If it takes
+        # too long, a timer kills it, which makes wait() return.
+        hung = threading.Event()
+        def on_timeout():
+            logging.warning("Movie data process hung, killing it")
+            hung.set()
+            self.kill_process(pipe)
+        timer = threading.Timer(MOVIE_DATA_UTIL_TIMEOUT, on_timeout)
+        timer.setDaemon(True)
+        with self.running_processes_lock:
+            self.running_processes.add(pipe)
+        try:
+            if self.in_shutdown:
+                # shutdown() may have run before we added pipe to
+                # running_processes
                 self.kill_process(pipe)
-                raise ProcessHung
+            timer.start()
+            pipe.wait()
+        finally:
+            timer.cancel()
+            with self.running_processes_lock:
+                self.running_processes.discard(pipe)
 
         if self.in_shutdown:
-            if pipe.poll() is None:
-                logging.warning("Movie data process running after shutdown, "
-                                "killing it")
-                self.kill_process(pipe)
             raise Shutdown
+        if hung.isSet():
+            raise ProcessHung
         # FIXME: should we do anything with stderr?
         movie_data_stdout.seek(0)
         return movie_data_stdout.read()
 
     def kill_process(self, pipe):
+        """Kill a movie data process.
+
+        The thread running the process is responsible for calling wait() on
+        it.
+        """
+        if pipe.returncode is not None:
+            return
         try:
             pipe.kill()
-            pipe.wait()
         except OSError:
             logging.warning("Error trying to kill the movie data process:\n%s",
                             traceback.format_exc())
@@ -344,9 +407,16 @@ class MovieDataUpdater(signals.SignalEmitter):
 
     def shutdown(self):
         self.in_shutdown = True
-        # wake up our thread
-        self.queue.put(None)
-        if self.thread is not None:
-            self.thread.join()
+        # wake up our threads
+        for thread in self.threads:
+            self.queue.put(None)
+        with self.running_processes_lock:
+            running_processes = list(self.running_processes)
+        for pipe in running_processes:
+            logging.warning("Movie data process running after shutdown, "
+                            "killing it")
+            self.kill_process(pipe)
+        for thread in self.threads:
+            thread.join()
 
 movie_data_updater = MovieDataUpdater()
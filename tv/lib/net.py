@@ -330,7 +330,7 @@ class AsyncSocket(object):
             self.connectionErrback = None
         eventloop.call_in_thread(onAddressLookup, handleGetAddrInfoException,
                                  socket.getaddrinfo,
-                                 "getAddrInfo - %s:%s" % (host, port),
+                                 "getAddrInfo",
                                  host, port)
 
     def accept_connection(self, family, host, port, callback, errback):
@@ -122,6 +122,402 @@ static PyObject *breakup_list(PyObject *self, PyObject *args)
     return ngram_list;
 }
 
+/*
+ * Deduplicated N-grams and N-gram hashes
+ *
+ * breakup_set() returns a set of N-grams for a list of words.  If prefix_max
+ * is given, it also includes prefix keys: PREFIX_MARKER followed by the
+ * first 1 to prefix_max characters of each word.  PREFIX_MARKER must match
+ * search.PREFIX_MARKER.
+ *
+ * hash_set() returns the hashes of the same keys.  We calculate them
+ * directly from the string data, without creating a string object for each
+ * N-gram.  We use 64-bit FNV-1a hashes of the character values, so str and
+ * unicode objects with the same ASCII text hash the same.
+ */
+
+#define PREFIX_MARKER '^'
+#define FNV_OFFSET_BASIS 14695981039346656037ULL
+#define FNV_PRIME 1099511628211ULL
+
+typedef unsigned PY_LONG_LONG ngram_hash;
+
+/* Callback for each key we find.  Return -1 on error. */
+typedef int (*key_callback)(void *data, PyObject *word, Py_ssize_t start,
+        Py_ssize_t length, int prefix, ngram_hash hash);
+
+static ngram_hash hash_chars(PyObject *word, Py_ssize_t start,
+        Py_ssize_t length, ngram_hash hash)
+{
+    Py_ssize_t i;
+
+    if(PyUnicode_Check(word)) {
+        Py_UNICODE *chars = PyUnicode_AS_UNICODE(word) + start;
+        for(i = 0; i < length; i++) {
+            hash ^= (ngram_hash)chars[i];
+            hash *= FNV_PRIME;
+        }
+    } else {
+        unsigned char *chars = (unsigned char*)PyString_AS_STRING(word) +
+            start;
+        for(i = 0; i < length; i++) {
+            hash ^= (ngram_hash)chars[i];
+            hash *= FNV_PRIME;
+        }
+    }
+    return hash;
+}
+
+static ngram_hash prefix_hash_start(void)
+{
+    ngram_hash hash = FNV_OFFSET_BASIS;
+    hash ^= (ngram_hash)PREFIX_MARKER;
+    hash *= FNV_PRIME;
+    return hash;
+}
+
+static Py_ssize_t word_length(PyObject *word)
+{
+    if(PyUnicode_Check(word)) {
+        return PyUnicode_GET_SIZE(word);
+    } else if(PyString_Check(word)) {
+        return PyString_GET_SIZE(word);
+    } else {
+        PyErr_SetString(PyExc_TypeError, "expected a string");
+        return -1;
+    }
+}
+
+/* Call callback for each N-gram and prefix key in word. */
+static int for_each_key(PyObject *word, long min, long max, long prefix_max,
+        key_callback callback, void *data)
+{
+    Py_ssize_t len, i, n;
+    ngram_hash hash;
+
+    if((len = word_length(word)) == -1) {
+        return -1;
+    }
+    for(n = min; n <= max; n++) {
+        for(i = 0; i + n <= len; i++) {
+            hash = hash_chars(word, i, n, FNV_OFFSET_BASIS);
+            if(callback(data, word, i, n, 0, hash) == -1) {
+                return -1;
+            }
+        }
+    }
+    hash = prefix_hash_start();
+    for(n = 1; n <= prefix_max && n <= len; n++) {
+        hash = hash_chars(word, n - 1, 1, hash);
+        if(callback(data, word, 0, n, 1, hash) == -1) {
+            return -1;
+        }
+    }
+    return 0;
+}
+
+/* Call callback for each key in a sequence of words. */
+static int for_each_key_in_list(PyObject *word_list, long min, long max,
+        long prefix_max, key_callback callback, void *data)
+{
+    PyObject *iter;
+    PyObject *word;
+
+    iter = PyObject_GetIter(word_list);
+    if(!iter) return -1;
+    while ((word = PyIter_Next(iter))) {
+        if(for_each_key(word, min, max, prefix_max, callback, data) == -1) {
+            Py_DECREF(word);
+            Py_DECREF(iter);
+            return -1;
+        }
+        Py_DECREF(word);
+    }
+    Py_DECREF(iter);
+    if(PyErr_Occurred()) return -1;
+    return 0;
+}
+
+static int add_key_to_set(void *data, PyObject *word, Py_ssize_t start,
+        Py_ssize_t length, int prefix, ngram_hash hash)
+{
+    PyObject *key;
+    int result;
+
+    if(prefix) {
+        PyObject *marker;
+        PyObject *chars;
+        if(PyUnicode_Check(word)) {
+            Py_UNICODE marker_char = PREFIX_MARKER;
+            marker = PyUnicode_FromUnicode(&marker_char, 1);
+        } else {
+            char marker_char = PREFIX_MARKER;
+            marker = PyString_FromStringAndSize(&marker_char, 1);
+        }
+        if(!marker) return -1;
+        chars = PySequence_GetSlice(word, start, start + length);
+        if(!chars) {
+            Py_DECREF(marker);
+            return -1;
+        }
+        key = PySequence_Concat(marker, chars);
+        Py_DECREF(marker);
+        Py_DECREF(chars);
+    } else {
+        key = PySequence_GetSlice(word, start, start + length);
+    }
+    if(!key) return -1;
+    result = PySet_Add((PyObject*)data, key);
+    Py_DECREF(key);
+    return result;
+}
+
+static int add_hash_to_set(void *data, PyObject *word, Py_ssize_t start,
+        Py_ssize_t length, int prefix, ngram_hash hash)
+{
+    PyObject *value;
+    int result;
+
+    value = PyLong_FromUnsignedLongLong(hash);
+    if(!value) return -1;
+    result = PySet_Add((PyObject*)data, value);
+    Py_DECREF(value);
+    return result;
+}
+
+static PyObject *breakup_set(PyObject *self, PyObject *args)
+{
+    PyObject* source_list;
+    PyObject* ngram_set;
+    long min, max, prefix_max = 0;
+
+    if (!PyArg_ParseTuple(args, "Oll|l:breakup_set", &source_list, &min,
+                &max, &prefix_max)) {
+        return NULL;
+    }
+    ngram_set = PySet_New(NULL);
+    if(!ngram_set) return NULL;
+    if(for_each_key_in_list(source_list, min, max, prefix_max,
+                add_key_to_set, ngram_set) == -1) {
+        Py_DECREF(ngram_set);
+        return NULL;
+    }
+    return ngram_set;
+}
+
+static PyObject *hash_set(PyObject *self, PyObject *args)
+{
+    PyObject* source_list;
+    PyObject* hashes;
+    long min, max, prefix_max = 0;
+
+    if (!PyArg_ParseTuple(args, "Oll|l:hash_set", &source_list, &min,
+                &max, &prefix_max)) {
+        return NULL;
+    }
+    hashes = PySet_New(NULL);
+    if(!hashes) return NULL;
+    if(for_each_key_in_list(source_list, min, max, prefix_max,
+                add_hash_to_set, hashes) == -1) {
+        Py_DECREF(hashes);
+        return NULL;
+    }
+    return hashes;
+}
+
+static int hash_key_object(PyObject *key, ngram_hash *hash)
+{
+    Py_ssize_t len;
+
+    if((len = word_length(key)) == -1) {
+        return -1;
+    }
+    *hash = hash_chars(key, 0, len, FNV_OFFSET_BASIS);
+    return 0;
+}
+
+static PyObject *hash_key(PyObject *self, PyObject *args)
+{
+    PyObject* key;
+    ngram_hash hash;
+
+    if (!PyArg_ParseTuple(args, "O:hash_key", &key)) {
+        return NULL;
+    }
+    if(hash_key_object(key, &hash) == -1) {
+        return NULL;
+    }
+    return PyLong_FromUnsignedLongLong(hash);
+}
+
+/*
+ * match_lists()
+ *
+ * Test a list of word lists against a query.  The query is made up of
+ * positive keys, which all need to be present for a word list to match, and
+ * groups of negative keys.  If all the keys in a negative group are present,
+ * the word list doesn't match.  Keys are N-grams or prefix keys, like the
+ * ones from breakup_set().
+ *
+ * Returns a list containing the indexes of the word lists that match.
+ */
+
+typedef struct {
+    ngram_hash *hashes;     /* hashes of all query keys */
+    char *found;            /* which query keys we've seen */
+    Py_ssize_t key_count;
+} query_state;
+
+static int mark_found_key(void *data, PyObject *word, Py_ssize_t start,
+        Py_ssize_t length, int prefix, ngram_hash hash)
+{
+    query_state *state = (query_state*)data;
+    Py_ssize_t i;
+
+    for(i = 0; i < state->key_count; i++) {
+        if(state->hashes[i] == hash) {
+            state->found[i] = 1;
+        }
+    }
+    return 0;
+}
+
+/* Append the hashes for a sequence of keys to hashes.  Returns the number of
+ * keys or -1 on error. */
+static Py_ssize_t hash_key_sequence(PyObject *keys, ngram_hash *hashes)
+{
+    PyObject *fast;
+    Py_ssize_t i, count;
+
+    fast = PySequence_Fast(keys, "keys must be a sequence");
+    if(!fast) return -1;
+    count = PySequence_Fast_GET_SIZE(fast);
+    for(i = 0; i < count; i++) {
+        if(hash_key_object(PySequence_Fast_GET_ITEM(fast, i),
+                    hashes + i) == -1) {
+            Py_DECREF(fast);
+            return -1;
+        }
+    }
+    Py_DECREF(fast);
+    return count;
+}
+
+static PyObject *match_lists(PyObject *self, PyObject *args)
+{
+    PyObject *word_lists, *positive_keys, *negative_groups;
+    PyObject *word_list_iter = NULL, *negative_fast = NULL;
+    PyObject *word_list, *index, *result = NULL;
+    Py_ssize_t positive_count, negative_count, key_count, group_start;
+    Py_ssize_t *group_sizes = NULL;
+    Py_ssize_t i, j, list_index;
+    long min, max, prefix_max;
+    query_state state;
+    int match;
+
+    state.hashes = NULL;
+    state.found = NULL;
+    if (!PyArg_ParseTuple(args, "OlllOO:match_lists", &word_lists, &min,
+                &max, &prefix_max, &positive_keys, &negative_groups)) {
+        return NULL;
+    }
+
+    /* compile the query into an array of key hashes */
+    positive_count = PySequence_Length(positive_keys);
+    if(positive_count == -1) goto error;
+    negative_fast = PySequence_Fast(negative_groups,
+            "negative_groups must be a sequence");
+    if(!negative_fast) goto error;
+    negative_count = PySequence_Fast_GET_SIZE(negative_fast);
+    key_count = positive_count;
+    group_sizes = PyMem_New(Py_ssize_t, negative_count + 1);
+    if(!group_sizes) {
+        PyErr_NoMemory();
+        goto error;
+    }
+    for(i = 0; i < negative_count; i++) {
+        group_sizes[i] = PySequence_Length(
+                PySequence_Fast_GET_ITEM(negative_fast, i));
+        if(group_sizes[i] == -1) goto error;
+        key_count += group_sizes[i];
+    }
+    state.hashes = PyMem_New(ngram_hash, key_count + 1);
+    state.found = PyMem_New(char, key_count + 1);
+    if(!state.hashes || !state.found) {
+        PyErr_NoMemory();
+        goto error;
+    }
+    state.key_count = key_count;
+    if(hash_key_sequence(positive_keys, state.hashes) == -1) goto error;
+    group_start = positive_count;
+    for(i = 0; i < negative_count; i++) {
+        if(hash_key_sequence(PySequence_Fast_GET_ITEM(negative_fast, i),
+                state.hashes + group_start) == -1) goto error;
+        group_start += group_sizes[i];
+    }
+
+    result = PyList_New(0);
+    if(!result) goto error;
+    word_list_iter = PyObject_GetIter(word_lists);
+    if(!word_list_iter) goto error;
+    list_index = 0;
+    while ((word_list = PyIter_Next(word_list_iter))) {
+        memset(state.found, 0, key_count);
+        if(for_each_key_in_list(word_list, min, max, prefix_max,
+                    mark_found_key, &state) == -1) {
+            Py_DECREF(word_list);
+            goto error;
+        }
+        Py_DECREF(word_list);
+        match = 1;
+        for(i = 0; i < positive_count; i++) {
+            if(!state.found[i]) {
+                match = 0;
+                break;
+            }
+        }
+        group_start = positive_count;
+        for(i = 0; match && i < negative_count; i++) {
+            int all_found = 1;
+            for(j = group_start; j < group_start + group_sizes[i]; j++) {
+                if(!state.found[j]) {
+                    all_found = 0;
+                    break;
+                }
+            }
+            if(all_found) match = 0;
+            group_start += group_sizes[i];
+        }
+        if(match) {
+            index = PyInt_FromSsize_t(list_index);
+            if(!index) goto error;
+            if(PyList_Append(result, index) == -1) {
+                Py_DECREF(index);
+                goto error;
+            }
+            Py_DECREF(index);
+        }
+        list_index++;
+    }
+    if(PyErr_Occurred()) goto error;
+
+    Py_DECREF(word_list_iter);
+    Py_DECREF(negative_fast);
+    PyMem_Free(group_sizes);
+    PyMem_Free(state.hashes);
+    PyMem_Free(state.found);
+    return result;
+
+error:
+    Py_XDECREF(word_list_iter);
+    Py_XDECREF(negative_fast);
+    Py_XDECREF(result);
+    PyMem_Free(group_sizes);
+    PyMem_Free(state.hashes);
+    PyMem_Free(state.found);
+    return NULL;
+}
+
 static PyMethodDef NgramsMethods[] =
 {
     {"breakup_word", (PyCFunction)breakup_word, METH_VARARGS,
@@ -130,6 +526,19 @@ static PyMethodDef NgramsMethods[] =
     {"breakup_list", (PyCFunction)breakup_list, METH_VARARGS,
         "split a sequence of words into a list of ngrams"
     },
+    {"breakup_set", (PyCFunction)breakup_set, METH_VARARGS,
+        "split a sequence of words into a set of ngrams and prefix keys"
+    },
+    {"hash_set", (PyCFunction)hash_set, METH_VARARGS,
+        "calculate a set of hashes for the ngrams and prefix keys of a "
+        "sequence of words"
+    },
+    {"hash_key", (PyCFunction)hash_key, METH_VARARGS,
+        "calculate the hash for a single ngram or prefix key"
+    },
+    {"match_lists", (PyCFunction)match_lists, METH_VARARGS,
+        "find the sequences of words that match a query"
+    },
     { NULL, NULL, 0, NULL }
 };
 
@@ -73,6 +73,10 @@ LIMIT_DOWNSTREAM_BT         = Pref(key='limitDownstreamBT',     default=False, p
 DOWNSTREAM_BT_LIMIT_IN_KBS  = Pref(key='downstreamBTLimitInKBS', default=200,   platformSpecific=False)
 LIMIT_CONNECTIONS_BT        = Pref(key='limitConnectionsBT',     default=False, platformSpecific=False)
 CONNECTION_LIMIT_BT_NUM     = Pref(key='connectionLimitBTNum', default=100,   platformSpecific=False)
+LIMIT_DOWNSTREAM_HTTP       = Pref(key='limitDownstreamHTTP',   default=False, platformSpecific=False)
+DOWNSTREAM_HTTP_LIMIT_IN_KBS = Pref(key='downstreamHTTPLimitInKBS', default=200, platformSpecific=False)
+LIMIT_DOWNSTREAM_HTTP_PER_DOWNLOAD = Pref(key='limitDownstreamHTTPPerDownload', default=False, platformSpecific=False)
+DOWNSTREAM_HTTP_PER_DOWNLOAD_LIMIT_IN_KBS = Pref(key='downstreamHTTPPerDownloadLimitInKBS', default=100, platformSpecific=False)
 PRESERVE_DISK_SPACE         = Pref(key='preserveDiskSpace',     default=True,  platformSpecific=False)
 PRESERVE_X_GB_FREE          = Pref(key='preserveXGBFree',       default=0.2,   platformSpecific=False)
 EXPIRE_AFTER_X_DAYS         = Pref(key='expireAfterXDays',      default=6,     platformSpecific=False,
@@ -110,6 +114,13 @@ SUBTITLE_FONT               = Pref(key='subtitleFont',          default=None,  p
 # language setting: "system" uses system default; all other languages are overrides
 LANGUAGE                    = Pref(key='language',              default="system", platformSpecific=False)
 MAX_CONCURRENT_CONVERSIONS  = Pref(key='maxConcurrentConversions', default=1, platformSpecific=False)
+# seconds between logging event loop stats.  0 means never
+EVENT_LOOP_STATS_INTERVAL   = Pref(key='eventLoopStatsInterval', default=0, platformSpecific=False)
+# number of movie data programs to run at once.  0 means one per CPU
+MAX_CONCURRENT_MOVIE_DATA   = Pref(key='maxConcurrentMovieData', default=0, platformSpecific=False)
+# number of worker processes to run feedparser in.  0 means one per CPU (up
+# to workerprocess.AUTO_WORKER_LIMIT)
+WORKER_PROCESS_COUNT        = Pref(key='workerProcessCount',    default=0, platformSpecific=False)
 SHOW_UNKNOWN_DEVICES        = Pref(key='showUnknownDevices',    default=False, platformSpecific=False)
 SHARE_MEDIA                 = Pref(key='ShareMedia',            default=False, platformSpecific=False)
 SHARE_DISCOVERABLE          = Pref(key='ShareDiscoverable',     default=True, platformSpecific=False)
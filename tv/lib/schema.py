@@ -354,6 +354,10 @@ class ObjectSchema(object):
     * ``table_name`` -- SQL table name to store the class in
     * ``fields`` -- list of (name, SchemaItem) pairs.  One item for
       each attribute that should be stored to disk.
+    * ``lazy_fields`` -- names of fields that shouldn't be loaded when
+      the object is restored.  They get loaded from the database the first
+      time the attribute is accessed.  Use this for large columns that most
+      code doesn't need.
     """
 
     @classmethod
@@ -365,6 +369,7 @@ class ObjectSchema(object):
         return cls.klass
 
     indexes = ()
+    lazy_fields = ()
 
 class MultiClassObjectSchema(ObjectSchema):
     """ObjectSchema where rows will be restored to different python
@@ -494,6 +499,9 @@ class ItemSchema(MultiClassObjectSchema):
         ('kind', SchemaString(noneOk=True)),
     ]
 
+    # descriptions can be large and are only needed to build ItemInfos
+    lazy_fields = ('entry_description', 'description')
+
     indexes = (
             ('item_feed', ('feed_id',)),
             ('item_feed_visible', ('feed_id', 'deleted')),
@@ -804,7 +812,7 @@ class ViewStateSchema(DDBObjectSchema):
     def handle_malformed_selection(value):
         return None
 
-VERSION = 162
+VERSION = 163
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
     FeedImplSchema, RSSFeedImplSchema, SavedSearchFeedImplSchema,
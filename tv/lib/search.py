@@ -29,11 +29,32 @@
 
 """search.py -- Indexed searching of items.
 
-To make incremental search fast, we index the N-grams for each item.
+To make incremental search fast, we index the N-grams for each item.  Terms
+shorter than our smallest N-grams are matched against the start of words
+using a prefix index.
+
+Note that this means that short and long terms match differently.  A term
+with NGRAM_MIN or more characters matches anywhere inside a word ("ball"
+matches "football"), but a shorter term only matches the start of a word
+("fo" matches "football", "ba" doesn't).  Indexing every 1 and 2 character
+substring would make those posting lists cover most of the library, which
+defeats the point of searching short terms.
+
+Searches normally return a set of matching ids.  For a ranked search, pass
+the matching ItemInfos to rank_items(), which orders them by where the terms
+match (title or other text), how often they match and how recent the item
+is (see score_item()).
 """
-import collections
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+import cPickle
+import heapq
+import math
 import os
 import re
+import sys
+import zlib
 
 from miro import ngrams
 from miro.plat.utils import filename_to_unicode
@@ -45,8 +66,25 @@ SLASHKILLER = re.compile(r'\\.')
 WORDMATCHER = re.compile("\w+", re.UNICODE)
 NGRAM_MIN = 3
 NGRAM_MAX = 5
+# Keys in the prefix index start with this.  WORDMATCHER never includes it in
+# a search term, so the keys can't clash with our N-grams.  This needs to
+# match PREFIX_MARKER in ngrams.c.
+PREFIX_MARKER = u'^'
+# weights for ranked searches
+TITLE_WEIGHT = 3.0
+TEXT_WEIGHT = 1.0
+RECENCY_WEIGHT = 1.0
+# number of days before the recency part of the score drops by half
+RECENCY_HALF_LIFE = 30.0
+# Bump this whenever the snapshot format or the way we calculate index keys
+# changes (see ItemSearcher.to_snapshot())
+SNAPSHOT_FORMAT = 1
 SEARCHOBJECTS = {}
 
+class SnapshotError(ValueError):
+    """Raised when we can't load an ItemSearcher snapshot."""
+    pass
+
 def _get_boolean_search(search_string):
     if not SEARCHOBJECTS.has_key(search_string):
         SEARCHOBJECTS[search_string] = BooleanSearch(search_string)
@@ -141,6 +179,50 @@ def _ngrams_for_item(item_info):
 
     return ngrams.breakup_list(item_info.search_terms, NGRAM_MIN, NGRAM_MAX)
 
+def _is_prefix_term(term):
+    """Check if we should use the prefix index to search for a term."""
+    return (0 < len(term) < NGRAM_MIN and
+            WORDMATCHER.findall(term) == [term])
+
+def _index_keys_for_term(term):
+    """Given a term, return a list of index keys that we should search for.
+
+    Long terms use _ngrams_for_term().  Shorter terms use the prefix index,
+    so they match items that have a word starting with the term.  If we
+    return an empty list, the term matches everything.
+    """
+    if _is_prefix_term(term):
+        return [PREFIX_MARKER + term]
+    return _ngrams_for_term(term)
+
+def _index_keys_for_item(item_info):
+    """Given an ItemInfo, return a set of N-grams and prefix index keys.
+
+    We index the prefixes of each word that are shorter than NGRAM_MIN.
+    ngrams.breakup_set() calculates both kinds of keys and removes
+    duplicates for us.
+    """
+    return ngrams.breakup_set(item_info.search_terms, NGRAM_MIN, NGRAM_MAX,
+            NGRAM_MIN - 1)
+
+def _compile_query(search_text):
+    """Convert a search into arguments for ngrams.match_lists()
+
+    :returns: (positive_keys, negative_groups) tuple.  Items must have all
+        the positive keys and can't have all the keys in any of the negative
+        groups.
+    """
+    parsed_search = _get_boolean_search(search_text)
+    positive_keys = []
+    for term in parsed_search.positive_terms:
+        positive_keys.extend(_index_keys_for_term(term))
+    negative_groups = [_index_keys_for_term(term)
+            for term in parsed_search.negative_terms]
+    # terms without any keys match everything, so they can't rule out
+    # items.
+    negative_groups = [group for group in negative_groups if group]
+    return positive_keys, negative_groups
+
 def item_matches(item_info, search_text):
     """Test if a single ItemInfo matches a search
 
@@ -149,51 +231,228 @@ def item_matches(item_info, search_text):
 
     :returns: True if the item matches the search string
     """
-    parsed_search = _get_boolean_search(search_text)
-    item_ngrams = _ngrams_for_item(item_info)
-
-    for term in parsed_search.positive_terms:
-        if not set(_ngrams_for_term(term)).issubset(item_ngrams):
-            return False
-    for term in parsed_search.negative_terms:
-        if set(_ngrams_for_term(term)).issubset(item_ngrams):
-            return False
-    return True
+    positive_keys, negative_groups = _compile_query(search_text)
+    return bool(ngrams.match_lists([item_info.search_terms], NGRAM_MIN,
+        NGRAM_MAX, NGRAM_MIN - 1, positive_keys, negative_groups))
 
 def list_matches(item_infos, search_text):
     """
     Optimized version of item_matches() which filters a iterable
     of item_infos.
 
-    Right now, the optimization is for a short search string and a lot of
-    items (the typical case).  This will probably be slow for long search
-    strings since we'll need to iterate over all of the terms.
+    We compile the search once, then test the search terms for all the items
+    in a single ngrams.match_lists() call.  This avoids creating N-gram
+    strings and sets for each item, so it's fast enough to use on large lists
+    that aren't indexed.
+    """
+    item_infos = list(item_infos)
+    positive_keys, negative_groups = _compile_query(search_text)
+    matches = ngrams.match_lists([info.search_terms for info in item_infos],
+            NGRAM_MIN, NGRAM_MAX, NGRAM_MIN - 1, positive_keys,
+            negative_groups)
+    for index in matches:
+        yield item_infos[index]
+
+def _term_matches_word(term, word):
+    if _is_prefix_term(term):
+        return word.startswith(term)
+    return term in word
+
+def _term_frequency_score(term, words):
+    count = 0
+    for word in words:
+        if _term_matches_word(term, word):
+            count += 1
+    if count == 0:
+        return 0.0
+    # dampen the frequency so that a term repeated many times in a long
+    # description doesn't outweigh a match in the title.
+    return 1.0 + math.log(count)
+
+def _recency_score(item_info, now):
+    date = item_info.release_date
+    if not isinstance(date, datetime):
+        date = item_info.date_added
+        if not isinstance(date, datetime):
+            return 0.0
+    age = now - date
+    age_days = max(age.days + age.seconds / 86400.0, 0.0)
+    return 0.5 ** (age_days / RECENCY_HALF_LIFE)
+
+def score_item(item_info, search_text, now=None):
+    """Calculate how well an ItemInfo matches a search.
+
+    Matches in the title count more than matches in the rest of the search
+    text, terms that appear more often count more, and newer items get a
+    bonus.  This doesn't check that the item actually matches the search,
+    use item_matches() or an ItemSearcher for that.
+
+    :param item_info: ItemInfo to score
+    :param search_text: search_text to search with
+    :param now: datetime to calculate the recency from, defaults to now
+
+    :returns: score for the item, higher scores are better matches
     """
+    if now is None:
+        now = datetime.now()
     parsed_search = _get_boolean_search(search_text)
-    positive_set = set()
-    negative_set = set()
+    # calc_search_terms() puts the title words first
+    title_word_count = len(WORDMATCHER.findall(item_info.name.lower()))
+    title_words = item_info.search_terms[:title_word_count]
+    other_words = item_info.search_terms[title_word_count:]
+    score = RECENCY_WEIGHT * _recency_score(item_info, now)
     for term in parsed_search.positive_terms:
-        positive_set |= set(_ngrams_for_term(term))
-    for term in parsed_search.negative_terms:
-        negative_set |= set(_ngrams_for_term(term))
+        score += TITLE_WEIGHT * _term_frequency_score(term, title_words)
+        score += TEXT_WEIGHT * _term_frequency_score(term, other_words)
+    return score
+
+def rank_items(item_infos, search_text, limit=None):
+    """Sort a list of ItemInfos by how well they match a search.
 
-    for info in item_infos:
-        item_ngrams_set = set(_ngrams_for_item(info))
-        match = positive_set.issubset(item_ngrams_set)
-        if match and negative_set:
-            match = negative_set.isdisjoint(item_ngrams_set)
+    :param item_infos: ItemInfos that match search_text
+    :param search_text: search_text to search with
+    :param limit: if given, only return this many of the best matches
 
-        if match:
-            yield info
+    :returns: list of ItemInfos, best matches first
+    """
+    now = datetime.now()
+    key = lambda info: score_item(info, search_text, now)
+    if limit is None:
+        return sorted(item_infos, key=key, reverse=True)
+    else:
+        return heapq.nlargest(limit, item_infos, key=key)
+
+def _intersect_sorted(list1, list2):
+    """Intersect 2 sorted arrays of ints.
+
+    We iterate through the shorter list and use galloping search to find
+    each value in the longer list.  This is fast when one list is much
+    shorter than the other, which is the common case for N-gram posting
+    lists.
+
+    :returns: sorted array of ints in both lists
+    """
+    if len(list1) > len(list2):
+        list1, list2 = list2, list1
+    result = array('i')
+    length = len(list2)
+    pos = 0
+    for value in list1:
+        # gallop forward until we pass value, then binary search
+        step = 1
+        while pos + step < length and list2[pos + step] < value:
+            pos += step
+            step *= 2
+        pos = bisect_left(list2, value, pos, min(pos + step + 1, length))
+        if pos == length:
+            break
+        if list2[pos] == value:
+            result.append(value)
+    return result
 
 class ItemSearcher(object):
-    """Index Item objects so that they can be searched quickly """
+    """Index Item objects so that they can be searched quickly
+
+    To keep memory usage low, we don't store python sets for each N-gram.
+    Instead, each N-gram gets an integer id and each indexed ItemInfo gets a
+    document number.  For each N-gram we store a posting list: a sorted
+    array of the document numbers that contain it.
+
+    Prefix index keys (see _index_keys_for_item()) are stored exactly like
+    N-grams.  They have their own posting lists, which lets short search
+    terms narrow the results instead of matching everything.
+
+    Document numbers only increase, so adding an item just means appending
+    to the posting lists.  When an item is removed or updated, we mark its
+    old document number as dead and skip it in the search results.  Once
+    enough dead document numbers pile up, we rebuild the posting lists
+    without them (see _compact()).
+    """
+
+    # compact once there are this many dead documents...
+    COMPACT_MIN_DEAD = 1000
+    # ...and they make up at least this fraction of all documents
+    COMPACT_DEAD_RATIO = 0.25
 
     def __init__(self):
-        # map N-grams -> set of item ids
-        self._ngram_map = collections.defaultdict(set)
-        # map item id -> list of N-grams
-        self._item_ngrams = {}
+        # map N-grams and prefix index keys -> N-gram id
+        self._ngram_ids = {}
+        # list of posting lists, indexed by N-gram id
+        self._postings = []
+        # map item id -> document number
+        self._item_docs = {}
+        # map document number -> item id for each document, or None for dead
+        # documents
+        self._doc_items = []
+        # map item id -> array of N-gram ids, so we know which N-grams an
+        # item used if we need to compact.
+        self._item_ngram_ids = {}
+        self._dead_count = 0
+
+    def __len__(self):
+        return len(self._item_docs)
+
+    def __contains__(self, item_id):
+        return item_id in self._item_docs
+
+    def item_ids(self):
+        """Get a set containing the ids of the items in the index."""
+        return set(self._item_docs)
+
+    def to_snapshot(self):
+        """Save the index to a string.
+
+        Use load_snapshot() to restore it.  The snapshot stores the N-gram
+        ids for each item along with the posting lists, so loading it is
+        much faster than indexing the items again.
+        """
+        if self._dead_count:
+            self._compact()
+        ngram_list = [None] * len(self._postings)
+        for ngram, ngram_id in self._ngram_ids.iteritems():
+            ngram_list[ngram_id] = ngram
+        snapshot = (SNAPSHOT_FORMAT, sys.byteorder, array('i').itemsize,
+                ngram_list,
+                [postings.tostring() for postings in self._postings],
+                self._doc_items,
+                [self._item_ngram_ids[item_id].tostring()
+                    for item_id in self._doc_items])
+        return zlib.compress(cPickle.dumps(snapshot,
+            cPickle.HIGHEST_PROTOCOL), 1)
+
+    def load_snapshot(self, data):
+        """Replace the contents of the index with a snapshot.
+
+        :param data: string returned by to_snapshot()
+        :raises SnapshotError: data is corrupt or uses a different format
+        """
+        try:
+            (format_version, byteorder, itemsize, ngram_list, postings,
+                    doc_items, item_ngram_ids) = cPickle.loads(
+                            zlib.decompress(data))
+        except (zlib.error, cPickle.UnpicklingError, EOFError, ValueError,
+                TypeError, IndexError, KeyError, AttributeError), e:
+            raise SnapshotError("corrupt snapshot: %s" % e)
+        if (format_version, byteorder, itemsize) != (SNAPSHOT_FORMAT,
+                sys.byteorder, array('i').itemsize):
+            raise SnapshotError("unknown snapshot format: %s" %
+                    ((format_version, byteorder, itemsize),))
+        if (len(ngram_list) != len(postings) or
+                len(doc_items) != len(item_ngram_ids)):
+            raise SnapshotError("corrupt snapshot: length mismatch")
+        try:
+            self._ngram_ids = dict((ngram, ngram_id)
+                    for ngram_id, ngram in enumerate(ngram_list))
+            self._postings = [array('i', data) for data in postings]
+            self._doc_items = doc_items
+            self._item_docs = dict((item_id, doc)
+                    for doc, item_id in enumerate(doc_items))
+            self._item_ngram_ids = dict((item_id, array('i', data))
+                    for item_id, data in zip(doc_items, item_ngram_ids))
+        except (TypeError, ValueError), e:
+            self.__init__()
+            raise SnapshotError("corrupt snapshot: %s" % e)
+        self._dead_count = 0
 
     def add_item(self, item_info):
         """Add an item info to the index."""
@@ -215,46 +474,113 @@ class ItemSearcher(object):
         self._remove_item(item_id)
 
     def _add_item(self, item_info):
-        item_ngrams = _ngrams_for_item(item_info)
-        for ngram in item_ngrams:
-            self._ngram_map[ngram].add(item_info.id)
-        self._item_ngrams[item_info.id] = item_ngrams
+        if item_info.id in self._item_docs:
+            self._remove_item(item_info.id)
+        ngram_ids = array('i')
+        for ngram in _index_keys_for_item(item_info):
+            try:
+                ngram_ids.append(self._ngram_ids[ngram])
+            except KeyError:
+                ngram_id = self._ngram_ids[ngram] = len(self._postings)
+                self._postings.append(array('i'))
+                ngram_ids.append(ngram_id)
+        doc = len(self._doc_items)
+        self._doc_items.append(item_info.id)
+        self._item_docs[item_info.id] = doc
+        self._item_ngram_ids[item_info.id] = ngram_ids
+        postings = self._postings
+        for ngram_id in ngram_ids:
+            postings[ngram_id].append(doc)
 
     def _remove_item(self, item_id):
-        for ngram in self._item_ngrams.pop(item_id):
-            self._ngram_map[ngram].discard(item_id)
+        doc = self._item_docs.pop(item_id)
+        del self._item_ngram_ids[item_id]
+        self._doc_items[doc] = None
+        self._dead_count += 1
+        if (self._dead_count >= self.COMPACT_MIN_DEAD and
+                self._dead_count >= (len(self._doc_items) *
+                    self.COMPACT_DEAD_RATIO)):
+            self._compact()
+
+    def _compact(self):
+        """Rebuild our posting lists without dead documents.
+
+        We also renumber the documents so that there are no gaps.
+        """
+        postings = [array('i') for i in xrange(len(self._postings))]
+        doc_items = []
+        item_docs = {}
+        for item_id in self._doc_items:
+            if item_id is None:
+                continue
+            doc = len(doc_items)
+            doc_items.append(item_id)
+            item_docs[item_id] = doc
+            for ngram_id in self._item_ngram_ids[item_id]:
+                postings[ngram_id].append(doc)
+        self._postings = postings
+        self._doc_items = doc_items
+        self._item_docs = item_docs
+        self._dead_count = 0
 
     def _term_search(self, term):
-        grams = _ngrams_for_term(term)
-        # note that we need to copy the value from _ngram_map.  We don't want
-        # our calls to intersection_update to change it.
-        rv = set(self._ngram_map[grams[0]])
-        for gram in grams[1:]:
-            rv.intersection_update(self._ngram_map[gram])
+        """Find the documents that match a term.
+
+        :returns: sorted array of document numbers, possibly including dead
+            documents.
+        """
+        posting_lists = []
+        for gram in _index_keys_for_term(term):
+            try:
+                posting_lists.append(self._postings[self._ngram_ids[gram]])
+            except KeyError:
+                # no items contain this N-gram
+                return array('i')
+        # start with the shortest list to keep the intersections small
+        posting_lists.sort(key=len)
+        rv = posting_lists[0]
+        for posting_list in posting_lists[1:]:
+            if not rv:
+                break
+            rv = _intersect_sorted(rv, posting_list)
+        return rv
+
+    def _docs_to_ids(self, docs):
+        doc_items = self._doc_items
+        rv = set(doc_items[doc] for doc in docs)
+        rv.discard(None)
         return rv
 
-    def search(self, search_text):
+    def search(self, search_text, ids=None):
         """Search through the index items.
 
         :param search_text: search_text to search with
+        :param ids: if given, only return results from this set of ids
 
         :returns: set of ids that match the search
         """
         parsed_search = _get_boolean_search(search_text)
-        # filter out terms smaller than the smallest N-gram we index.
+        # filter out terms that we can't search the index for.
         positive_terms = [t for t in parsed_search.positive_terms
-                if len(t) >= NGRAM_MIN]
+                if _index_keys_for_term(t)]
         negative_terms = [t for t in parsed_search.negative_terms
-                if len(t) >= NGRAM_MIN]
+                if _index_keys_for_term(t)]
 
         if positive_terms:
-            first_term = positive_terms[0]
-            matching_ids = self._term_search(first_term)
-            for term in positive_terms[1:]:
-                matching_ids.intersection_update(self._term_search(term))
+            matching_docs = None
+            for term in positive_terms:
+                docs = self._term_search(term)
+                if matching_docs is None:
+                    matching_docs = docs
+                else:
+                    matching_docs = _intersect_sorted(matching_docs, docs)
+            matching_ids = self._docs_to_ids(matching_docs)
         else:
-            matching_ids = set(self._item_ngrams.keys())
+            matching_ids = set(self._item_docs)
 
         for term in negative_terms:
-            matching_ids.difference_update(self._term_search(term))
+            matching_ids.difference_update(self._docs_to_ids(
+                self._term_search(term)))
+        if ids is not None:
+            matching_ids.intersection_update(ids)
         return matching_ids
@@ -0,0 +1,279 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.searchindex`` -- Search index for the items in the database.
+
+The frontend filters item lists as the user types in the search box.  For
+lists of database items, rather than having each list build an N-gram index
+of its items, the backend keeps a single index of every item in the
+database.  The index is kept up to date using the ItemInfoCache signals.
+
+We save a snapshot of the index next to the item_info_cache table when we
+shutdown, and periodically while the index changes.  On the next startup, we
+load the snapshot, so searches work right away instead of having to wait for
+the index to be rebuilt.
+
+The snapshot is allowed to be missing items, since we index any items that
+aren't in it, and to have extra items, since we drop items that aren't in
+the database.  But it can't have out of date search terms.  When an item
+changes, we delete the snapshot until the next save.  The delete runs in
+the same transaction as the item change, so if Miro crashes, we never trust
+a snapshot that's out of date.
+"""
+
+import itertools
+import logging
+import threading
+
+from miro import app
+from miro import eventloop
+from miro import search
+
+class SearchIndex(object):
+    """Search index of all items in the database.
+
+    The backend updates the index, but the frontend searches it.  search()
+    and is_ready() can be called from any thread.  Everything else should
+    only be called from the backend thread.  The state that search() and
+    is_ready() use (searcher, _unindexed_ids and loaded) must only be
+    changed while holding lock.
+
+    load() loads the snapshot saved by save(), then indexes any items that
+    are missing from it in chunks from idle callbacks.  Until that's done,
+    is_ready() returns False and search results may be incomplete.
+    """
+
+    # how many items should we index in each idle callback?
+    INDEX_CHUNK_SIZE = 250
+    # how long to wait after the index changes before saving a snapshot
+    SAVE_INTERVAL = 300
+
+    def __init__(self):
+        self.searcher = search.ItemSearcher()
+        self.lock = threading.Lock()
+        self._unindexed_ids = set()
+        self._index_dc = None
+        self._save_dc = None
+        # does search_index_snapshot have an up to date snapshot?
+        self._snapshot_saved = False
+        self.loaded = False
+
+    def version(self):
+        return "%s-%s" % (app.item_info_cache.version(),
+                search.SNAPSHOT_FORMAT)
+
+    def load(self):
+        """Load the saved snapshot and start indexing the other items.
+
+        Call this after app.item_info_cache has been loaded.
+        """
+        app.db.cursor.execute("SELECT id FROM item")
+        item_ids = set(row[0] for row in app.db.cursor)
+        self._snapshot_saved = self._load_snapshot()
+        if not self._snapshot_saved:
+            # the snapshot is missing, out of date or corrupt
+            app.db.cursor.execute("DELETE FROM search_index_snapshot")
+        with self.lock:
+            indexed_ids = self.searcher.item_ids()
+            for id_ in indexed_ids - item_ids:
+                self.searcher.remove_item(id_)
+            self._unindexed_ids = item_ids - indexed_ids
+            self.loaded = True
+        app.item_info_cache.connect('added', self._on_item_added)
+        app.item_info_cache.connect('changed', self._on_item_changed)
+        app.item_info_cache.connect('removed', self._on_item_removed)
+        self._schedule_index_chunk()
+
+    def _load_snapshot(self):
+        """Load the saved snapshot.
+
+        :returns: True if we loaded the snapshot
+        """
+        app.db.cursor.execute("SELECT version, data "
+                "FROM search_index_snapshot")
+        row = app.db.cursor.fetchone()
+        if row is None:
+            return False
+        version, data = row
+        if version != self.version():
+            logging.info("Search index snapshot out of date, rebuilding")
+            return False
+        with self.lock:
+            try:
+                self.searcher.load_snapshot(str(data))
+            except search.SnapshotError, e:
+                logging.warn("Error loading search index snapshot: %s", e)
+                self.searcher = search.ItemSearcher()
+                return False
+        return True
+
+    def save(self):
+        """Save a snapshot of the index to the database."""
+        if self._save_dc is not None:
+            self._save_dc.cancel()
+            self._save_dc = None
+        if not self.loaded:
+            return
+        with self.lock:
+            data = self.searcher.to_snapshot()
+        with app.db.raw_transaction() as cursor:
+            cursor.execute("DELETE FROM search_index_snapshot")
+            cursor.execute("INSERT INTO search_index_snapshot "
+                    "(version, data) VALUES (?, ?)",
+                    (self.version(), buffer(data)))
+        self._snapshot_saved = True
+
+    def schedule_save(self):
+        """Save a snapshot of the index after SAVE_INTERVAL seconds."""
+        if self._save_dc is None:
+            self._save_dc = eventloop.add_timeout(self.SAVE_INTERVAL,
+                    self._save_timeout, 'save search index')
+
+    def _save_timeout(self):
+        self._save_dc = None
+        if app.search_index is not self:
+            # we've been replaced by a new SearchIndex, don't overwrite its
+            # snapshot
+            return
+        self.save()
+
+    def _invalidate_snapshot(self):
+        """Delete the saved snapshot because an item's search terms changed.
+        """
+        if self._snapshot_saved:
+            app.db.cursor.execute("DELETE FROM search_index_snapshot")
+            self._snapshot_saved = False
+        self.schedule_save()
+
+    def is_ready(self):
+        """Check if every item in the database is in the index.
+
+        This can be called from any thread.
+        """
+        with self.lock:
+            return self.loaded and not self._unindexed_ids
+
+    def search(self, search_text, ids=None):
+        """Search the index.
+
+        This can be called from any thread.
+
+        :param search_text: search_text to search with
+        :param ids: if given, only return results from this set of ids
+
+        :returns: set of ids that match the search
+        """
+        with self.lock:
+            matching_ids = self.searcher.search(search_text)
+        if ids is not None:
+            matching_ids.intersection_update(ids)
+        return matching_ids
+
+    def _schedule_index_chunk(self):
+        if self._index_dc is None and self._unindexed_ids:
+            self._index_dc = eventloop.add_idle(self._index_chunk,
+                    'build search index')
+
+    def _index_chunk(self):
+        self._index_dc = None
+        if app.search_index is not self:
+            # we've been replaced by a new SearchIndex, stop indexing
+            return
+        chunk = list(itertools.islice(self._unindexed_ids,
+            self.INDEX_CHUNK_SIZE))
+        try:
+            infos = self._get_chunk_infos(chunk)
+            with self.lock:
+                for info in infos:
+                    self.searcher.add_item(info)
+        finally:
+            # Drop the whole chunk, even if we couldn't index some of it, so
+            # that we don't keep failing on the same ids.
+            with self.lock:
+                self._unindexed_ids.difference_update(chunk)
+            self._schedule_index_chunk()
+            self.schedule_save()
+
+    def _get_chunk_infos(self, chunk):
+        """Get the ItemInfos to index for a chunk of ids.
+
+        Ids that we can't get an ItemInfo for (for example because the item
+        was removed) are skipped.
+        """
+        try:
+            infos = app.item_info_cache.get_infos(chunk)
+        except StandardError:
+            logging.warn("Error getting item infos for the search index, "
+                    "getting them one at a time", exc_info=True)
+            infos = []
+            for id_ in chunk:
+                try:
+                    infos.append(app.item_info_cache.get_info(id_))
+                except StandardError:
+                    logging.warn("Error getting item info for %s", id_,
+                            exc_info=True)
+        # calculate the search terms before grabbing the lock, so that we
+        # block searches for as little time as possible.
+        good_infos = []
+        for info in infos:
+            try:
+                info.search_terms
+            except StandardError:
+                logging.warn("Error calculating search terms for %s",
+                        info.id, exc_info=True)
+            else:
+                good_infos.append(info)
+        return good_infos
+
+    def _on_item_added(self, item_info_cache, info):
+        with self.lock:
+            self._unindexed_ids.discard(info.id)
+            self.searcher.add_item(info)
+        self.schedule_save()
+
+    def _on_item_changed(self, item_info_cache, info):
+        with self.lock:
+            self._unindexed_ids.discard(info.id)
+            if info.id in self.searcher:
+                self.searcher.update_item(info)
+            else:
+                self.searcher.add_item(info)
+        self._invalidate_snapshot()
+
+    def _on_item_removed(self, item_info_cache, info):
+        with self.lock:
+            self._unindexed_ids.discard(info.id)
+            if info.id in self.searcher:
+                self.searcher.remove_item(info.id)
+        self.schedule_save()
+
+def create_sql():
+    """Get the SQL needed to create the table for the search index snapshot.
+    """
+    return "CREATE TABLE search_index_snapshot(version TEXT, data BLOB)"
@@ -316,10 +316,11 @@ class SharingTracker(object):
                 raise IOError('test connect failed')
             client.disconnect()
 
-        eventloop.call_in_thread(success,
-                                 failure,
-                                 testconnect,
-                                 'DAAP test connect')
+        eventloop.call_in_thread_lane(eventloop.LANE_BACKGROUND,
+                                      success,
+                                      failure,
+                                      testconnect,
+                                      'DAAP test connect')
 
     def mdns_callback_backend(self, added, fullname, host, port):
         if fullname == app.sharing_manager.name:
@@ -673,10 +674,14 @@ class SharingItemTrackerImpl(signals.SignalEmitter):
     def client_disconnect(self):
         client = self.client
         self.client = None
-        eventloop.call_in_thread(self.client_disconnect_callback,
-                                 self.client_disconnect_error_callback,
-                                 client.disconnect,
-                                 'DAAP client connect')
+        # This is usually the user ejecting the share, and the tabs stay
+        # around until the callback runs, so don't queue it up behind
+        # background work.
+        eventloop.call_in_thread_lane(eventloop.LANE_INTERACTIVE,
+                                      self.client_disconnect_callback,
+                                      self.client_disconnect_error_callback,
+                                      client.disconnect,
+                                      'DAAP client connect')
 
     def client_disconnect_error_callback(self, unused):
         self.client_disconnect_callback_common(unused)
@@ -75,6 +75,7 @@ from miro import metadataprogress
 from miro import models
 from miro import moviedata
 from miro import playlist
+from miro import searchindex
 from miro import prefs
 import miro.plat.resources
 from miro.plat.utils import setup_logging
@@ -252,6 +253,9 @@ def startup():
     httpclient.start_thread()
     logging.info("Starting event loop thread")
     eventloop.startup()
+    stats_interval = app.config.get(prefs.EVENT_LOOP_STATS_INTERVAL)
+    if stats_interval > 0:
+        eventloop.log_stats_periodically(stats_interval)
     if DEBUG_DB_MEM_USAGE:
         mem_usage_test_event.wait()
     load_extensions()
@@ -289,6 +293,9 @@ def finish_startup(obj, thread):
     except storedatabase.UpgradeError:
         raise StartupError(None, None)
     database.initialize()
+    # check changed objects against the view trackers once per batch rather
+    # than once per change
+    app.view_tracker_manager.set_batch_mode(True)
     end = time.time()
     logging.timing("Database upgrade time: %.3f", end - start)
     if app.db.startup_version != app.db.current_version:
@@ -305,6 +312,8 @@ def finish_startup(obj, thread):
     app.metadata_progress_updater = metadataprogress.MetadataProgressUpdater()
     app.item_info_cache = iteminfocache.ItemInfoCache()
     app.item_info_cache.load()
+    app.search_index = searchindex.SearchIndex()
+    app.search_index.load()
     dbupgradeprogress.upgrade_end()
 
     logging.info("Loading video converters...")
@@ -416,7 +425,7 @@ def on_frontend_started():
     yield None
     feed.expire_items()
     yield None
-    moviedata.movie_data_updater.start_thread()
+    moviedata.movie_data_updater.start_threads()
     yield None
     commandline.startup()
     yield None
@@ -46,6 +46,7 @@ The hope is that it will be human readable.  We use the type
 ``pythonrepr`` to label these columns.
 """
 
+import contextlib
 import glob
 import shutil
 import cPickle
@@ -72,6 +73,7 @@ from miro import dialogs
 from miro import eventloop
 from miro import fileutil
 from miro import iteminfocache
+from miro import searchindex
 from miro import messages
 from miro import schema
 from miro import prefs
@@ -109,6 +111,11 @@ _sqlite_type_map = {
 
 VERSION_KEY = "Democracy Version"
 
+# How many prepared statements should sqlite keep around?  Each table has an
+# INSERT statement and an UPDATE statement for each combination of columns
+# that changes together, so the default of 100 is too small.
+STATEMENT_CACHE_SIZE = 500
+
 def split_values_for_sqlite(value_list):
     """Split a list of values into chunks that SQL can handle.
 
@@ -121,7 +128,7 @@ def split_values_for_sqlite(value_list):
         yield value_list[start:start+CHUNK_SIZE]
 
 
-class LiveStorage:
+class LiveStorage(object):
     """Handles the storage of DDBObjects.
 
     This class does basically two things:
@@ -159,19 +166,40 @@ class LiveStorage:
         self._schema_version = schema_version
         self._schema_map = {}
         self._schema_column_map = {}
+        # Maps schemas to the fields we load on restore and the fields that
+        # we load lazily.  See ObjectSchema.lazy_fields.
+        self._eager_fields = {}
+        self._lazy_fields = {}
         self._all_schemas = []
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
+        # ids of objects in memory whose lazy fields haven't been loaded
+        self._ids_lazy_unloaded = set()
         self._statements_in_transaction = []
+        # SQL strings for INSERT/UPDATE statements.  Keeping the SQL
+        # strings the same lets sqlite reuse its prepared statements.
+        self._statement_cache = {}
+        # UPDATEs waiting to be run.  Maps object ids to (schema, dict)
+        # tuples, where the dict maps column names to SQL values.  See
+        # _flush_pending_updates()
+        self._pending_updates = {}
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
             for klass in oschema.ddb_object_classes():
                 self._schema_map[klass] = oschema
                 for field_name, schema_item in oschema.fields:
-                    klass.track_attribute_changes(field_name)
+                    # non-simple items store mutable values (lists, dicts,
+                    # ...) that can be changed without setting them.
+                    mutable = not isinstance(schema_item,
+                            schema.SchemaSimpleItem)
+                    klass.track_attribute_changes(field_name, mutable)
             for name, schema_item in oschema.fields:
                 self._schema_column_map[oschema, name] = schema_item
+            self._eager_fields[oschema] = [f for f in oschema.fields
+                    if f[0] not in oschema.lazy_fields]
+            self._lazy_fields[oschema] = [f for f in oschema.fields
+                    if f[0] in oschema.lazy_fields]
         self._converter = SQLiteConverter()
 
         self.open_connection()
@@ -185,7 +213,8 @@ class LiveStorage:
         logging.info("opening database %s", path)
         self.connection = sqlite3.connect(path,
                 isolation_level=None,
-                detect_types=sqlite3.PARSE_DECLTYPES)
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=STATEMENT_CACHE_SIZE)
         self.cursor = self.connection.cursor()
         try:
             self.cursor.execute("PRAGMA journal_mode=PERSIST");
@@ -414,22 +443,56 @@ class LiveStorage:
                        (obj.id, obj))
             logging.error(details)
         self._ids_loaded.discard(obj.id)
+        self._ids_lazy_unloaded.discard(obj.id)
 
     def _insert_sql_for_schema(self, obj_schema):
-        return "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
+        key = ('insert', obj_schema)
+        try:
+            return self._statement_cache[key]
+        except KeyError:
+            sql = "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
                 ', '.join(name for name, schema_item in obj_schema.fields),
                 ', '.join('?' for i in xrange(len(obj_schema.fields))))
+            self._statement_cache[key] = sql
+            return sql
+
+    def _update_sql_for_schema(self, obj_schema, columns):
+        """Get the SQL to update a set of columns.
+
+        columns should be a tuple in the same order as obj_schema.fields.
+        The values for the statement are the column values followed by the
+        object id.
+        """
+        key = ('update', obj_schema, columns)
+        try:
+            return self._statement_cache[key]
+        except KeyError:
+            sql = "UPDATE %s SET %s WHERE id=?" % (obj_schema.table_name,
+                    ', '.join('%s=?' % name for name in columns))
+            self._statement_cache[key] = sql
+            return sql
+
+    def _validate_value(self, obj, name, schema_item, value):
+        try:
+            schema_item.validate(value)
+        except schema.ValidationError:
+            if util.chatter:
+                logging.warn("error validating %s for %s", name, obj)
+            raise
+
+    def _column_value(self, obj, name):
+        # Use __dict__ rather than getattr() to avoid marking mutable
+        # attributes as changed.  See MutableAttributeUpdateTracker.
+        try:
+            return obj.__dict__[name]
+        except KeyError:
+            raise AttributeError(name)
 
     def _values_for_obj(self, obj_schema, obj):
         values = []
         for name, schema_item in obj_schema.fields:
-            value = getattr(obj, name)
-            try:
-                schema_item.validate(value)
-            except schema.ValidationError:
-                if util.chatter:
-                    logging.warn("error validating %s for %s", name, obj)
-                raise
+            value = self._column_value(obj, name)
+            self._validate_value(obj, name, schema_item, value)
             values.append(self._converter.to_sql(obj_schema, name,
                 schema_item, value))
         return values
@@ -463,43 +526,137 @@ class LiveStorage:
             obj.reset_changed_attributes()
 
     def update_obj(self, obj):
-        """Update a DDBObject on disk."""
+        """Update a DDBObject on disk.
+
+        Only the columns in obj.changed_attributes get written.
+
+        The UPDATE statement doesn't get run right away.  Instead we
+        remember which columns need to be written and run all updates at
+        once when the transaction finishes or before the next statement.
+        This way if an object gets updated several times in a row, we only
+        need to write it once.
+
+        Because of this, errors from the UPDATE don't get raised here.  If
+        the object's row doesn't exist, we raise a KeyError (or a ValueError
+        if the update changed multiple rows) when the updates get run, from
+        flush_pending_updates(), finish_transaction() or the next statement.
+        The error message includes the object's id and schema.
+        """
 
         obj_schema = self._schema_map[obj.__class__]
-        setters = []
-        values = []
+        try:
+            sql_values = self._pending_updates[obj.id][1]
+        except KeyError:
+            sql_values = {}
+        changed_attributes = obj.changed_attributes
         for name, schema_item in obj_schema.fields:
-            if (isinstance(schema_item, schema.SchemaSimpleItem) and
-                    name not in obj.changed_attributes):
+            if name not in changed_attributes:
                 continue
-            setters.append('%s=?' % name)
-            value = getattr(obj, name)
-            try:
-                schema_item.validate(value)
-            except schema.ValidationError:
-                if util.chatter:
-                    logging.warn("error validating %s for %s", name, obj)
-                raise
-            values.append(self._converter.to_sql(obj_schema, name,
-                schema_item, value))
+            value = self._column_value(obj, name)
+            self._validate_value(obj, name, schema_item, value)
+            # convert the value now, so that later changes to mutable
+            # values don't sneak into the UPDATE without being validated
+            sql_values[name] = self._converter.to_sql(obj_schema, name,
+                    schema_item, value)
         obj.reset_changed_attributes()
-        if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
-            self._execute(sql, values, is_update=True)
-            if (self.cursor.rowcount != 1 and not
-                    self._quitting_from_operational_error):
-                if self.cursor.rowcount == 0:
-                    raise KeyError("Updating non-existent row (id: %s)" %
-                            obj.id)
-                else:
-                    raise ValueError("Update changed multiple rows "
-                            "(id: %s, count: %s)" %
-                            (obj.id, self.cursor.rowcount))
+        if sql_values:
+            self._pending_updates[obj.id] = (obj_schema, sql_values)
+
+    def flush_pending_updates(self):
+        """Run any UPDATE statements queued up by update_obj().
+
+        Code that runs SQL directly on our cursor should call this first if
+        it needs to see the current data.
+        """
+        if self._pending_updates:
+            self._flush_pending_updates()
+
+    def _flush_pending_updates(self):
+        """Run the UPDATE statements queued up by update_obj().
+
+        Updates that change the same columns get run together using
+        executemany().
+
+        Throws a KeyError if we try to update a row that doesn't exist and a
+        ValueError if an update changes multiple rows.  We run all the other
+        updates before raising the error.
+        """
+        pending_updates = self._pending_updates
+        self._pending_updates = {}
+        statements = {}
+        for obj_id, (obj_schema, sql_values) in pending_updates.iteritems():
+            columns = tuple(name for name, schema_item in obj_schema.fields
+                    if name in sql_values)
+            values = [sql_values[name] for name in columns]
+            values.append(obj_id)
+            sql = self._update_sql_for_schema(obj_schema, columns)
+            statements.setdefault(sql, (obj_schema, []))[1].append(values)
+        error = None
+        for sql, (obj_schema, value_list) in statements.items():
+            if len(value_list) == 1:
+                self._execute(sql, value_list[0], is_update=True)
+            else:
+                self._execute(sql, value_list, is_update=True, many=True)
+            if (self.cursor.rowcount != len(value_list) and not
+                    self._quitting_from_operational_error and
+                    error is None):
+                error = self._update_error(obj_schema,
+                        [values[-1] for values in value_list])
+        if error is not None:
+            raise error
+
+    def _update_error(self, obj_schema, ids):
+        """Build the exception for UPDATEs that didn't change 1 row each.
+
+        executemany() only tells us the total row count, so we check which
+        of the objects are missing their rows.
+        """
+        rowcount = self.cursor.rowcount
+        existing_ids = set()
+        for ids_chunk in split_values_for_sqlite(ids):
+            self.cursor.execute("SELECT id FROM %s WHERE id IN (%s)" %
+                    (obj_schema.table_name,
+                        ', '.join('?' for i in xrange(len(ids_chunk)))),
+                    ids_chunk)
+            existing_ids.update(row[0] for row in self.cursor)
+        missing_ids = [id_ for id_ in ids if id_ not in existing_ids]
+        if missing_ids:
+            return KeyError("Updating non-existent row (schema: %s, "
+                    "ids: %s)" % (obj_schema.__name__, missing_ids))
+        else:
+            return ValueError("Update changed multiple rows (schema: %s, "
+                    "ids: %s, count: %s)" % (obj_schema.__name__, ids,
+                        rowcount))
+
+    @contextlib.contextmanager
+    def raw_transaction(self):
+        """Context manager for code that runs SQL directly on our cursor.
+
+        Pending updates get flushed first and the statements run inside a
+        savepoint, so this works whether or not we're already in the middle
+        of a transaction.  If the block raises an exception, its changes
+        get rolled back.
+        """
+        self.flush_pending_updates()
+        self.cursor.execute("SAVEPOINT raw_transaction")
+        try:
+            yield self.cursor
+        except StandardError:
+            self.cursor.execute("ROLLBACK TO raw_transaction")
+            self.cursor.execute("RELEASE raw_transaction")
+            raise
+        else:
+            self.cursor.execute("RELEASE raw_transaction")
 
     def remove_obj(self, obj):
-        """Remove a DDBObject from disk."""
+        """Remove a DDBObject from disk.
 
+        If the object hasn't loaded its lazy fields, we load them first, so
+        that they can still be read once the row is gone.
+        """
+
+        self._pending_updates.pop(obj.id, None)
+        self.load_lazy_fields(obj)
         schema = self._schema_map[obj.__class__]
         sql = "DELETE FROM %s WHERE id=?" % (schema.table_name)
         self._execute(sql, (obj.id,), is_update=True)
@@ -509,7 +666,8 @@ class LiveStorage:
         """Remove a list of objects in one go.
 
         Throws a ValueError if the objects don't all use the same database
-        table.
+        table.  Like remove_obj(), we load any lazy fields that the objects
+        haven't loaded yet before removing them.
         """
 
         if len(objects) == 0:
@@ -518,6 +676,12 @@ class LiveStorage:
         for obj in objects:
             if obj_schema != self._schema_map[obj.__class__]:
                 raise ValueError("Incompatible types for bulk remove")
+            self._pending_updates.pop(obj.id, None)
+        lazy_ids = self._ids_lazy_unloaded.intersection(
+                obj.id for obj in objects)
+        if lazy_ids:
+            self._load_lazy_fields(obj_schema, lazy_ids,
+                    dict((obj.id, obj) for obj in objects))
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
         for objects_chunk in split_values_for_sqlite(objects):
@@ -563,6 +727,16 @@ class LiveStorage:
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
+    def get_schema_item(self, table_name, column_name):
+        """Get the SchemaItem for a column.
+
+        Throws a KeyError if there is no such table or column.
+        """
+        for oschema in self._all_schemas:
+            if oschema.table_name == table_name:
+                return self._schema_column_map[oschema, column_name]
+        raise KeyError(table_name)
+
     def _get_query_bottom(self, table_name, where, joins, order_by, limit):
         sql = StringIO()
         sql.write("FROM %s\n" % table_name)
@@ -590,31 +764,80 @@ class LiveStorage:
         for id_ in id_list:
             yield self._object_map[id_]
 
-    def ensure_objects_loaded(self, klass, id_list):
+    def ensure_objects_loaded(self, klass, id_list, load_lazy=False):
         """Ensure that a list of ids are loaded into memory.
 
+        :param load_lazy: also load the objects' lazy fields.  This is much
+            faster than loading them one object at a time if the caller is
+            going to access them for most of the objects.
+
         :returns: True iff we needed to load objects
         """
+        schema = self._schema_map[klass]
         unrestored_ids = set(id_list).difference(self._ids_loaded)
+        if load_lazy and self._lazy_fields[schema]:
+            lazy_ids = self._ids_lazy_unloaded.intersection(id_list)
+            if lazy_ids:
+                self._load_lazy_fields(schema, lazy_ids)
         if unrestored_ids:
             # restore any objects that we don't already have in memory.
-            schema = self._schema_map[klass]
-            self._restore_objects(schema, unrestored_ids)
+            self._restore_objects(schema, unrestored_ids, load_lazy)
             return True
         return False
 
+    def load_lazy_fields(self, obj):
+        """Load the lazy fields for an object.
+
+        This gets called by DDBObject when an attribute is missing.
+
+        :returns: True iff we needed to load fields
+        """
+        if obj.id not in self._ids_lazy_unloaded:
+            return False
+        self._load_lazy_fields(self._schema_map[obj.__class__], (obj.id,),
+                {obj.id: obj})
+        return True
+
+    def _load_lazy_fields(self, schema, id_set, obj_map=None):
+        if obj_map is None:
+            obj_map = self._object_map
+        fields = self._lazy_fields[schema]
+        column_names = ['id'] + [f[0] for f in fields]
+        id_list = tuple(id_set)
+        for id_list_chunk in split_values_for_sqlite(id_list):
+            sql = "SELECT %s FROM %s WHERE id IN (%s)" % (
+                    ', '.join(column_names), schema.table_name,
+                    ', '.join('?' for i in xrange(len(id_list_chunk))))
+            self.cursor.execute(sql, id_list_chunk)
+            for row in self.cursor.fetchall():
+                obj = obj_map.get(row[0])
+                if obj is None:
+                    continue
+                lazy_data = self._convert_row(schema, fields, row[1:],
+                        row[0])
+                # don't overwrite fields that were set before we loaded them
+                for name, value in lazy_data.iteritems():
+                    obj.__dict__.setdefault(name, value)
+        self._ids_lazy_unloaded.difference_update(id_list)
+
     def query_ids(self, table_name, where, values=None, order_by=None,
             joins=None, limit=None):
         sql = StringIO()
         sql.write("SELECT %s.id " % table_name)
         sql.write(self._get_query_bottom(table_name, where, joins,
             order_by, limit))
+        # make sure the query sees updates that we haven't run yet
+        self.flush_pending_updates()
         self.cursor.execute(sql.getvalue(), values)
         return (row[0] for row in self.cursor.fetchall())
 
-    def _restore_objects(self, schema, id_set):
+    def _restore_objects(self, schema, id_set, load_lazy=False):
+        if load_lazy:
+            fields = schema.fields
+        else:
+            fields = self._eager_fields[schema]
         column_names = ['%s.%s' % (schema.table_name, f[0])
-                for f in schema.fields]
+                for f in fields]
 
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
@@ -627,14 +850,29 @@ class LiveStorage:
 
             self.cursor.execute(sql.getvalue(), id_list_chunk)
             for row in self.cursor.fetchall():
-                self._restore_object_from_row(schema, row)
+                self._restore_object_from_row(schema, fields, row)
+
+    def _restore_object_from_row(self, schema, fields, db_row):
+        restored_data = self._convert_row(schema, fields, db_row)
+        if len(fields) < len(schema.fields):
+            self._ids_lazy_unloaded.add(restored_data['id'])
+        klass = schema.get_ddb_class(restored_data)
+        return klass(restored_data=restored_data)
+
+    def _convert_row(self, schema, fields, db_row, id_=None):
+        """Convert values from a database row to python values.
 
-    def _restore_object_from_row(self, schema, db_row):
+        If we use a malformed data handler for any value, the value stored
+        in the database gets updated.
+
+        :param fields: list of (name, schema_item) pairs for db_row
+        :param id_: object id, if it's not one of the fields in db_row
+        """
         restored_data = {}
         columns_to_update = []
         values_to_update = []
         for (name, schema_item), value in \
-                itertools.izip(schema.fields, db_row):
+                itertools.izip(fields, db_row):
             try:
                 value = self._converter.from_sql(schema, name, schema_item,
                         value)
@@ -658,12 +896,13 @@ class LiveStorage:
         if columns_to_update:
             # We are using some values that are different than what's stored
             # in disk.  Update the database to make things match.
+            if id_ is None:
+                id_ = restored_data['id']
             setters = ['%s=?' % c for c in columns_to_update]
             sql = "UPDATE %s SET %s WHERE id=%s" % (schema.table_name,
-                    ', '.join(setters), restored_data['id'])
+                    ', '.join(setters), id_)
             self._execute(sql, values_to_update)
-        klass = schema.get_ddb_class(restored_data)
-        return klass(restored_data=restored_data)
+        return restored_data
 
     def persistent_object_count(self):
         return len(self._object_map)
@@ -709,6 +948,15 @@ class LiveStorage:
         self.finish_transaction(commit=success)
 
     def finish_transaction(self, commit=True):
+        try:
+            if commit:
+                self.flush_pending_updates()
+            else:
+                self._pending_updates = {}
+        finally:
+            self._end_transaction(commit)
+
+    def _end_transaction(self, commit):
         if len(self._statements_in_transaction) == 0:
             return
         if not self._quitting_from_operational_error:
@@ -723,6 +971,11 @@ class LiveStorage:
             # We want to avoid updating the database at this point.
             return
 
+        if self._pending_updates:
+            # run any queued up updates first so that the statement sees
+            # the current data
+            self._flush_pending_updates()
+
         if is_update and len(self._statements_in_transaction) == 0:
             self.cursor.execute("BEGIN TRANSACTION")
 
@@ -874,6 +1127,7 @@ class LiveStorage:
                         (name, schema.table_name, ', '.join(columns)))
         self._create_variables_table()
         self.cursor.execute(iteminfocache.create_sql())
+        self.cursor.execute(searchindex.create_sql())
         self._set_version()
 
     def _get_version(self):
@@ -903,6 +1157,8 @@ class LiveStorage:
         """Saves the current database then starts fresh with an empty
         database.
         """
+        self._pending_updates = {}
+        self._ids_lazy_unloaded = set()
         self.connection.close()
         self.save_invalid_db()
         self.open_connection()
@@ -46,6 +46,7 @@ import subprocess
 import sys
 import threading
 import warnings
+import zlib
 import Queue
 
 from miro import app
@@ -68,8 +69,19 @@ def _on_windows():
 # ** Protocol between miro and subprocesses **
 #
 # We spawn a child process and communicate to it by sending messages through
-# it's stdin and stdout.  Each message contains a length (a unsigned long)
-# followed by a pickled object.
+# it's stdin and stdout.  Each message is sent as a frame: a header with the
+# payload length (4 byte unsigned int) and a flags byte, followed by the
+# payload.  The payload is the object pickled with the highest pickle
+# protocol.  If FRAME_COMPRESSED is set in the flags, the payload is also
+# zlib compressed.  We only compress payloads larger than COMPRESS_THRESHOLD,
+# and only if it makes them smaller.
+#
+# Messages are buffered by a FrameWriter and written out together when it's
+# flushed.  In the main process we flush once the current eventloop callback
+# is done.  In the subprocess we flush when there are no more incoming
+# messages to handle.  We also start a timer when a response gets buffered, so
+# that responses never wait more than MAX_RESPONSE_DELAY seconds, even if a
+# handler takes a long time.
 #
 # The communication goes like this:
 #
@@ -212,7 +224,19 @@ class SubprocessResponder(messagetools.MessageHandler):
 class LoadError(StandardError):
     """Exception for corrupt data when reading from a pipe."""
 
-SIZEOF_LONG = struct.calcsize("L")
+# frame header: payload length and flags
+FRAME_HEADER = struct.Struct("!IB")
+# flags for the frame header
+FRAME_COMPRESSED = 1 << 0
+# payloads larger than this many bytes are compressed.  Compressing is much
+# slower than just writing the data to a local pipe, so this is set high
+# enough that only truly huge messages get compressed.
+COMPRESS_THRESHOLD = 1024 * 1024
+# FrameWriter flushes automatically once it buffers this many bytes
+MAX_BUFFER_SIZE = 1024 * 1024
+# The subprocess sends responses at most this many seconds after they're
+# buffered, even while it's busy handling messages
+MAX_RESPONSE_DELAY = 0.1
 
 def _read_bytes_from_pipe(pipe, length):
     """Read size bytes from a pipe.
@@ -233,6 +257,21 @@ def _read_bytes_from_pipe(pipe, length):
         data.append(d)
     return ''.join(data)
 
+def _encode_obj(obj):
+    """Convert an object to a frame to send over a pipe.
+
+    :raises pickle.PickleError: obj could not be pickled
+    :returns: string containing the frame header and payload
+    """
+    payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    flags = 0
+    if len(payload) > COMPRESS_THRESHOLD:
+        compressed = zlib.compress(payload, 1)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= FRAME_COMPRESSED
+    return FRAME_HEADER.pack(len(payload), flags) + payload
+
 def _load_obj(pipe):
     """Load an object from one side of a pipe.
 
@@ -243,17 +282,22 @@ def _load_obj(pipe):
 
     :returns: Python object send from the other side
     """
-    size_data = _read_bytes_from_pipe(pipe, SIZEOF_LONG)
-    if len(size_data) < SIZEOF_LONG:
-        raise LoadError("EOF reached while reading size field "
-                "(read %s bytes)" % len(size_data))
-    size = struct.unpack("L", size_data)[0]
-    pickle_data = _read_bytes_from_pipe(pipe, size)
-    if len(pickle_data) < size:
+    header = _read_bytes_from_pipe(pipe, FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        raise LoadError("EOF reached while reading frame header "
+                "(read %s bytes)" % len(header))
+    size, flags = FRAME_HEADER.unpack(header)
+    payload = _read_bytes_from_pipe(pipe, size)
+    if len(payload) < size:
         raise LoadError("EOF reached while reading pickle data "
-                "(read %s bytes)" % len(pickle_data))
+                "(read %s bytes)" % len(payload))
+    if flags & FRAME_COMPRESSED:
+        try:
+            payload = zlib.decompress(payload)
+        except zlib.error, e:
+            raise LoadError("Compressed data corrupt: %s" % e)
     try:
-        return pickle.loads(pickle_data)
+        return pickle.loads(payload)
     except pickle.PickleError:
         raise LoadError("Pickle data corrupt")
     except ImportError:
@@ -263,24 +307,68 @@ def _load_obj(pipe):
         _send_subprocess_error_for_exception()
         raise LoadError("Unknown error in pickle.loads: %s" % e)
 
-def _dump_obj(obj, pipe):
-    """Dump an object to the other side of the pipe.
+class FrameWriter(object):
+    """Buffers objects and writes them to a pipe in a single write.
 
-    :raises IOError: low-level error while writing to the pipe
-    :raises pickle.PickleError: obj could not be pickled
+    Objects are pickled as soon as they are added, so later changes to them
+    don't affect what gets sent and pickle errors are raised to the caller
+    of add().
+
+    FrameWriter is thread safe.  In the subprocess, the thread reading stdin
+    can send error messages while the main thread is sending responses.
     """
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.frames = []
+        self.buffer_size = 0
+        self.lock = threading.RLock()
 
-    pickle_data = pickle.dumps(obj)
-    size_data = struct.pack("L", len(pickle_data))
-    # NOTE: We do a blocking write here.  This should be fine, since on both
-    # sides we have a thread dedicated to just reading from the pipe and
-    # pushing the data into a Queue.  However, there's some chance that the
-    # process on the other side has gone really haywire and the reader thread
-    # is hung.  I (BDK) can't really see a way for this to realistically
-    # happen, so we stick with blocking writes.
-    pipe.write(size_data)
-    pipe.write(pickle_data)
-    pipe.flush()
+    def add(self, obj):
+        """Add an object to the buffer.
+
+        If the buffer gets too large, we flush it.
+
+        :raises IOError: low-level error while writing to the pipe
+        :raises pickle.PickleError: obj could not be pickled
+        """
+        frame = _encode_obj(obj)
+        with self.lock:
+            self.frames.append(frame)
+            self.buffer_size += len(frame)
+            if self.buffer_size >= MAX_BUFFER_SIZE:
+                self.flush()
+
+    def has_pending(self):
+        with self.lock:
+            return len(self.frames) > 0
+
+    def clear(self):
+        with self.lock:
+            self.frames = []
+            self.buffer_size = 0
+
+    def flush(self):
+        """Write all buffered objects to the pipe.
+
+        :raises IOError: low-level error while writing to the pipe
+        """
+        with self.lock:
+            if not self.frames:
+                return
+            data = ''.join(self.frames)
+            self.clear()
+            # NOTE: We do a blocking write here.  This should be fine, since
+            # on both sides we have a thread dedicated to just reading from
+            # the pipe and pushing the data into a Queue.  However, there's
+            # some chance that the process on the other side has gone really
+            # haywire and the reader thread is hung.  I (BDK) can't really see
+            # a way for this to realistically happen, so we stick with
+            # blocking writes.
+            #
+            # We hold the lock while writing so that data from different
+            # flush() calls can't get interleaved.
+            self.pipe.write(data)
+            self.pipe.flush()
 
 class SubprocessManager(object):
     """Manages a running subprocess
@@ -297,7 +385,10 @@ class SubprocessManager(object):
         up.
 
         We will install a MessageHandler for message_base_class that sends
-        them to the subprocess.
+        them to the subprocess.  If message_base_class is None, we don't
+        install a handler and messages need to be sent with send_message().
+        This is useful when several SubprocessManagers handle the same type
+        of messages.
 
         responder will receive callbacks when the subprocess sends messages.
 
@@ -306,13 +397,16 @@ class SubprocessManager(object):
         """
         if handler_args is None:
             handler_args = ()
-        message_base_class.install_handler(self)
+        if message_base_class is not None:
+            message_base_class.install_handler(self)
         self.responder = responder
         self.handler_class = handler_class
         self.handler_args = handler_args
         self.is_running = False
         self.process = None
         self.thread = None
+        self.writer = None
+        self._flush_scheduled = False
 
     # Process management
 
@@ -327,6 +421,7 @@ class SubprocessManager(object):
         """Does the work to startup a new process/thread."""
         # create our child process.
         self.process = self._start_subprocess()
+        self.writer = FrameWriter(self.process.stdin)
         # create thread to handle the subprocess's output.  It would be nice
         # to eliminate this thread, but I don't see an easy way to integrate
         # it into the eventloop, since windows doesn't have support for
@@ -421,28 +516,57 @@ class SubprocessManager(object):
 
         self.thread = None
         self.process = None
+        self.writer = None
         self.is_running = False
 
     # Handle communication to our child process
 
     def send_message(self, msg):
-        """Send a message to our subprocess """
+        """Send a message to our subprocess
+
+        Messages are buffered and written to the pipe together after the
+        current eventloop callback finishes.  Use flush_messages() to send
+        them right away.
+        """
 
         if not self.is_running:
             raise ValueError("subprocess not running")
         try:
-            _dump_obj(msg, self.process.stdin)
+            self.writer.add(msg)
         except IOError:
-            logging.warn("Broken pipe in send_message()")
-            # we could try to restart our subprocess here, but if the pipe is
-            # really broken, then our thread will quit soon and this will
-            # cause a restart.
+            self._on_broken_pipe()
         except pickle.PickleError:
             logging.warn("Error pickling message in send_message() (%s)", msg)
+            return
+        if not self._flush_scheduled and self.writer.has_pending():
+            self._flush_scheduled = True
+            eventloop.add_urgent_call(self._scheduled_flush,
+                    'flush subprocess messages')
+
+    def _scheduled_flush(self):
+        self._flush_scheduled = False
+        self.flush_messages()
+
+    def flush_messages(self):
+        """Write all buffered messages to the subprocess."""
+        if not self.is_running:
+            return
+        try:
+            self.writer.flush()
+        except IOError:
+            self._on_broken_pipe()
+
+    def _on_broken_pipe(self):
+        logging.warn("Broken pipe in send_message()")
+        self.writer.clear()
+        # we could try to restart our subprocess here, but if the pipe is
+        # really broken, then our thread will quit soon and this will
+        # cause a restart.
 
     def send_quit(self):
         """Ask the subprocess to shutdown."""
         self.send_message(None)
+        self.flush_messages()
 
     def _send_startup_info(self):
         self.send_message(StartupInfo(self._get_config_dict()))
@@ -540,14 +664,17 @@ def subprocess_main():
     stdin = sys.stdin
     stdout = sys.stdout
     sys.stdout = sys.stdin = None
+    # setup MessageHandler for messages going to the main process
+    msg_handler = PipeMessageProxy(stdout)
+    SubprocessResponse.install_handler(msg_handler)
     # initialize things
     try:
-        handler = _subprocess_setup(stdin, stdout)
+        handler = _subprocess_setup(stdin)
     except Exception, e:
         # error reading our initial messages.  Try to log a warning, then
         # quit.
         _send_subprocess_error_for_exception()
-        _finish_subprocess_message_stream(stdout)
+        _finish_subprocess_message_stream(msg_handler)
         raise # reraise so that miro_helper.py returns a non-zero exit code
     # startup thread to process stdin
     queue = Queue.Queue()
@@ -558,29 +685,39 @@ def subprocess_main():
     # run our message loop
     handler.on_startup()
     try:
-        while True:
-            msg = queue.get()
-            if msg is None:
-                break
-            handler.handle(msg)
+        _subprocess_message_loop(handler, queue, msg_handler)
     finally:
         handler.on_shutdown()
         # send None to signal that we are about to quit
-        _finish_subprocess_message_stream(stdout)
+        _finish_subprocess_message_stream(msg_handler)
         # exceptions will continue on here, which causes miro_helper.py
         # to return a non-zero exit code
 
-def _finish_subprocess_message_stream(stdout):
+def _subprocess_message_loop(handler, queue, msg_handler):
+    """Handle messages from queue until we get None."""
+    while True:
+        # send our responses before we wait for more messages.  If we're
+        # busy with a long run of messages, msg_handler's flush timer sends
+        # them, so the main process isn't left waiting.
+        if queue.empty():
+            msg_handler.flush()
+        msg = queue.get()
+        if msg is None:
+            break
+        handler.handle(msg)
+
+def _finish_subprocess_message_stream(msg_handler):
     """Signal that we are done sending messages in the subprocess."""
     try:
-        _dump_obj(None, stdout)
+        msg_handler.handle(None)
+        msg_handler.flush()
     except IOError:
         # just ignore since we're done writing out anyways
         pass
     # Note we don't catch PickleError, but there should never be an issue
     # pickling None
 
-def _subprocess_setup(stdin, stdout):
+def _subprocess_setup(stdin):
     """Does initial setup for a subprocess.
 
     Returns a SubprocessHandler to use for the subprocess
@@ -592,9 +729,6 @@ def _subprocess_setup(stdin, stdout):
     """
     # disable warnings so we don't get too much junk on stderr
     warnings.filterwarnings("ignore")
-    # setup MessageHandler for messages going to the main process
-    msg_handler = PipeMessageProxy(stdout)
-    SubprocessResponse.install_handler(msg_handler)
     # load startup info
     msg = _load_obj(stdin)
     if not isinstance(msg, StartupInfo):
@@ -636,16 +770,51 @@ class PipeMessageProxy(object):
     """Handles messages by writing them to a pipe
 
     This is used in the subprocess to send messages back to the main process
-    over it's stdout pipe.
+    over it's stdout pipe.  Messages are buffered until flush() is called, or
+    until they've waited MAX_RESPONSE_DELAY seconds.  The flush timer runs in
+    its own thread, so it works while a handler is busy.
     """
     def __init__(self, fileobj):
         self.fileobj = fileobj
+        self.writer = FrameWriter(fileobj)
+        self.timer_lock = threading.Lock()
+        self.flush_timer = None
+
+    def flush(self):
+        self._cancel_flush_timer()
+        self.writer.flush()
 
     def handle(self, msg):
         try:
-            _dump_obj(msg, self.fileobj)
+            self.writer.add(msg)
         except pickle.PickleError:
             _send_subprocess_error_for_exception()
+        else:
+            self._start_flush_timer()
         # NOTE: we don't handle IOError here because what can we do about
         # that?  Just let it propagate up to the top and which should cause us
         # to shutdown.
+
+    def _start_flush_timer(self):
+        with self.timer_lock:
+            if self.flush_timer is None:
+                self.flush_timer = threading.Timer(MAX_RESPONSE_DELAY,
+                        self._on_flush_timer)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def _cancel_flush_timer(self):
+        with self.timer_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+    def _on_flush_timer(self):
+        with self.timer_lock:
+            self.flush_timer = None
+        try:
+            self.writer.flush()
+        except IOError:
+            # The main thread will get the same error the next time it
+            # flushes, let it handle it.
+            pass
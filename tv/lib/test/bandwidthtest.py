@@ -0,0 +1,207 @@
+from miro.dl_daemon import bandwidth
+
+from miro.test.framework import MiroTestCase
+
+KB = 1024
+
+class FakeStats(object):
+    def __init__(self):
+        self.downloaded = 0
+
+class FakeClient(object):
+    def __init__(self):
+        self.stats = FakeStats()
+        self.max_recv_speed = None
+        self.paused = False
+        self.set_speed_count = 0
+
+    def get_stats(self):
+        return self.stats
+
+    def set_max_recv_speed(self, max_recv_speed):
+        self.max_recv_speed = max_recv_speed
+        self.set_speed_count += 1
+
+    def set_recv_paused(self, paused):
+        self.paused = paused
+
+    def receive(self, amount):
+        self.stats.downloaded += amount
+
+class FakeDownload(object):
+    def __init__(self, client_count=1):
+        self.clients = [FakeClient() for i in xrange(client_count)]
+
+    def get_http_clients(self):
+        return self.clients
+
+    def receive(self, amount):
+        for client in self.clients:
+            client.receive(amount / len(self.clients))
+
+    def total_limit(self):
+        return sum(client.max_recv_speed for client in self.clients)
+
+class TokenBucketTest(MiroTestCase):
+    def test_refill(self):
+        bucket = bandwidth.TokenBucket(100, 200, 0)
+        bucket.consume(200, 0)
+        self.assertEquals(bucket.tokens, 0)
+        bucket.refill(1)
+        self.assertEquals(bucket.tokens, 100)
+        # tokens shouldn't go over burst
+        bucket.refill(10)
+        self.assertEquals(bucket.tokens, 200)
+
+    def test_deficit(self):
+        bucket = bandwidth.TokenBucket(100, 200, 0)
+        self.assertEquals(bucket.deficit_time(), 0)
+        bucket.consume(250, 0)
+        self.assertEquals(bucket.deficit_time(), 0.5)
+        bucket.refill(0.5)
+        self.assertEquals(bucket.deficit_time(), 0)
+
+class FairSharesTest(MiroTestCase):
+    def test_equal(self):
+        shares = bandwidth.fair_shares(300, {'a': None, 'b': None, 'c': None})
+        self.assertEquals(shares, {'a': 100, 'b': 100, 'c': 100})
+
+    def test_small_demands(self):
+        # a can only use 50, so b and c split the rest
+        shares = bandwidth.fair_shares(300, {'a': 50, 'b': None, 'c': 500})
+        self.assertEquals(shares, {'a': 50, 'b': 125, 'c': 125})
+
+    def test_all_satisfied(self):
+        shares = bandwidth.fair_shares(300, {'a': 50, 'b': 60})
+        self.assertEquals(shares, {'a': 50, 'b': 60})
+
+    def test_empty(self):
+        self.assertEquals(bandwidth.fair_shares(300, {}), {})
+
+class BandwidthManagerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.manager = bandwidth.BandwidthManager()
+
+    def test_no_limits(self):
+        download = FakeDownload()
+        self.manager.update([download], now=0)
+        self.assertEquals(download.clients[0].max_recv_speed, None)
+        self.assertEquals(download.clients[0].set_speed_count, 0)
+
+    def test_total_limit(self):
+        self.manager.set_limits(1000 * KB, None)
+        budget = self.manager.download_budget()
+        # we should hold back some bandwidth for interactive traffic
+        self.assertEquals(budget, 900 * KB)
+        downloads = [FakeDownload(), FakeDownload()]
+        self.manager.update(downloads, now=0)
+        for download in downloads:
+            self.assertEquals(download.total_limit(), 450 * KB)
+
+    def test_min_reserve(self):
+        self.manager.set_limits(40 * KB, None)
+        self.assertEquals(self.manager.download_budget(),
+                (40 - bandwidth.MIN_RESERVE / KB) * KB)
+
+    def test_download_limit(self):
+        self.manager.set_limits(None, 100 * KB)
+        downloads = [FakeDownload(), FakeDownload(2)]
+        self.manager.update(downloads, now=0)
+        for download in downloads:
+            self.assertEquals(download.total_limit(), 100 * KB)
+        # segments should split the limit for their download
+        self.assertEquals(downloads[1].clients[0].max_recv_speed, 50 * KB)
+
+    def test_download_limit_and_total_limit(self):
+        self.manager.set_limits(1000 * KB, 100 * KB)
+        downloads = [FakeDownload(), FakeDownload()]
+        self.manager.update(downloads, now=0)
+        for download in downloads:
+            self.assertEquals(download.total_limit(), 100 * KB)
+
+    def test_underused_share(self):
+        self.manager.set_limits(1000 * KB, None)
+        slow = FakeDownload()
+        fast = FakeDownload()
+        self.manager.update([slow, fast], now=0)
+        # slow only gets 50KB/s, even though its share is 450KB/s.  Fast
+        # uses all of its share.
+        slow.receive(50 * KB)
+        fast.receive(450 * KB)
+        self.manager.update([slow, fast], now=1)
+        self.assertEquals(slow.total_limit(), 75 * KB)
+        self.assertEquals(fast.total_limit(), 825 * KB)
+
+    def test_pause_over_limit(self):
+        self.manager.set_limits(1000 * KB, None)
+        download = FakeDownload()
+        self.manager.update([download], now=0)
+        # receive way more than the limit allows
+        download.receive(3000 * KB)
+        self.manager.update([download], now=1)
+        self.assert_(download.clients[0].paused)
+        # once the bucket refills, we should unpause
+        self.manager.update([download], now=5)
+        self.assert_(not download.clients[0].paused)
+
+    def test_remove_limits(self):
+        self.manager.set_limits(1000 * KB, None)
+        download = FakeDownload()
+        self.manager.update([download], now=0)
+        self.assertNotEquals(download.clients[0].max_recv_speed, None)
+        self.manager.set_limits(None, None)
+        self.manager.update([download], now=1)
+        self.assertEquals(download.clients[0].max_recv_speed, None)
+
+    def test_only_send_changes(self):
+        self.manager.set_limits(1000 * KB, None)
+        download = FakeDownload()
+        self.manager.update([download], now=0)
+        download.receive(900 * KB)
+        self.manager.update([download], now=1)
+        self.assertEquals(download.clients[0].set_speed_count, 1)
+
+class BandwidthSchedulingTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.manager = bandwidth.BandwidthManager()
+        self.downloads = [FakeDownload()]
+        self.manager.get_downloads = lambda: self.downloads
+
+    def tearDown(self):
+        self.manager.cancel_update()
+        MiroTestCase.tearDown(self)
+
+    def test_no_updates_without_limits(self):
+        self.manager.schedule_update()
+        self.assertEquals(self.manager.update_dc, None)
+        self.manager.download_started()
+        self.assertEquals(self.manager.update_dc, None)
+
+    def test_no_updates_without_downloads(self):
+        self.manager.set_limits(1000 * KB, None)
+        self.downloads = []
+        self.manager.schedule_update()
+        self.assertEquals(self.manager.update_dc, None)
+
+    def test_updates_while_downloading(self):
+        self.manager.set_limits(1000 * KB, None)
+        self.manager.schedule_update()
+        self.assertNotEquals(self.manager.update_dc, None)
+        self.manager.do_update()
+        self.assertNotEquals(self.manager.update_dc, None)
+        # once the downloads finish, we should stop updating
+        self.downloads = []
+        self.manager.do_update()
+        self.assertEquals(self.manager.update_dc, None)
+        self.assertEquals(self.manager.last_update, None)
+
+    def test_download_started(self):
+        self.manager.set_limits(1000 * KB, None)
+        self.downloads = []
+        self.manager.schedule_update()
+        self.assertEquals(self.manager.update_dc, None)
+        self.downloads = [FakeDownload()]
+        self.manager.download_started()
+        self.assertNotEquals(self.manager.update_dc, None)
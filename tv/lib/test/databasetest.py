@@ -146,6 +146,55 @@ class ViewTrackerTest(DatabaseTestCase):
         self.assertEquals(self.remove_callbacks, [self.i2])
         self.assertEquals(self.change_callbacks, [self.i1])
 
+    def test_batch_mode(self):
+        app.view_tracker_manager.set_batch_mode(True)
+        self.feed2.set_title(u"booya")
+        self.feed.revert_title()
+        # nothing should happen until the batch is processed
+        self.assertEquals(self.add_callbacks, [])
+        self.assertEquals(self.remove_callbacks, [])
+        self.assertEquals(self.change_callbacks, [])
+        app.view_tracker_manager.process_pending_changes()
+        self.assertEquals(self.add_callbacks, [self.feed2])
+        self.assertEquals(self.remove_callbacks, [self.feed])
+        self.assertEquals(self.change_callbacks, [])
+        # changing an object multiple times should only result in 1 check
+        self.feed2.set_title(u"booya2")
+        self.feed2.set_title(u"booya3")
+        app.view_tracker_manager.set_batch_mode(False)
+        self.assertEquals(self.change_callbacks, [self.feed2])
+
+    def test_batch_mode_bulk_signals(self):
+        bulk_added = []
+        self.tracker.set_bulk_mode(True)
+        self.tracker.connect('bulk-added',
+                lambda tracker, objs: bulk_added.append(objs))
+        app.view_tracker_manager.set_batch_mode(True)
+        feed3 = feed.Feed(u"http://feed3.com")
+        feed3.set_title(u"booya")
+        self.feed2.set_title(u"booya")
+        app.view_tracker_manager.process_pending_changes()
+        self.assertEquals(len(bulk_added), 1)
+        self.assertSameSet(bulk_added[0], [feed3, self.feed2])
+        self.assertEquals(self.add_callbacks, [])
+
+    def test_batch_mode_remove(self):
+        self.setup_view(item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}))
+        app.view_tracker_manager.set_batch_mode(True)
+        self.i1.set_title(u"new title")
+        self.i1.remove()
+        app.view_tracker_manager.process_pending_changes()
+        self.assertEquals(self.remove_callbacks, [self.i1])
+        self.assertEquals(self.change_callbacks, [])
+
+    def test_batch_mode_len(self):
+        app.view_tracker_manager.set_batch_mode(True)
+        self.feed2.set_title(u"booya")
+        # len() should process pending changes
+        self.assertEquals(len(self.tracker), 2)
+        self.assertEquals(self.add_callbacks, [self.feed2])
+
     def test_unlink(self):
         self.tracker.unlink()
         self.feed2.set_title(u"booya")
@@ -167,6 +216,76 @@ class ViewTrackerTest(DatabaseTestCase):
         self.clear_ddb_object_cache()
         tracker.check_all_objects()
 
+class CompiledPredicateTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.i2.file_type = u'video'
+        self.i2.seen = True
+        self.i2.signal_change()
+        self.i3.file_type = u'audio'
+        self.i3.deleted = True
+        self.i3.signal_change()
+
+    def check_predicate(self, where, values=()):
+        tracker = item.Item.make_view(where, values).make_tracker()
+        self.assertNotEquals(tracker.predicate, None)
+        for obj in (self.i1, self.i2, self.i3):
+            self.assertEquals(tracker._obj_in_view(obj),
+                    tracker._obj_in_view_sql(obj))
+        tracker.unlink()
+
+    def check_not_compiled(self, where, values=(), joins=None):
+        tracker = item.Item.make_view(where, values,
+                joins=joins).make_tracker()
+        self.assertEquals(tracker.predicate, None)
+        tracker.unlink()
+
+    def test_equality(self):
+        self.check_predicate('feed_id=?', (self.feed.id,))
+        self.check_predicate('item.feed_id == ?', (self.feed2.id,))
+        self.check_predicate("file_type='video'")
+        self.check_predicate("file_type != 'video'")
+        self.check_predicate("keep = 0")
+
+    def test_booleans(self):
+        self.check_predicate('seen')
+        self.check_predicate('NOT seen')
+        self.check_predicate('feed_id=? AND NOT seen', (self.feed.id,))
+        self.check_predicate('(deleted IS NULL or not deleted)')
+        self.check_predicate('NOT deleted OR seen')
+
+    def test_in(self):
+        self.check_predicate("file_type IN ('video', 'audio')")
+        self.check_predicate("file_type NOT IN ('video', 'audio')")
+        self.check_predicate("parent_id=? AND "
+                "file_type IN ('video', 'audio')", (self.i1.id,))
+
+    def test_null(self):
+        self.check_predicate("parent_id IS NULL")
+        self.check_predicate("parent_id IS NOT NULL")
+        self.check_predicate("NOT (parent_id = 0)")
+
+    def test_fallback(self):
+        self.check_not_compiled("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'})
+        self.check_not_compiled("title LIKE 'item%'")
+        self.check_not_compiled('feed_id IS NOT NULL AND '
+                'feed_id NOT IN (SELECT id from feed)')
+        # TEXT columns as booleans use numeric conversion in SQLite
+        self.check_not_compiled("file_type")
+        # DATETIME columns get converted when stored
+        self.check_not_compiled("downloadedTime IS NULL AND "
+                "releaseDateObj > ?", (None,))
+        # SQLite would convert the string to an integer
+        self.check_not_compiled("feed_id=?", (str(self.feed.id),))
+
+    def test_check_mode(self):
+        database.CHECK_COMPILED_PREDICATES = True
+        try:
+            self.check_predicate('feed_id=? AND NOT seen', (self.feed.id,))
+        finally:
+            database.CHECK_COMPILED_PREDICATES = False
+
 # class TestViewLimiter(database.ViewLimiter):
 #     def __init__(self, *feeds_to_include):
 #         self.feeds_to_include = feeds_to_include
@@ -216,6 +335,15 @@ class DDBObjectTestCase(MiroTestCase):
         testobj.bar = 2
         self.assertEquals(testobj.changed_attributes, set(['foo']))
 
+    def test_mutable_attribute_track(self):
+        TestDDBObject.track_attribute_changes('foo_list', mutable=True)
+        testobj = TestDDBObject(self)
+        testobj.foo_list = []
+        testobj.reset_changed_attributes()
+        # getting a mutable attribute means it could be changed in-place
+        testobj.foo_list.append(1)
+        self.assertEquals(testobj.changed_attributes, set(['foo_list']))
+
 class DatabaseLoggingTest(MiroTestCase):
     def check_db_logs(self, count):
         records = self.log_filter.records
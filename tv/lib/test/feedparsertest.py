@@ -1,9 +1,10 @@
 import os
 import unittest
 import pprint
+import cPickle
 
 from miro import feedparserutil
-from miro.item import FeedParserValues
+from miro.feedparservalues import FeedParserValues, ParsedFeed
 from miro.plat import resources
 from miro.test.framework import MiroTestCase, dynamic_test
 
@@ -235,6 +236,41 @@ class FeedParserValuesTest(unittest.TestCase):
             fpv = FeedParserValues(d.entries[i])
             self.assertEquals(fpv.data["thumbnail_url"], url)
 
+class ParsedFeedTest(unittest.TestCase):
+    def test_parsed_feed(self):
+        d = _parse_feed("http___feeds_miroguide_com_miroguide_featured.xml")
+        parsed = ParsedFeed(d)
+        self.assertEquals(parsed.channel_title, d.feed.title)
+        self.assertEquals(parsed.is_empty, False)
+        self.assertEquals(len(parsed.entries), len(d.entries))
+        for entry, fp_values in zip(d.entries, parsed.entries):
+            self.assertEquals(fp_values.data, FeedParserValues(entry).data)
+            self.assertEquals(fp_values.entry, None)
+
+    def test_pickle(self):
+        d = _parse_feed("http___vodo_net_feeds_promoted.xml")
+        parsed = cPickle.loads(cPickle.dumps(ParsedFeed(d),
+            cPickle.HIGHEST_PROTOCOL))
+        for entry, fp_values in zip(d.entries, parsed.entries):
+            self.assertEquals(fp_values.data, FeedParserValues(entry).data)
+            self.assertEquals(fp_values.first_video_enclosure['url'],
+                    FeedParserValues(entry).first_video_enclosure['url'])
+
+    def test_content_hash(self):
+        filename = "http___feeds_miroguide_com_miroguide_featured.xml"
+        parsed = ParsedFeed(_parse_feed(filename))
+        parsed2 = ParsedFeed(_parse_feed(filename))
+        self.assertEquals(parsed.content_hash, parsed2.content_hash)
+        self.assertNotEquals(parsed.entries[0].content_hash,
+                parsed.entries[1].content_hash)
+        parsed3 = ParsedFeed(_parse_feed("http___vodo_net_feeds_promoted.xml"))
+        self.assertNotEquals(parsed.content_hash, parsed3.content_hash)
+
+    def test_empty(self):
+        parsed = ParsedFeed(feedparserutil.parse(""))
+        self.assertEquals(parsed.is_empty, True)
+        self.assertEquals(parsed.entries, [])
+        self.assertEquals(parsed.ttl, 0)
 
 # FIXME - could use way more feedparser tests
 
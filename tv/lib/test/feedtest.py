@@ -393,6 +393,21 @@ support participatory culture and build a fairer music industry.</description>
         self.parse_new_feed(5)
         self.check_guids(2, 3, 4, 5, 6)
 
+    def test_unchanged_feed(self):
+        # updating with the same content shouldn't make our items old
+        app.config.set(prefs.TRUNCATE_CHANNEL_AFTER_X_ITEMS, 0)
+        app.config.set(prefs.MAX_OLD_ITEMS_DEFAULT, 0)
+        self.update_feed(self.feed)
+        self.update_feed(self.feed)
+        self.check_guids(1, 2)
+
+    def test_unchanged_feed_removed_item(self):
+        # if an item gets removed, we should match the entries again, even
+        # if the content is the same.
+        list(Item.make_view())[0].remove()
+        self.update_feed(self.feed)
+        self.check_guids(1, 2)
+
     def test_overflow_with_max_old_items(self):
         app.config.set(
             prefs.TRUNCATE_CHANNEL_AFTER_X_ITEMS, 1000) # don't bother
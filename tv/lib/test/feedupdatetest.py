@@ -0,0 +1,163 @@
+import itertools
+import time
+from datetime import datetime
+
+from miro import feedupdate
+from miro import signals
+
+from miro.test.framework import MiroTestCase
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+class FakeFeed(signals.SignalEmitter):
+    id_counter = itertools.count()
+
+    def __init__(self, url):
+        signals.SignalEmitter.__init__(self, 'update-finished', 'removed')
+        self.id = FakeFeed.id_counter.next()
+        self.url = url
+        self.update_count = 0
+        self.created = datetime.now()
+        self.newest_item_time = None
+
+    def get_title(self):
+        return self.url
+
+    def get_url(self):
+        return self.url
+
+    def get_newest_item_time(self):
+        return self.newest_item_time
+
+    def update(self):
+        self.update_count += 1
+
+class FeedUpdateHistoryTest(MiroTestCase):
+    def test_new_feed(self):
+        # we should start out updating at the feed's normal frequency
+        history = feedupdate.FeedUpdateHistory(now=0)
+        self.assertEquals(history.next_delay(HOUR, now=0), HOUR)
+        history.record_update(3, now=HOUR)
+        self.assertEquals(history.next_delay(HOUR, now=HOUR), HOUR)
+
+    def test_quiet_feed(self):
+        # feeds without new entries should get updated less often, up to
+        # MAX_INTERVAL_FACTOR times the update frequency.
+        history = feedupdate.FeedUpdateHistory(now=0)
+        history.record_update(1, now=0)
+        history.record_not_modified(now=DAY)
+        self.assertEquals(history.next_delay(HOUR, now=DAY),
+                DAY / feedupdate.POLLS_PER_PUBLISH_INTERVAL)
+        history.record_update(0, now=30 * DAY)
+        self.assertEquals(history.next_delay(HOUR, now=30 * DAY),
+                HOUR * feedupdate.MAX_INTERVAL_FACTOR)
+
+    def test_publish_interval(self):
+        history = feedupdate.FeedUpdateHistory(now=0)
+        for i in range(5):
+            history.record_update(1, now=i * 2 * HOUR)
+        self.assertEquals(history.publish_interval, 2 * HOUR)
+        # right after new entries, we use the publish interval
+        self.assertEquals(history.next_delay(10 * 60, now=8 * HOUR),
+                2 * HOUR / feedupdate.POLLS_PER_PUBLISH_INTERVAL)
+        # never update more often than the update frequency
+        self.assertEquals(history.next_delay(HOUR, now=8 * HOUR), HOUR)
+
+    def test_errors(self):
+        history = feedupdate.FeedUpdateHistory(now=0)
+        history.record_error()
+        self.assertEquals(history.next_delay(HOUR, now=0), 2 * HOUR)
+        history.record_error()
+        self.assertEquals(history.next_delay(HOUR, now=0), 4 * HOUR)
+        for i in range(10):
+            history.record_error()
+        self.assertEquals(history.next_delay(HOUR, now=0),
+                HOUR * feedupdate.MAX_INTERVAL_FACTOR)
+        # a successful update resets the backoff
+        history.record_update(0, now=0)
+        self.assertEquals(history.next_delay(HOUR, now=0), HOUR)
+
+    def test_for_feed(self):
+        # histories should start from the data in the database, so they
+        # don't reset every time we start up
+        feed = FakeFeed(u'http://example.com/feed')
+        feed.created = datetime.fromtimestamp(time.time() - 30 * DAY)
+        history = feedupdate.FeedUpdateHistory.for_feed(feed)
+        self.assertEquals(history.last_new_entries, None)
+        self.assertEquals(history.next_delay(HOUR),
+                HOUR * feedupdate.MAX_INTERVAL_FACTOR)
+        feed.newest_item_time = datetime.fromtimestamp(time.time() - DAY)
+        history = feedupdate.FeedUpdateHistory.for_feed(feed)
+        self.assertAlmostEquals(history.next_delay(HOUR),
+                DAY / feedupdate.POLLS_PER_PUBLISH_INTERVAL, -1)
+
+class FeedUpdateQueueTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.queue = feedupdate.FeedUpdateQueue()
+
+    def start_updates(self, feeds):
+        for feed in feeds:
+            self.queue.update_queue.enqueue((feed, feed.update))
+        self.queue.run_update_queue()
+
+    def check_updating(self, feeds):
+        self.assertEquals(self.queue.currently_updating, set(feeds))
+        for feed in feeds:
+            self.assertEquals(feed.update_count, 1)
+
+    def test_global_limit(self):
+        feeds = [FakeFeed(u'http://example%d.com/feed' % i)
+                for i in range(feedupdate.MAX_UPDATES + 1)]
+        self.start_updates(feeds)
+        self.check_updating(feeds[:-1])
+        feeds[0].emit('update-finished')
+        self.queue.run_update_queue()
+        self.check_updating(feeds[1:])
+
+    def test_host_limit(self):
+        feeds = [FakeFeed(u'http://example.com/feed%d' % i)
+                for i in range(feedupdate.MAX_UPDATES_PER_HOST + 1)]
+        other_feed = FakeFeed(u'http://example.org/feed')
+        self.start_updates(feeds + [other_feed])
+        # the extra feed for example.com should wait, but the example.org
+        # feed can go ahead of it.
+        self.check_updating(feeds[:-1] + [other_feed])
+        feeds[0].emit('removed')
+        self.queue.run_update_queue()
+        self.check_updating(feeds[1:] + [other_feed])
+
+    def test_non_http_feeds(self):
+        # feeds without a host only count for the global limit
+        feeds = [FakeFeed(u'dtv:search') for i in
+                range(feedupdate.MAX_UPDATES)]
+        self.start_updates(feeds)
+        self.check_updating(feeds)
+
+    def test_jitter(self):
+        feed = FakeFeed(u'http://example.com/feed')
+        delays = set()
+        for i in range(10):
+            delay = self.queue.next_update_delay(feed, HOUR)
+            # jitter should never make us update more often than the
+            # feed's update frequency
+            self.assert_(HOUR <= delay <= HOUR * (1 + feedupdate.JITTER))
+            delays.add(delay)
+        self.assertNotEquals(len(delays), 1)
+
+    def test_jitter_max_delay(self):
+        feed = FakeFeed(u'http://example.com/feed')
+        for i in range(10):
+            self.queue.get_history(feed).record_error()
+        max_delay = HOUR * feedupdate.MAX_INTERVAL_FACTOR
+        for i in range(10):
+            self.assert_(self.queue.next_update_delay(feed, HOUR) <=
+                    max_delay)
+
+    def test_forget_feed(self):
+        feed = FakeFeed(u'http://example.com/feed')
+        self.queue.get_history(feed).record_error()
+        self.assert_(feed.id in self.queue.histories)
+        self.queue.forget_feed(feed)
+        self.assert_(feed.id not in self.queue.histories)
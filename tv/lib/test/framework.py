@@ -22,6 +22,7 @@ from miro import moviedata
 from miro import util
 from miro import prefs
 from miro import searchengines
+from miro import searchindex
 from miro import signals
 from miro import storedatabase
 from time import sleep
@@ -418,6 +419,8 @@ class MiroTestCase(unittest.TestCase):
     def setup_new_item_info_cache(self):
         app.item_info_cache = iteminfocache.ItemInfoCache()
         app.item_info_cache.load()
+        app.search_index = searchindex.SearchIndex()
+        app.search_index.load()
 
     def reset_failed_soft_count(self):
         app.controller.failed_soft_count = 0
@@ -548,7 +551,7 @@ class EventLoopTest(MiroTestCase):
 
     def processThreads(self):
         eventloop._eventloop.threadpool.init_threads()
-        while not eventloop._eventloop.threadpool.queue.empty():
+        while eventloop._eventloop.threadpool.queue_depth() > 0:
             sleep(0.05)
         eventloop._eventloop.threadpool.close_threads()
 
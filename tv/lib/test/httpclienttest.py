@@ -2,6 +2,7 @@ import functools
 import os
 import pycurl
 import pickle
+import threading
 from cStringIO import StringIO
 
 from miro import dialogs
@@ -440,7 +441,106 @@ class HTTPClientTest(HTTPClientTestBase):
         self.grab_url(self.httpserver.build_url('test.txt'),
                 write_file=filename, resume=True)
         self.assertEquals(open(filename).read(), self.test_response_data)
- 
+
+    @uses_httpclient
+    def test_write_file_skip_head(self):
+        filename = self.make_temp_path(".txt")
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename, skip_head_request=True)
+        self.assertEquals(open(filename).read(), self.test_response_data)
+        self.assertEquals(self.last_http_info('method'), 'GET')
+        self.assertEquals(self.httpserver.head_request_count(), 0)
+
+    @uses_httpclient
+    def test_write_file_skip_head_resume(self):
+        filename = self.make_temp_path(".txt")
+        initial_size = 5
+        self._write_partial_file(filename, initial_size)
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename, resume=True, skip_head_request=True)
+        self.assertEquals(open(filename).read(), self.test_response_data)
+        self.check_header('Range', 'bytes=%d-' % initial_size)
+        self.assertEquals(self.httpserver.head_request_count(), 0)
+
+    @uses_httpclient
+    def test_write_file_skip_head_failed_resume(self):
+        self.httpserver.disable_resume()
+        self.expecting_errback = True
+        filename = self.make_temp_path(".txt")
+        self._write_partial_file(filename)
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename, resume=True, skip_head_request=True)
+        self.assert_(isinstance(self.grab_url_error, httpclient.ResumeFailed))
+
+    @uses_httpclient
+    def test_write_file_skip_head_error(self):
+        # the body of an error response shouldn't end up in our file
+        filename = self.make_temp_path(".txt")
+        self._write_partial_file(filename, 30)
+        self.expecting_errback = True
+        self.grab_url(self.httpserver.build_url('badfile.txt'),
+                write_file=filename, skip_head_request=True)
+        self.assert_(isinstance(self.grab_url_error,
+            httpclient.UnexpectedStatusCode))
+        self.assertEquals(open(filename).read(),
+                self.test_response_data[:30])
+
+    @uses_httpclient
+    def test_write_file_skip_head_resume_error(self):
+        # libcurl reports a range error for error responses when we're
+        # resuming.  We should still see the real status code.
+        filename = self.make_temp_path(".txt")
+        self._write_partial_file(filename, 30)
+        self.expecting_errback = True
+        self.grab_url(self.httpserver.build_url('badfile.txt'),
+                write_file=filename, resume=True, skip_head_request=True)
+        self.assert_(isinstance(self.grab_url_error,
+            httpclient.UnexpectedStatusCode))
+        self.assertEquals(open(filename).read(),
+                self.test_response_data[:30])
+
+    @uses_httpclient
+    def test_write_file_byte_range(self):
+        filename = self.make_temp_path(".txt")
+        f = open(filename, 'wb')
+        f.write('-' * 30)
+        f.close()
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename, byte_range=(5, 14))
+        self.check_header('Range', 'bytes=5-14')
+        self.assertEquals(open(filename).read(),
+                '-' * 5 + self.test_response_data[5:15] + '-' * 15)
+        self.assertEquals(self.client.get_stats().downloaded, 10)
+        # the data should be flushed to disk before we finish
+        self.assertEquals(self.client.transfer.bytes_flushed, 10)
+
+    @uses_httpclient
+    def test_byte_range_sync_thread(self):
+        # fsync() can block, so it should run in the file sync thread, not
+        # the libcurl thread
+        sync_threads = []
+        real_fsync = os.fsync
+        def fsync(fd):
+            sync_threads.append(threading.currentThread().getName())
+            real_fsync(fd)
+        os.fsync = fsync
+        try:
+            self.test_write_file_byte_range()
+        finally:
+            os.fsync = real_fsync
+        self.assert_(sync_threads)
+        self.assertEquals(set(sync_threads), set(["LibCURL File Sync"]))
+
+    @uses_httpclient
+    def test_write_file_byte_range_not_supported(self):
+        self.httpserver.disable_resume()
+        self.expecting_errback = True
+        filename = self.make_temp_path(".txt")
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename, byte_range=(5, 14))
+        self.assert_(isinstance(self.grab_url_error, httpclient.ResumeFailed))
+        self.assertEquals(open(filename).read(), '')
+
     @uses_httpclient
     def test_cancel(self):
         filename = self.make_temp_path(".txt")
@@ -480,6 +580,107 @@ class HTTPClientTest(HTTPClientTestBase):
         self.wait_for_libcurl_manager()
         self.assert_(not os.path.exists(filename))
 
+    @uses_httpclient
+    def test_handle_reuse(self):
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.assertEquals(self.client.get_stats().handle_reused, False)
+        # the second transfer should reuse the handle from the first
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.assertEquals(self.client.get_stats().handle_reused, True)
+        self.assertNotEquals(self.client.get_stats().connection_reused, None)
+        self.wait_for_libcurl_manager()
+        pool = httpclient.curl_manager.handle_pool
+        self.assertEquals(pool.created_count, 1)
+        self.assertEquals(pool.reused_count, 1)
+
+    @uses_httpclient
+    def test_handle_reuse_after_error(self):
+        self.expecting_errback = True
+        self.grab_url(self.httpserver.build_url('badfile.txt'))
+        self.check_errback_called()
+        self.expecting_errback = False
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.assertEquals(self.client.get_stats().handle_reused, True)
+
+    @uses_httpclient
+    def test_update_stats_error(self):
+        # an error getting the final stats shouldn't stop us from calling
+        # the callback or from giving the handle back to the pool
+        self.client = httpclient.grab_url(
+                self.httpserver.build_url('test.txt'),
+                self.grab_url_callback, self.grab_url_errback)
+        transfer = self.client.transfer
+        real_update_stats = transfer.update_stats
+        def update_stats():
+            # only fail for the final stats, after the transfer is done
+            if transfer.handle in httpclient.curl_manager.transfer_map:
+                real_update_stats()
+            else:
+                raise ValueError("stats error")
+        transfer.update_stats = update_stats
+        self.runEventLoop(timeout=self.event_loop_timeout)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.wait_for_libcurl_manager()
+        self.assertEquals(self.client.transfer.handle, None)
+        pool = httpclient.curl_manager.handle_pool
+        self.assertEquals(len(pool.idle_handles), 1)
+
+    @uses_httpclient
+    def test_max_recv_speed(self):
+        self.client = httpclient.grab_url(
+                self.httpserver.build_url('test.txt'),
+                self.grab_url_callback, self.grab_url_errback)
+        self.client.set_max_recv_speed(100 * 1024)
+        self.client.set_recv_paused(True)
+        self.client.set_recv_paused(False)
+        self.runEventLoop(timeout=self.event_loop_timeout)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.assertEquals(self.client.transfer.max_recv_speed, 100 * 1024)
+
+    @uses_httpclient
+    def test_recv_paused_new_request(self):
+        # The transfer sends a HEAD request, then a GET with a new handle.
+        # Both handles should get our paused state.
+        options = httpclient.TransferOptions(
+                self.httpserver.build_url('test.txt'),
+                write_file=self.make_temp_path(".txt"))
+        transfer = httpclient.CurlTransfer(options, self.grab_url_callback,
+                self.grab_url_errback)
+        transfer.recv_paused = True
+        # don't really pause, so that the transfer can finish
+        transfer.apply_recv_settings = mock.Mock()
+        transfer.start()
+        self.runEventLoop(timeout=self.event_loop_timeout)
+        self.assertNotEquals(self.grab_url_info, None)
+        self.assertEquals(transfer.apply_recv_settings.call_count, 2)
+
+class CurlHandlePoolTest(EventLoopTest):
+    def test_reuse(self):
+        pool = httpclient.CurlHandlePool()
+        handle, reused = pool.get_handle()
+        self.assertEquals(reused, False)
+        pool.release_handle(handle)
+        handle2, reused = pool.get_handle()
+        self.assertEquals(reused, True)
+        self.assert_(handle2 is handle)
+        self.assertEquals(pool.created_count, 1)
+        self.assertEquals(pool.reused_count, 1)
+        pool.close()
+
+    def test_max_size(self):
+        pool = httpclient.CurlHandlePool(max_size=1)
+        handle, reused = pool.get_handle()
+        handle2, reused = pool.get_handle()
+        pool.release_handle(handle)
+        pool.release_handle(handle2)
+        self.assertEquals(pool.idle_handles, [handle])
+        # handle2 should be closed
+        self.assertRaises(pycurl.error, handle2.setopt, pycurl.URL,
+                'http://example.com/')
+        pool.close()
+
 class HTTPAuthTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
@@ -570,6 +771,26 @@ class HTTPAuthTest(HTTPClientTestBase):
         self.assertEquals(self.dialogs_seen, 1)
         self.assertEquals(open(filename).read(), self.test_response_data)
 
+    @uses_httpclient
+    def test_auth_with_write_file_skip_head(self):
+        filename = self.make_temp_path(".txt")
+        self.setup_answer("user", "wrongpassword")
+        self.expecting_errback = True
+        self.grab_url(self.httpserver.build_url('protected/index.txt'),
+                write_file=filename, skip_head_request=True)
+        self.check_auth_errback_called()
+        self.assertEquals(open(filename).read(), "")
+
+    @uses_httpclient
+    def test_auth_success_with_write_file_skip_head_resume(self):
+        filename = self.make_temp_path(".txt")
+        self._write_partial_file(filename, 30)
+        self.setup_answer("user", "password")
+        self.grab_url(self.httpserver.build_url('protected/index.txt'),
+                write_file=filename, resume=True, skip_head_request=True)
+        self.assertEquals(self.dialogs_seen, 1)
+        self.assertEquals(open(filename).read(), self.test_response_data)
+
     @uses_httpclient
     def test_auth_memory(self):
         self.setup_answer("user", "password")
@@ -1013,6 +1234,20 @@ class NetworkErrorTest(HTTPClientTestBase):
         self.assert_(isinstance(self.grab_url_error,
             httpclient.UnknownHostError))
 
+    @uses_mock_httpclient
+    def test_unknown_handle_in_batch(self):
+        # a handle that we don't have a transfer for shouldn't stop us from
+        # handling the rest of the batch
+        def mock_add_handle(handle):
+            errors = [(object(), pycurl.E_COULDNT_CONNECT, 'bogus handle'),
+                    (handle, pycurl.E_COULDNT_RESOLVE_HOST, 'fake message')]
+            self.mocked_multi.info_read.return_value = ([], [], errors)
+        self.mocked_multi.add_handle.side_effect = mock_add_handle
+        self.grab_url('http://pculture.org/')
+        self.check_errback_called()
+        self.assert_(isinstance(self.grab_url_error,
+            httpclient.UnknownHostError))
+
     @uses_httpclient
     def test_unknown_error(self):
         # This is a bit of a weird test.  We want to test the generic libcurl
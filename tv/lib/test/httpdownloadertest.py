@@ -2,6 +2,7 @@ import os
 
 from miro import download_utils
 from miro import httpclient
+from miro.test import mock
 from miro.test.framework import (
     EventLoopTest, uses_httpclient, skip_for_platforms)
 from miro.plat import resources
@@ -32,7 +33,7 @@ class TestingDownloader(download.HTTPDownloader):
         # doesn't exist.
         pass
 
-class HTTPDownloaderTest(EventLoopTest):
+class HTTPDownloaderTestBase(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
         download.chatter = False
@@ -65,6 +66,7 @@ class HTTPDownloaderTest(EventLoopTest):
         self.wait_for_libcurl_manager()
         return len(httpclient.curl_manager.transfer_map)
 
+class HTTPDownloaderTest(HTTPDownloaderTestBase):
 #    Really slow test that downloads a very large file.
 #    def testHuge(self):
 #        url = ('http://archive-c01.libsyn.com/aXdueJh2m32XeGh6l3efp5qtZXiX/'
@@ -165,3 +167,158 @@ class HTTPDownloaderTest(EventLoopTest):
         self.downloader2.statusCallback = status_callback
         self.runEventLoop()
         self.assert_(not self.restarted)
+
+class SegmentedTestingDownloader(TestingDownloader):
+    SEGMENT_COUNT = 3
+    MIN_SEGMENT_SIZE = 1000
+
+class SegmentedDownloadTest(HTTPDownloaderTestBase):
+    def setUp(self):
+        HTTPDownloaderTestBase.setUp(self)
+        self.httpserver.add_header('Accept-Ranges', 'bytes')
+        # our test server can only handle 1 connection at a time, so don't
+        # let libcurl keep connections open.
+        self.httpserver.close_connection()
+
+    def test_split_segments(self):
+        segments = download.split_segments(1000, 3)
+        self.assertEquals([(s.start, s.end) for s in segments],
+                [(0, 332), (333, 665), (666, 999)])
+        self.assertEquals(sum(s.length() for s in segments), 1000)
+
+    def test_encode_segments(self):
+        segments = download.split_segments(1000, 2)
+        segments[0].downloaded = 100
+        data = download.encode_segments(segments)
+        self.assertEquals(data, u'0-499:100,500-999:0')
+        decoded = download.decode_segments(data)
+        self.assertEquals([(s.start, s.end, s.downloaded) for s in decoded],
+                [(0, 499, 100), (500, 999, 0)])
+        self.assertEquals(download.encode_segments(None), None)
+        self.assertEquals(download.decode_segments(None), None)
+        self.assertEquals(download.decode_segments(u'0-abc'), None)
+
+    @uses_httpclient
+    def test_download(self):
+        self.downloader = SegmentedTestingDownloader(self, self.download_url,
+                "ID1")
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path, 'rb').read())
+        self.assertEquals(self.downloader.currentSize, self.download_size)
+        self.assertEquals(self.downloader.get_status()['segments'], None)
+        # the last request should have been a range request
+        self.assert_('range' in self.last_http_info('headers'))
+
+    @uses_httpclient
+    def test_no_range_support(self):
+        # the server says it supports ranges, but it ignores them.  We should
+        # fall back to a single transfer.
+        self.httpserver.disable_resume()
+        self.downloader = SegmentedTestingDownloader(self, self.download_url,
+                "ID1")
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assert_(self.downloader.range_requests_failed)
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path, 'rb').read())
+
+    @uses_httpclient
+    def test_restore(self):
+        # restore a segmented download that was paused in the middle
+        data = open(self.download_path, 'rb').read()
+        segments = download.split_segments(len(data), 3)
+        filename = self.make_temp_path('.part')
+        f = open(filename, 'wb')
+        f.truncate(len(data))
+        for segment, amount in zip(segments, (100, 0, 5000)):
+            f.seek(segment.start)
+            f.write(data[segment.start:segment.start+amount])
+            segment.downloaded = amount
+        f.close()
+        self.downloader = SegmentedTestingDownloader(self,
+                restore=self.make_restore(filename, segments, 5100))
+        self.restarted = False
+        def start_new_download_intercept():
+            self.restarted = True
+            self.stopEventLoop(False)
+        self.downloader.start_new_download = start_new_download_intercept
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assert_(not self.restarted)
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assertEquals(self.getDownloadedData(), data)
+
+    def make_restore(self, filename, segments, current_size):
+        return {
+            'dlid': 'ID1',
+            'url': unicode(self.httpserver.build_url('linux-screen.jpg')),
+            'state': u'downloading',
+            'totalSize': self.download_size,
+            'currentSize': current_size,
+            'filename': filename,
+            'startTime': 0,
+            'endTime': 0,
+            'shortFilename': 'linux-screen.jpg',
+            'reasonFailed': u'No Error',
+            'shortReasonFailed': u'No Error',
+            'dlerType': u'HTTP',
+            'retryTime': None,
+            'retryCount': -1,
+            'channelName': None,
+            'segments': download.encode_segments(segments),
+        }
+
+    @uses_httpclient
+    def test_crash_with_unflushed_data(self):
+        # libcurl has given us 5000 bytes for the first segment, but only
+        # 1000 of them have been flushed to disk when we crash.  The rest of
+        # the preallocated file is zeros.
+        data = open(self.download_path, 'rb').read()
+        filename = self.make_temp_path('.part')
+        f = open(filename, 'wb')
+        f.truncate(len(data))
+        f.write(data[:1000])
+        f.close()
+        self.downloader = SegmentedTestingDownloader(self,
+                self.download_url, "ID1")
+        self.downloader.cancel_request()
+        self.downloader.segments = download.split_segments(len(data), 3)
+        stats = httpclient.TransferStats()
+        stats.status_code = 206
+        stats.downloaded = 5000
+        stats.flushed = 1000
+        client = mock.Mock()
+        client.get_stats.return_value = stats
+        self.downloader.segments[0].client = client
+        self.downloader._update_segment_stats()
+        self.downloader.segments[0].client = None
+        self.assertEquals(self.downloader.currentSize, 1000)
+        segments = download.decode_segments(
+                self.downloader.get_status()['segments'])
+        self.assertEquals([s.downloaded for s in segments], [1000, 0, 0])
+        # restore from the status that we saved before the crash
+        download._downloads = {}
+        self.downloader = SegmentedTestingDownloader(self,
+                restore=self.make_restore(filename, segments, 1000))
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assertEquals(self.getDownloadedData(), data)
+
+    @uses_httpclient
+    def test_restore_missing_data(self):
+        # if the file doesn't have the data we think it does, we should
+        # start over.
+        segments = download.split_segments(self.download_size, 3)
+        segments[2].downloaded = 5000
+        filename = self.make_temp_path('.part')
+        self.downloader = SegmentedTestingDownloader(self,
+                self.download_url, "ID1")
+        self.downloader.cancel_request()
+        self.downloader.filename = filename
+        self.downloader.segments = segments
+        self.assert_(not self.downloader._resume_sanity_check())
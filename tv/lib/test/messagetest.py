@@ -13,6 +13,7 @@ from miro.folder import PlaylistFolder, ChannelFolder
 from miro.singleclick import _build_entry
 from miro.tabs import TabOrder
 from miro import itemsource
+from miro import iteminfocache
 from miro import messages
 from miro import messagehandler
 from miro import metadataprogress
@@ -620,21 +621,21 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         item_ = Item(FeedParserValues(entry), feed_id=self.feed.id)
         self.items.append(item_)
 
-    def test_failsafe_load(self):
-        # Make sure current data is saved
+    def save_item_info_cache(self):
         app.db.finish_transaction()
         app.item_info_cache.save()
+
+    def test_failsafe_load(self):
+        # Make sure current data is saved
+        self.save_item_info_cache()
         # insert bogus values into the db
         app.db.cursor.execute("UPDATE item_info_cache SET pickle='BOGUS'")
         # this should fallback to the failsafe values
         self.setup_new_item_info_cache()
         for item in self.items:
-            cache_info = app.item_info_cache.id_to_info[item.id]
+            cache_info = self.get_info_from_item_info_cache(item.id)
             real_info = itemsource.DatabaseItemSource._item_info_for(item)
             self.assertEquals(cache_info.__dict__, real_info.__dict__)
-        # it should also delete all data from the item cache table
-        app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
-        self.assertEquals(app.db.cursor.fetchone()[0], 0)
         # Next call to save() should fix the data
         app.db.finish_transaction()
         app.item_info_cache.save()
@@ -643,7 +644,8 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         for item in self.items:
             app.db.cursor.execute("SELECT pickle FROM item_info_cache "
                     "WHERE id=%s" % item.id)
-            db_info = cPickle.loads(str(app.db.cursor.fetchone()[0]))
+            db_info = iteminfocache.RecordDecoder().decode(
+                    app.db.cursor.fetchone()[0])
             real_info = itemsource.DatabaseItemSource._item_info_for(item)
             self.assertEquals(db_info.__dict__, real_info.__dict__)
 
@@ -666,11 +668,13 @@ class ItemInfoCacheErrorTest(MiroTestCase):
             old_setup_restored(self)
         Item.setup_restored = new_setup_restored
         try:
-            # load up item_info_cache
+            # load up item_info_cache.  Loading the info will restore the
+            # item.
             self.setup_new_item_info_cache()
+            cached_info = self.get_info_from_item_info_cache(
+                    self.items[0].id)
         finally:
             Item.setup_restored = old_setup_restored
-        cached_info = self.get_info_from_item_info_cache(self.items[0].id)
         self.assertEquals(cached_info.name, 'new title2')
 
     def test_change_in_setup_restored(self):
@@ -694,7 +698,159 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         self.assertEquals(cached_info.name, 'new title2')
 
     def get_info_from_item_info_cache(self, id):
-        return app.item_info_cache.id_to_info[id]
+        return app.item_info_cache.get_info(id)
+
+    def test_progressive_load(self):
+        self.save_item_info_cache()
+        self.setup_new_item_info_cache()
+        # we shouldn't load anything until we need to
+        self.assertEquals(app.item_info_cache.id_to_info, {})
+        self.assert_(not app.item_info_cache.is_fully_loaded())
+        # get_info() should load just the one info
+        info = self.get_info_from_item_info_cache(self.items[0].id)
+        self.assertEquals(info.id, self.items[0].id)
+        self.assertEquals(app.item_info_cache.id_to_info.keys(),
+                [self.items[0].id])
+        # the idle callback should load the rest
+        app.item_info_cache._load_chunk()
+        self.assert_(app.item_info_cache.is_fully_loaded())
+        self.assertSameSet(app.item_info_cache.id_to_info.keys(),
+                [i.id for i in self.items])
+        self.assertEquals(app.controller.failed_soft_count, 0)
+
+    def test_progressive_load_error(self):
+        self.save_item_info_cache()
+        self.setup_new_item_info_cache()
+        cache = app.item_info_cache
+        cache.LOAD_CHUNK_SIZE = 2
+        def bad_load_infos(id_list):
+            raise ValueError()
+        cache._load_infos = bad_load_infos
+        cache._load_chunk()
+        # if loading a chunk fails, we should rebuild the infos one at a
+        # time, and keep loading the rest
+        self.assertEquals(len(cache._unloaded_ids), len(self.items) - 2)
+        self.assertEquals(len(cache._infos_changed), 2)
+        self.assert_(cache._load_dc is not None)
+        del cache._load_infos
+        cache._load_chunk()
+        self.assert_(cache.is_fully_loaded())
+        self.assertEquals(cache._failed_ids, set())
+
+    def test_progressive_load_rebuild_error(self):
+        self.save_item_info_cache()
+        self.setup_new_item_info_cache()
+        cache = app.item_info_cache
+        bad_id = self.items[0].id
+        def bad_load_infos(id_list):
+            raise ValueError()
+        real_rebuild_infos = cache._rebuild_infos
+        def bad_rebuild_infos(id_list):
+            if bad_id in id_list:
+                raise ValueError()
+            real_rebuild_infos(id_list)
+        cache._load_infos = bad_load_infos
+        cache._rebuild_infos = bad_rebuild_infos
+        cache._load_chunk()
+        del cache._load_infos
+        # ids that we can't rebuild shouldn't stop us from loading
+        self.assert_(cache.is_fully_loaded())
+        self.assertEquals(cache._failed_ids, set([bad_id]))
+        self.assertEquals(len(cache.all_infos()), len(self.items) - 1)
+        # once we can rebuild the info again, we should repair it
+        del cache._rebuild_infos
+        self.assertEquals(len(cache.all_infos()), len(self.items))
+        self.assertEquals(cache._failed_ids, set())
+        self.assert_(bad_id in cache._infos_changed)
+
+    def test_change_failed_item(self):
+        self.save_item_info_cache()
+        self.setup_new_item_info_cache()
+        cache = app.item_info_cache
+        changed_id, removed_id = self.items[0].id, self.items[1].id
+        cache._unloaded_ids.difference_update([changed_id, removed_id])
+        cache._failed_ids.update([changed_id, removed_id])
+        self.items[0].title = u'new title'
+        self.items[0].signal_change()
+        self.assertEquals(cache.id_to_info[changed_id].name, u'new title')
+        self.assert_(changed_id in cache._infos_changed)
+        removed_infos = []
+        cache.connect('removed',
+                lambda cache, info: removed_infos.append(info))
+        self.items[1].remove()
+        self.assertEquals([info.id for info in removed_infos], [removed_id])
+        self.assert_(removed_id in cache._infos_deleted)
+        self.assertEquals(cache._failed_ids, set())
+
+    def test_repair_single_row(self):
+        self.save_item_info_cache()
+        bad_id, good_id = self.items[0].id, self.items[1].id
+        app.db.cursor.execute("UPDATE item_info_cache SET pickle='BOGUS' "
+                "WHERE id=?", (bad_id,))
+        self.setup_new_item_info_cache()
+        app.item_info_cache.all_infos()
+        # only the bad row should be rebuilt
+        self.assertEquals(app.item_info_cache._infos_changed.keys(),
+                [bad_id])
+        self.save_item_info_cache()
+        app.db.cursor.execute("SELECT pickle FROM item_info_cache "
+                "WHERE id=?", (bad_id,))
+        db_info = iteminfocache.RecordDecoder().decode(
+                app.db.cursor.fetchone()[0])
+        self.assertEquals(db_info.id, bad_id)
+
+    def test_missing_and_extra_rows(self):
+        self.save_item_info_cache()
+        missing_id = self.items[0].id
+        app.db.cursor.execute("DELETE FROM item_info_cache WHERE id=?",
+                (missing_id,))
+        app.db.cursor.execute("INSERT INTO item_info_cache (id, pickle) "
+                "VALUES (?, ?)", (12345678, 'BOGUS'))
+        self.setup_new_item_info_cache()
+        # rows for items that don't exist anymore should be deleted
+        app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache "
+                "WHERE id=12345678")
+        self.assertEquals(app.db.cursor.fetchone()[0], 0)
+        # missing rows should be rebuilt
+        info = self.get_info_from_item_info_cache(missing_id)
+        self.assertEquals(info.id, missing_id)
+        self.save_item_info_cache()
+        app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
+        self.assertEquals(app.db.cursor.fetchone()[0], len(self.items))
+
+    def test_change_unloaded_item(self):
+        self.save_item_info_cache()
+        self.setup_new_item_info_cache()
+        self.items[0].title = u'new title'
+        self.items[0].signal_change()
+        info = self.get_info_from_item_info_cache(self.items[0].id)
+        self.assertEquals(info.name, u'new title')
+        self.items[1].remove()
+        self.assert_(self.items[1].id in
+                app.item_info_cache._infos_deleted)
+        app.item_info_cache.all_infos()
+        self.assertEquals(app.item_info_cache.id_to_info.keys(),
+                [self.items[0].id])
+
+    def test_remove_unloaded_item(self):
+        self.save_item_info_cache()
+        removed_id = self.items[1].id
+        app.db.cursor.execute("DELETE FROM item_info_cache WHERE id=?",
+                (removed_id,))
+        self.clear_ddb_object_cache()
+        self.setup_new_item_info_cache()
+        removed_infos = []
+        app.item_info_cache.connect('removed',
+                lambda cache, info: removed_infos.append(info))
+        # load the item without its lazy fields, then remove it.  The cache
+        # row is missing, so the info has to be built from the item.
+        item_ = Item.get_by_id(removed_id)
+        self.assert_(removed_id in app.db._ids_lazy_unloaded)
+        item_.remove()
+        self.assertEquals([info.id for info in removed_infos], [removed_id])
+        self.assert_(removed_id in app.item_info_cache._infos_deleted)
+        self.assert_(removed_id not in app.item_info_cache.id_to_info)
+        self.save_item_info_cache()
 
     def test_item_info_version(self):
         app.db.finish_transaction()
@@ -706,6 +862,125 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
         self.assertEquals(app.db.cursor.fetchone()[0], 0)
 
+class ItemInfoRecordTest(MiroTestCase):
+    # Test the record format for the item_info_cache table
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        self.items = []
+        for i in xrange(3):
+            entry = _build_entry(u'http://example.com/%s' % i,
+                    'video/x-unknown')
+            self.items.append(Item(FeedParserValues(entry),
+                feed_id=self.feed.id))
+        self.infos = [itemsource.DatabaseItemSource._item_info_for(item)
+                for item in self.items]
+
+    def check_round_trip(self, info, decoder=None):
+        if decoder is None:
+            decoder = iteminfocache.RecordDecoder()
+        decoded = decoder.decode(iteminfocache.encode_record(info))
+        self.assertEquals(decoded.__dict__, info.__getstate__())
+        return decoded
+
+    def test_round_trip(self):
+        for info in self.infos:
+            self.check_round_trip(info)
+
+    def test_extra_and_missing_fields(self):
+        info = self.infos[0]
+        info.connections = 5
+        self.check_round_trip(info)
+        del info.license
+        self.check_round_trip(info)
+
+    def test_children(self):
+        info = self.infos[0]
+        info.children = self.infos[1:]
+        decoded = iteminfocache.RecordDecoder().decode(
+                iteminfocache.encode_record(info))
+        self.assertEquals([child.__dict__ for child in decoded.children],
+                [child.__getstate__() for child in self.infos[1:]])
+
+    def test_interned_strings(self):
+        decoder = iteminfocache.RecordDecoder()
+        rows = [(info.id, iteminfocache.encode_record(info))
+                for info in self.infos]
+        decoded = [info for id_, info in decoder.decode_rows(rows)]
+        self.assertEquals([info.id for info in decoded],
+                [info.id for info in self.infos])
+        self.assert_(decoded[0].feed_name is decoded[1].feed_name)
+
+    def test_compression(self):
+        info = self.infos[0]
+        info.description = u'a' * (iteminfocache.COMPRESS_THRESHOLD * 2)
+        record = iteminfocache.encode_record(info)
+        self.assert_(len(record) < len(info.description))
+        self.check_round_trip(info)
+
+    def test_bad_records(self):
+        decoder = iteminfocache.RecordDecoder()
+        record = iteminfocache.encode_record(self.infos[0])
+        bad_format = chr(iteminfocache.RECORD_FORMAT + 1) + record[1:]
+        header = record[:iteminfocache.RECORD_HEADER.size]
+        # pickles that reference a missing class or module
+        missing_class = header + 'cmiro.messages\nNoSuchClass\n.'
+        missing_module = header + 'cno_such_module\nNoSuchClass\n.'
+        for bad_record in ('', 'BOGUS', bad_format, record[:-10],
+                missing_class, missing_module):
+            self.assertRaises(iteminfocache.RecordError, decoder.decode,
+                    bad_record)
+
+    def test_small_records_not_compressed(self):
+        record = iteminfocache.encode_record(self.infos[0])
+        format_version, flags = iteminfocache.RECORD_HEADER.unpack(
+                record[:iteminfocache.RECORD_HEADER.size])
+        self.assertEquals(flags, 0)
+
+class ItemInfoDerivedAttributesTest(MiroTestCase):
+    # Test the ItemInfo attributes that are calculated from other attributes
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        entry = _build_entry(u'http://example.com/', 'video/x-unknown')
+        self.item = Item(FeedParserValues(entry), feed_id=self.feed.id)
+        self.info = itemsource.DatabaseItemSource._item_info_for(self.item)
+
+    def test_lazy(self):
+        # derived attributes shouldn't be calculated until they're needed
+        self.assertEquals(self.info._derived, {})
+        self.assertEquals(self.info.description_stripped,
+                messages.ItemInfo.html_stripper.strip(self.info.description))
+        self.assert_('description_stripped' in self.info._derived)
+        # they also shouldn't be stored in __dict__, since we use that to
+        # check if ItemInfos have changed
+        self.assert_('description_stripped' not in self.info.__dict__)
+        new_info = itemsource.DatabaseItemSource._item_info_for(self.item)
+        self.assertEquals(new_info.__dict__, self.info.__dict__)
+
+    def test_set(self):
+        self.info.name_sort_key = 'foo'
+        self.assertEquals(self.info.name_sort_key, 'foo')
+        del self.info.name_sort_key
+        self.assertNotEquals(self.info.name_sort_key, 'foo')
+
+    def test_pass_to_constructor(self):
+        kwargs = self.info.__dict__.copy()
+        kwargs['search_terms'] = (u'foo',)
+        info = messages.ItemInfo(self.info.id, **kwargs)
+        self.assertEquals(info.search_terms, (u'foo',))
+        self.assert_('search_terms' not in info.__dict__)
+
+    def test_pickle(self):
+        self.info.display_kind
+        self.info.search_terms
+        for protocol in (0, cPickle.HIGHEST_PROTOCOL):
+            data = cPickle.dumps(self.info, protocol)
+            unpickled = cPickle.loads(data)
+            self.assertEquals(unpickled._derived, {})
+            self.assertEquals(unpickled.search_terms, self.info.search_terms)
+            self.assertEquals(unpickled.display_kind, self.info.display_kind)
+
 class MetadataProgressUpdaterTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
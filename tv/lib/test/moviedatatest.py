@@ -12,12 +12,14 @@ from miro import filetags
 from miro import metadata
 from miro import app
 from miro import models
+from miro import prefs
 from miro import filetypes
 from miro.feed import Feed
 from miro.plat import resources
 from miro.plat import renderers
 from miro.fileobject import FilenameType
 
+import threading
 import time
 
 moviedata.MOVIE_DATA_UTIL_TIMEOUT = 10 # shouldn't break any other tests
@@ -172,6 +174,73 @@ class MovieDataRequestTest(MiroTestCase):
         self.check_will_run_moviedata(self.video_item, True)
         self.check_will_run_moviedata(self.audio_item, False)
 
+class MovieDataPoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.mdu = moviedata.MovieDataUpdater()
+
+    def test_worker_count(self):
+        app.config.set(prefs.MAX_CONCURRENT_MOVIE_DATA, 3)
+        self.assertEquals(self.mdu.worker_count(), 3)
+        app.config.set(prefs.MAX_CONCURRENT_MOVIE_DATA, 0)
+        self.assert_(self.mdu.worker_count() >= 1)
+
+    def test_timeout(self):
+        old_timeout = moviedata.MOVIE_DATA_UTIL_TIMEOUT
+        moviedata.MOVIE_DATA_UTIL_TIMEOUT = 0.1
+        try:
+            start = time.time()
+            self.assertRaises(moviedata.ProcessHung,
+                    self.mdu.run_movie_data_program, ['sleep', '10'], None)
+            self.assert_(time.time() - start < 5)
+        finally:
+            moviedata.MOVIE_DATA_UTIL_TIMEOUT = old_timeout
+        self.assertEquals(self.mdu.running_processes, set())
+
+    def test_output(self):
+        stdout = self.mdu.run_movie_data_program(
+                ['echo', 'Miro-Movie-Data-Length: 123'], None)
+        self.assertEquals(self.mdu.parse_duration(stdout), 123)
+
+    def test_loop_context(self):
+        # each worker thread should see its own state in the loop context
+        contexts = []
+        results = []
+        def begin_loop(mdu, context):
+            context.value = threading.currentThread().getName()
+            contexts.append(context)
+        def end_loop(mdu, context):
+            thread_name = threading.currentThread().getName()
+            results.append(context.value == thread_name)
+        self.mdu.connect('begin-loop', begin_loop)
+        self.mdu.connect('end-loop', end_loop)
+        def run_loop():
+            for i in xrange(100):
+                with self.mdu.looping():
+                    pass
+        threads = [threading.Thread(target=run_loop) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results, [True] * 400)
+        self.assert_(contexts[0] is self.mdu.loop_context)
+
+    def test_queue_empty(self):
+        # we should only emit queue-empty once every worker is idle
+        emits = []
+        self.mdu.connect('queue-empty', lambda mdu: emits.append(mdu))
+        self.mdu.worker_total = 2
+        self.mdu.worker_idle()
+        self.assertEquals(emits, [])
+        self.mdu.worker_idle()
+        self.assertEquals(emits, [self.mdu])
+        # if another item got queued, the workers aren't done yet
+        self.mdu.idle_workers = 1
+        self.mdu.queue.put(None)
+        self.mdu.worker_idle()
+        self.assertEquals(emits, [self.mdu])
+
 # FIXME
 # theora_with_ogg_extension test case expected to have a screenshot")
 # mp4-0 test case expected to have a screenshot")
@@ -2,13 +2,23 @@ import shutil
 import os
 import pstats
 import cProfile
+import collections
+import random
+import sys
+import threading
+import time
+from array import array
 
 from miro import app
 from miro import messagehandler
 from miro import messages
 from miro import models
+from miro import search
+from miro import subprocessmanager
+from miro import workerprocess
 from miro.fileobject import FilenameType
-from miro.test.framework import EventLoopTest
+from miro.plat import resources
+from miro.test.framework import EventLoopTest, MiroTestCase
 from miro.test import messagetest
 
 class PerformanceTest(EventLoopTest):
@@ -66,3 +76,188 @@ class PerformanceTest(EventLoopTest):
     def track_item_count(self):
         messages.TrackNewVideoCount().send_to_backend()
         self.runUrgentCalls()
+
+class SubprocessPipePerformanceTest(MiroTestCase):
+    """Measure how fast we can send messages to the worker process."""
+
+    MESSAGE_COUNT = 500
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        path = os.path.join(resources.path(
+            "testdata/feedparsertests/feeds"),
+            "http___feeds_miroguide_com_miroguide_featured.xml")
+        self.html = open(path).read()
+
+    def _run_benchmark(self, batch_size):
+        read_fd, write_fd = os.pipe()
+        read_pipe = os.fdopen(read_fd, 'rb')
+        write_pipe = os.fdopen(write_fd, 'wb')
+        received = []
+        def reader():
+            for i in xrange(self.MESSAGE_COUNT):
+                received.append(subprocessmanager._load_obj(read_pipe))
+        thread = threading.Thread(target=reader)
+        thread.start()
+        writer = subprocessmanager.FrameWriter(write_pipe)
+        start = time.time()
+        for i in xrange(self.MESSAGE_COUNT):
+            writer.add(workerprocess.FeedparserTask(self.html))
+            if (i + 1) % batch_size == 0:
+                writer.flush()
+        writer.flush()
+        thread.join()
+        elapsed = time.time() - start
+        write_pipe.close()
+        read_pipe.close()
+        self.assertEquals(len(received), self.MESSAGE_COUNT)
+        megabytes = len(self.html) * self.MESSAGE_COUNT / (1024.0 * 1024.0)
+        print ('batch size %3d: %6d messages/sec %8.2f MB/sec' %
+                (batch_size, self.MESSAGE_COUNT / elapsed,
+                    megabytes / elapsed))
+
+    def test_pipe_throughput(self):
+        print 'testing throughput of %s feedparser tasks (%d bytes each)' % (
+                self.MESSAGE_COUNT, len(self.html))
+        for batch_size in (1, 10, 100):
+            self._run_benchmark(batch_size)
+        print 'with compression'
+        old_threshold = subprocessmanager.COMPRESS_THRESHOLD
+        subprocessmanager.COMPRESS_THRESHOLD = 0
+        try:
+            for batch_size in (1, 10, 100):
+                self._run_benchmark(batch_size)
+        finally:
+            subprocessmanager.COMPRESS_THRESHOLD = old_threshold
+
+class SetItemSearcher(object):
+    """The old ItemSearcher, which stores a set of ids for each N-gram.
+
+    This is used as a baseline in SearchIndexPerformanceTest.
+    """
+    def __init__(self):
+        self._ngram_map = collections.defaultdict(set)
+        self._item_ngrams = {}
+
+    def add_item(self, item_info):
+        item_ngrams = search._ngrams_for_item(item_info)
+        for ngram in item_ngrams:
+            self._ngram_map[ngram].add(item_info.id)
+        self._item_ngrams[item_info.id] = item_ngrams
+
+    def _term_search(self, term):
+        grams = search._ngrams_for_term(term)
+        rv = set(self._ngram_map[grams[0]])
+        for gram in grams[1:]:
+            rv.intersection_update(self._ngram_map[gram])
+        return rv
+
+    def search(self, search_text):
+        parsed_search = search._get_boolean_search(search_text)
+        positive_terms = [t for t in parsed_search.positive_terms
+                if len(t) >= search.NGRAM_MIN]
+        if not positive_terms:
+            return set(self._item_ngrams.keys())
+        matching_ids = self._term_search(positive_terms[0])
+        for term in positive_terms[1:]:
+            matching_ids.intersection_update(self._term_search(term))
+        return matching_ids
+
+def set_list_matches(item_infos, search_text):
+    """The old list_matches(), which builds a set of N-grams for each item.
+
+    This is used as a baseline in SearchIndexPerformanceTest.
+    """
+    parsed_search = search._get_boolean_search(search_text)
+    positive_set = set()
+    for term in parsed_search.positive_terms:
+        positive_set |= set(search._ngrams_for_term(term))
+    for info in item_infos:
+        if positive_set.issubset(set(search._ngrams_for_item(info))):
+            yield info
+
+def _deep_size(obj, seen=None):
+    """Estimate the memory used by obj and the objects it contains."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += _deep_size(key, seen) + _deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += _deep_size(value, seen)
+    elif hasattr(obj, '__dict__'):
+        size += _deep_size(obj.__dict__, seen)
+    return size
+
+class FakeSearchInfo(object):
+    def __init__(self, id_, search_terms):
+        self.id = id_
+        self.search_terms = search_terms
+
+class SearchIndexPerformanceTest(MiroTestCase):
+    """Compare memory and query time for the search index."""
+
+    ITEM_COUNT = 20000
+    WORDS_PER_ITEM = 30
+    QUERIES = ['mir', 'miro', 'video player', 'abcde', 'epis -music',
+            'qzx', 'longerword']
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        rand = random.Random(1234)
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        vocabulary = [''.join(rand.choice(letters)
+            for i in xrange(rand.randint(3, 10))) for j in xrange(5000)]
+        vocabulary.extend(['miro', 'video', 'player', 'episode', 'music'])
+        self.infos = [FakeSearchInfo(i, rand.sample(vocabulary,
+            self.WORDS_PER_ITEM)) for i in xrange(self.ITEM_COUNT)]
+
+    def _run_benchmark(self, name, searcher):
+        start = time.time()
+        for info in self.infos:
+            searcher.add_item(info)
+        index_time = time.time() - start
+        memory = _deep_size(searcher) / (1024.0 * 1024.0)
+        start = time.time()
+        results = {}
+        for i in xrange(10):
+            for query in self.QUERIES:
+                results[query] = searcher.search(query)
+        query_time = (time.time() - start) / (10 * len(self.QUERIES))
+        print ('%-20s index: %6.2fs  memory: %7.1fMB  query: %7.2fms' %
+                (name, index_time, memory, query_time * 1000))
+        return results
+
+    def test_search_index(self):
+        print 'indexing %s items with %s words each' % (self.ITEM_COUNT,
+                self.WORDS_PER_ITEM)
+        old_results = self._run_benchmark('set based',
+                SetItemSearcher())
+        new_results = self._run_benchmark('ItemSearcher',
+                search.ItemSearcher())
+        self.assertEquals(old_results, new_results)
+
+    def _time_list_matches(self, name, list_matches):
+        start = time.time()
+        results = {}
+        for query in self.QUERIES:
+            results[query] = [i.id for i in list_matches(self.infos, query)]
+        query_time = (time.time() - start) / len(self.QUERIES)
+        print '%-20s query: %7.2fms' % (name, query_time * 1000)
+        return results
+
+    def test_list_matches(self):
+        print 'searching %s unindexed items with %s words each' % (
+                self.ITEM_COUNT, self.WORDS_PER_ITEM)
+        # the old version doesn't handle negative terms
+        self.QUERIES = [q for q in self.QUERIES if '-' not in q]
+        old_results = self._time_list_matches('set based',
+                set_list_matches)
+        new_results = self._time_list_matches('list_matches',
+                search.list_matches)
+        self.assertEquals(old_results, new_results)
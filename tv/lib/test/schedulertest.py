@@ -1,7 +1,11 @@
 from time import time, sleep
+import select
 import threading
 
 from miro import eventloop
+from miro import eventloopstats
+from miro import eventpoller
+from miro import util
 from miro.test.framework import EventLoopTest
 
 class SchedulerTest(EventLoopTest):
@@ -57,3 +61,255 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+class ThreadPoolTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.threadpool = eventloop._eventloop.threadpool
+        self.results = []
+
+    def tearDown(self):
+        self.threadpool.close_threads()
+        for queue in self.threadpool.queues.values():
+            queue.clear()
+        EventLoopTest.tearDown(self)
+
+    def callback(self, result):
+        self.results.append(result)
+
+    def errback(self, error):
+        self.results.append(error)
+
+    def test_call_in_thread(self):
+        eventloop.call_in_thread(self.callback, self.errback,
+                lambda x: x * 2, 'double', 2)
+        self.processThreads()
+        self.process_idles()
+        self.assertEquals(self.results, [4])
+
+    def test_lane_order(self):
+        for lane in (eventloop.LANE_BACKGROUND, eventloop.LANE_IO,
+                eventloop.LANE_INTERACTIVE):
+            eventloop.call_in_thread_lane(lane, self.callback, self.errback,
+                    lambda: None, lane)
+        self.assertEquals(self.threadpool.queue_depth(), 3)
+        names = []
+        while self.threadpool.queue_depth() > 0:
+            lane, call_info = self.threadpool._next_call()
+            names.append(call_info[3])
+        self.assertEquals(names, [eventloop.LANE_INTERACTIVE,
+            eventloop.LANE_IO, eventloop.LANE_BACKGROUND])
+
+    def test_lane_limit(self):
+        eventloop.call_in_thread_lane(eventloop.LANE_BACKGROUND,
+                self.callback, self.errback, lambda: None, 'background')
+        limit = self.threadpool.LANE_LIMITS[eventloop.LANE_BACKGROUND]
+        self.threadpool.running[eventloop.LANE_BACKGROUND] = limit
+        try:
+            self.assertEquals(self.threadpool._next_call(), (None, None))
+        finally:
+            self.threadpool.running[eventloop.LANE_BACKGROUND] = 0
+
+    def test_interactive_not_starved(self):
+        background_event = threading.Event()
+        interactive_event = threading.Event()
+        self.threadpool.init_threads()
+        try:
+            for i in xrange(self.threadpool.MAX_THREADS):
+                eventloop.call_in_thread_lane(eventloop.LANE_BACKGROUND,
+                        self.callback, self.errback, background_event.wait,
+                        'background', 5)
+            eventloop.call_in_thread_lane(eventloop.LANE_INTERACTIVE,
+                    self.callback, self.errback, interactive_event.set,
+                    'interactive')
+            interactive_event.wait(5)
+            self.assert_(interactive_event.isSet())
+        finally:
+            background_event.set()
+
+    def test_stats(self):
+        eventloop.call_in_thread(self.callback, self.errback,
+                lambda: None, 'foo')
+        eventloop.call_in_thread(self.callback, self.errback,
+                lambda: 1 / 0, 'foo')
+        self.assertEquals(eventloop.thread_pool_stats()['foo'].queued, 2)
+        self.processThreads()
+        stats = eventloop.thread_pool_stats()['foo']
+        self.assertEquals(stats.queued, 0)
+        self.assertEquals(stats.running, 0)
+        self.assertEquals(stats.finished, 2)
+
+class EventLoopStatsTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.stats = eventloopstats.EventLoopStats()
+
+    def test_histogram(self):
+        histogram = eventloopstats.Histogram()
+        for i in xrange(98):
+            histogram.add(0.002)
+        histogram.add(0.3)
+        histogram.add(10.0)
+        self.assertEquals(histogram.count, 100)
+        self.assertEquals(histogram.max, 10.0)
+        self.assertEquals(histogram.percentile(0.5), 0.005)
+        self.assertEquals(histogram.percentile(0.99), 0.5)
+        self.assertEquals(histogram.percentile(1.0), 10.0)
+        self.assertAlmostEqual(histogram.mean(), 0.10496)
+
+    def test_empty_histogram(self):
+        histogram = eventloopstats.Histogram()
+        self.assertEquals(histogram.mean(), 0.0)
+        self.assertEquals(histogram.percentile(0.5), 0.0)
+
+    def test_record_call(self):
+        self.stats.record_call('foo', 0.01, 0.2)
+        self.stats.record_call('foo', 0.03, 0.4)
+        call_stats = self.stats.calls['foo']
+        self.assertEquals(call_stats.latency.count, 2)
+        self.assertEquals(call_stats.latency.max, 0.03)
+        self.assertAlmostEqual(call_stats.run_time.total, 0.6)
+
+    def test_max_names(self):
+        for i in xrange(eventloopstats.MAX_NAMES + 10):
+            self.stats.record_call('call-%d' % i, 0, 0)
+        self.assertEquals(len(self.stats.calls),
+                eventloopstats.MAX_NAMES + 1)
+        self.assertEquals(
+                self.stats.calls[eventloopstats.OTHER_NAME].run_time.count,
+                10)
+
+    def test_queue_depth(self):
+        for depth in (3, 10, 2):
+            self.stats.record_queue_depth('idle queue', depth)
+        depth_stats = self.stats.queue_depths['idle queue']
+        self.assertEquals(depth_stats.last, 2)
+        self.assertEquals(depth_stats.max, 10)
+        self.assertEquals(depth_stats.mean(), 5.0)
+
+    def test_report(self):
+        self.stats.record_call('slow', 0.0, 2.0)
+        self.stats.record_call('delayed', 3.0, 0.0)
+        self.stats.record_poll_wait(0.1)
+        self.stats.record_queue_depth('idle queue', 4)
+        report = self.stats.get_report()
+        self.assert_('slow' in report)
+        self.assert_('delayed' in report)
+        self.assert_('idle queue' in report)
+
+    def test_event_loop_records_calls(self):
+        eventloop.stats.reset()
+        eventloop.add_idle(lambda: None, "stats test")
+        eventloop.add_timeout(0.1, eventloop.shutdown, "stats test stop")
+        self.runEventLoop()
+        self.assert_('idle (stats test)' in eventloop.stats.calls)
+        self.assert_('timeout (stats test stop)' in eventloop.stats.calls)
+        self.assert_(eventloop.stats.poll_wait.count > 0)
+        self.assert_('idle queue' in eventloop.stats.queue_depths)
+
+    def test_other_loops_dont_record(self):
+        # loops running in other threads (like the libcurl thread) shouldn't
+        # touch the main loop's stats
+        eventloop.stats.reset()
+        eventloop.SimpleEventLoop().record_poll_wait(0.1)
+        self.assertEquals(eventloop.stats.poll_wait.count, 0)
+
+class SelectPollerTest(EventLoopTest):
+    def make_poller(self):
+        return eventpoller.SelectPoller()
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.poller = self.make_poller()
+        self.sender, self.receiver = util.make_dummy_socket_pair()
+
+    def tearDown(self):
+        self.poller.close()
+        self.sender.close()
+        self.receiver.close()
+        EventLoopTest.tearDown(self)
+
+    def test_read(self):
+        fd = self.receiver.fileno()
+        self.poller.register(fd, eventpoller.READ)
+        self.assertEquals(self.poller.poll(0), [])
+        self.sender.send("a")
+        self.assertEquals(self.poller.poll(1), [(fd, eventpoller.READ)])
+
+    def test_write(self):
+        fd = self.sender.fileno()
+        self.poller.register(fd, eventpoller.WRITE)
+        self.assertEquals(self.poller.poll(1), [(fd, eventpoller.WRITE)])
+
+    def test_modify(self):
+        fd = self.sender.fileno()
+        self.poller.register(fd, eventpoller.READ)
+        self.assertEquals(self.poller.poll(0), [])
+        self.poller.register(fd, eventpoller.READ | eventpoller.WRITE)
+        self.assertEquals(self.poller.poll(1), [(fd, eventpoller.WRITE)])
+
+    def test_unregister(self):
+        fd = self.receiver.fileno()
+        self.poller.register(fd, eventpoller.READ)
+        self.poller.unregister(fd)
+        self.sender.send("a")
+        self.assertEquals(self.poller.poll(0), [])
+        # unregistering twice is okay
+        self.poller.unregister(fd)
+        # so is registering with no events
+        self.poller.register(fd, 0)
+        self.assertEquals(self.poller.fd_events, {})
+
+    def test_set_fds(self):
+        read_fd = self.receiver.fileno()
+        write_fd = self.sender.fileno()
+        self.poller.register(read_fd, eventpoller.READ)
+        self.poller.set_fds([], [write_fd], keep_fds=[read_fd])
+        self.assertEquals(self.poller.fd_events, {
+            read_fd: eventpoller.READ,
+            write_fd: eventpoller.WRITE,
+        })
+        self.poller.set_fds([write_fd], [])
+        self.assertEquals(self.poller.fd_events,
+                {write_fd: eventpoller.READ})
+
+    def test_hangup(self):
+        fd = self.receiver.fileno()
+        self.poller.register(fd, eventpoller.READ)
+        self.sender.close()
+        self.assertEquals(self.poller.poll(1), [(fd, eventpoller.READ)])
+
+if hasattr(select, 'epoll'):
+    class EpollPollerTest(SelectPollerTest):
+        def make_poller(self):
+            return eventpoller.EpollPoller()
+
+        def test_fd_reused(self):
+            # epoll forgets about fds when they're closed.  Make sure we
+            # handle the fd getting reused.
+            fd = self.receiver.fileno()
+            self.poller.register(fd, eventpoller.READ)
+            self.receiver.close()
+            self.sender.close()
+            self.sender, self.receiver = util.make_dummy_socket_pair()
+            for sock in (self.sender, self.receiver):
+                self.poller.register(sock.fileno(),
+                        eventpoller.READ | eventpoller.WRITE)
+            self.assert_(len(self.poller.poll(1)) > 0)
+
+class EventLoopPollerTest(EventLoopTest):
+    def test_callbacks_registered(self):
+        sender, receiver = util.make_dummy_socket_pair()
+        try:
+            poller = eventloop._eventloop.poller
+            fd = receiver.fileno()
+            eventloop.add_read_callback(receiver, lambda: None)
+            self.assertEquals(poller.fd_events[fd], eventpoller.READ)
+            eventloop.add_write_callback(receiver, lambda: None)
+            self.assertEquals(poller.fd_events[fd],
+                    eventpoller.READ | eventpoller.WRITE)
+            eventloop.stop_handling_socket(receiver)
+            self.assert_(fd not in poller.fd_events)
+        finally:
+            sender.close()
+            receiver.close()
@@ -1,5 +1,8 @@
+import datetime
 import gc
+from array import array
 
+from miro import app
 from miro import messages
 from miro import models
 from miro import search
@@ -8,7 +11,9 @@ from miro import itemsource
 from miro.item import FeedParserValues
 from miro.singleclick import _build_entry
 from miro.test.framework import MiroTestCase
+from miro.frontends.widgets import itemtrack
 from miro.frontends.widgets.itemtrack import SearchFilter
+from miro.frontends.widgets.itemtrack import DatabaseItemSearcher
 
 class NGramTest(MiroTestCase):
     def test_simple(self):
@@ -25,6 +30,59 @@ class NGramTest(MiroTestCase):
                 'ba', 'ar', 'bar',
                 'az', 'zb', 'baz', 'azb', 'zba'])
 
+    def test_set(self):
+        word_list = [u'foo', u'bar', u'foo', u'bazbaz']
+        results = ngrams.breakup_set(word_list, 2, 3)
+        self.assertEquals(results, set(ngrams.breakup_list(word_list, 2, 3)))
+        # test adding prefix keys
+        results = ngrams.breakup_set(word_list, 3, 3, 2)
+        self.assertEquals(results, set([
+            u'foo', u'bar', u'baz', u'azb', u'zba',
+            u'^f', u'^fo', u'^b', u'^ba']))
+        self.assertEquals(ngrams.breakup_set([u'a'], 3, 5, 2),
+                set([u'^a']))
+        self.assertRaises(TypeError, ngrams.breakup_set, [1], 2, 3)
+
+    def test_prefix_marker(self):
+        # ngrams.c hardcodes the prefix marker, make sure it matches the one
+        # in search.py
+        self.assertEquals(ngrams.breakup_set([u'a'], 3, 5, 1),
+                set([search.PREFIX_MARKER + u'a']))
+
+    def test_hash_set(self):
+        word_list = [u'foo', u'bar', u'caf\xe9', u'bazbaz']
+        keys = ngrams.breakup_set(word_list, 2, 3, 2)
+        self.assertEquals(ngrams.hash_set(word_list, 2, 3, 2),
+                set(ngrams.hash_key(key) for key in keys))
+        self.assertEquals(len(ngrams.hash_set(word_list, 2, 3, 2)),
+                len(keys))
+        # str and unicode with the same ASCII text should hash the same
+        self.assertEquals(ngrams.hash_key('foo'), ngrams.hash_key(u'foo'))
+        self.assertNotEquals(ngrams.hash_key(u'foo'),
+                ngrams.hash_key(u'bar'))
+
+    def test_match_lists(self):
+        word_lists = [
+            [u'foo', u'bar'],
+            [u'foobar'],
+            [u'bar', u'baz'],
+            [],
+        ]
+        def check_match(positive, negative, correct_indexes):
+            self.assertEquals(ngrams.match_lists(word_lists, 3, 5, 2,
+                positive, negative), correct_indexes)
+        check_match([], [], [0, 1, 2, 3])
+        check_match([u'foo'], [], [0, 1])
+        check_match([u'foo', u'bar'], [], [0, 1])
+        check_match([u'ooba'], [], [1])
+        check_match([u'^ba'], [], [0, 2])
+        check_match([u'^b'], [[u'foo']], [2])
+        # negative groups only rule out lists that contain all their keys
+        check_match([u'bar'], [[u'baz', u'qux']], [0, 1, 2])
+        check_match([u'bar'], [[u'baz'], [u'foo']], [])
+        self.assertRaises(TypeError, ngrams.match_lists, [[1]], 3, 5, 2,
+                [], [])
+
 class SearchTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -32,8 +90,10 @@ class SearchTest(MiroTestCase):
         self.item1 = self.make_item(u'http://example.com/', u'my first item')
         self.item2 = self.make_item(u'http://example.com/', u'my second item')
 
-    def make_item(self, url, title=u'default item title'):
+    def make_item(self, url, title=u'default item title', description=None):
         additional = {'title': title}
+        if description is not None:
+            additional['description'] = description
         entry = _build_entry(url, 'video/x-unknown', additional)
         item = models.Item(FeedParserValues(entry), feed_id=self.feed.id)
         return itemsource.DatabaseItemSource._item_info_for(item)
@@ -65,13 +125,18 @@ class SearchTest(MiroTestCase):
         # n-grams for.
         self.assertMatches('ond', self.item2)
         self.assertNotMatches('ond', self.item1)
-        # all searches less than 3 characters should match everything
+        # searches less than 3 characters should match the start of words
         self.assertMatches('', self.item1)
         self.assertMatches('', self.item2)
-        self.assertMatches('d', self.item1)
-        self.assertMatches('d', self.item2)
-        self.assertMatches('st', self.item1)
-        self.assertMatches('st', self.item2)
+        self.assertMatches('m', self.item1)
+        self.assertMatches('m', self.item2)
+        self.assertMatches('fi', self.item1)
+        self.assertNotMatches('fi', self.item2)
+        self.assertNotMatches('d', self.item1)
+        self.assertNotMatches('st', self.item1)
+        self.assertNotMatches('my -s', self.item2)
+        # ...unless they can't be part of a word
+        self.assertMatches('.', self.item1)
 
     def test_item_matches_case_insensitive(self):
         self.assertMatches('FiRsT', self.item1)
@@ -89,6 +154,35 @@ class SearchTest(MiroTestCase):
                           [self.item1, self.item2])
         self.assertEquals(list(search.list_matches(items, 'foo')),
                           [])
+        self.assertEquals(list(search.list_matches(items, 'my -second')),
+                          [self.item1])
+        self.assertEquals(list(search.list_matches(items, 'my -sec -fir')),
+                          [])
+
+    def test_rank_items(self):
+        title_match = self.make_item(u'http://example.com/3', u'miro video')
+        description_match = self.make_item(u'http://example.com/4',
+                u'some video', u'watch it with miro')
+        no_match = self.make_item(u'http://example.com/5', u'other video')
+        self.assertEquals(search.rank_items(
+            [no_match, description_match, title_match], 'miro'),
+            [title_match, description_match, no_match])
+        self.assertEquals(search.rank_items(
+            [no_match, description_match, title_match], 'mi', limit=1),
+            [title_match])
+
+    def test_rank_items_recency(self):
+        old_item = self.make_item(u'http://example.com/3', u'miro video')
+        new_item = self.make_item(u'http://example.com/4', u'miro video')
+        old_item.release_date -= datetime.timedelta(days=60)
+        self.assertEquals(search.rank_items([old_item, new_item], 'miro'),
+                [new_item, old_item])
+        # a better match should outweigh being newer
+        new_item.name = u'video'
+        new_item.description = u'miro'
+        new_item._derived.clear()
+        self.assertEquals(search.rank_items([old_item, new_item], 'miro'),
+                [old_item, new_item])
 
     def test_ngrams_for_term(self):
         self.assertEquals(search._ngrams_for_term('abc'),
@@ -141,6 +235,98 @@ class ItemSearcherTest(MiroTestCase):
         self.check_search_results('my', self.item1)
         self.check_empty_result('second')
 
+    def test_prefix(self):
+        self.check_search_results('m', self.item1, self.item2)
+        self.check_search_results('fi', self.item1)
+        self.check_search_results('my s', self.item2)
+        self.check_search_results('my -s', self.item1)
+        self.check_empty_result('x')
+        self.item1.set_title(u'xylophone')
+        self.searcher.update_item(self.make_info(self.item1))
+        self.check_search_results('x', self.item1)
+        self.check_search_results('m', self.item2)
+
+    def test_compact(self):
+        # make the searcher compact after a few removes and check that
+        # searches still work.
+        self.searcher.COMPACT_MIN_DEAD = 3
+        self.searcher.COMPACT_DEAD_RATIO = 0.5
+        extra_items = [self.make_item(u'http://example.com/%d' % i,
+            u'extra item %d' % i) for i in xrange(6)]
+        for item in extra_items[:4]:
+            self.searcher.remove_item(item.id)
+        self.item1.set_title(u'my new title')
+        self.searcher.update_item(self.make_info(self.item1))
+        self.assertEquals(len(self.searcher), 4)
+        self.assertEquals(self.searcher._doc_items.count(None),
+                self.searcher._dead_count)
+        self.check_search_results('item', self.item2, *extra_items[4:])
+        self.check_search_results('extra', *extra_items[4:])
+        self.check_search_results('title', self.item1)
+        self.check_empty_result('first')
+
+    def test_snapshot(self):
+        item3 = self.make_item(u'http://example.com/3', u'my third item')
+        self.searcher.remove_item(item3.id)
+        new_searcher = search.ItemSearcher()
+        new_searcher.load_snapshot(self.searcher.to_snapshot())
+        self.searcher = new_searcher
+        self.assertEquals(len(self.searcher), 2)
+        self.check_search_results('my', self.item1, self.item2)
+        self.check_search_results('fi', self.item1)
+        self.check_empty_result('third')
+        # the loaded index should handle changes
+        self.item1.set_title(u'my new title')
+        self.searcher.update_item(self.make_info(self.item1))
+        self.check_search_results('title', self.item1)
+        self.check_empty_result('first')
+
+    def test_corrupt_snapshot(self):
+        searcher = search.ItemSearcher()
+        self.assertRaises(search.SnapshotError, searcher.load_snapshot,
+                'BOGUS')
+        snapshot = self.searcher.to_snapshot()
+        self.assertRaises(search.SnapshotError, searcher.load_snapshot,
+                snapshot[:len(snapshot) // 2])
+
+    def test_search_ids(self):
+        self.assertSameSet(self.searcher.search('my', set()), [])
+        self.assertSameSet(self.searcher.search('my', set([self.item1.id])),
+                [self.item1.id])
+
+    def test_unicode_ids(self):
+        # device items use unicode paths for their ids
+        class FakeInfo(object):
+            def __init__(self, id_, title):
+                self.id = id_
+                self.search_terms = title.split()
+        self.searcher.add_item(FakeInfo(u'/media/foo.avi', u'foo video'))
+        self.searcher.add_item(FakeInfo(u'/media/bar.avi', u'bar video'))
+        self.assertSameSet(self.searcher.search('video'),
+                [u'/media/foo.avi', u'/media/bar.avi'])
+        self.searcher.remove_item(u'/media/foo.avi')
+        self.assertSameSet(self.searcher.search('video'),
+                [u'/media/bar.avi'])
+
+class IntersectSortedTest(MiroTestCase):
+    def check_intersect(self, list1, list2):
+        correct = sorted(set(list1).intersection(list2))
+        result = search._intersect_sorted(array('i', list1),
+                array('i', list2))
+        self.assertEquals(list(result), correct)
+        result = search._intersect_sorted(array('i', list2),
+                array('i', list1))
+        self.assertEquals(list(result), correct)
+
+    def test_intersect(self):
+        self.check_intersect([], [])
+        self.check_intersect([1, 2, 3], [])
+        self.check_intersect([1, 2, 3], [2, 3, 4])
+        self.check_intersect([5], range(100))
+        self.check_intersect([0, 99], range(100))
+        self.check_intersect([-1, 100], range(100))
+        self.check_intersect(range(0, 1000, 7), range(0, 1000, 3))
+
 class SearchFilterTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -149,14 +335,17 @@ class SearchFilterTest(MiroTestCase):
         self.added_objects = []
         self.changed_objects = []
         self.removed_objects = []
-        self.filterer = SearchFilter()
+        self.searcher = search.ItemSearcher()
+        self.filterer = SearchFilter(self.searcher)
         self.info1 = self.make_info(u'info one')
         self.info2 = self.make_info(u'info two')
         self.info3 = self.make_info(u'info three')
         self.info4 = self.make_info(u'info four')
 
-    def make_info(self, title):
+    def make_info(self, title, description=None):
         additional = {'title': title}
+        if description is not None:
+            additional['description'] = description
         url = u'http://example.com/'
         entry = _build_entry(url, 'video/x-unknown', additional)
         item = models.Item(FeedParserValues(entry), feed_id=self.feed.id)
@@ -195,7 +384,7 @@ class SearchFilterTest(MiroTestCase):
         self.check_initial_list_filter([self.info1, self.info2],
             [self.info1, self.info2])
         # try again with a search set
-        self.filterer = SearchFilter()
+        self.filterer = SearchFilter(self.searcher)
         self.filterer.set_search("two")
         self.check_initial_list_filter([self.info1, self.info2], [self.info2])
 
@@ -236,3 +425,224 @@ class SearchFilterTest(MiroTestCase):
         # only info2 matches the search, so removed should only include it
         self.check_changed_filter([], [], [self.info1, self.info2],
                 [], [], [self.info2])
+
+    def test_search_ranked(self):
+        info5 = self.make_info(u'other', u'info info')
+        self.filterer.filter_initial_list([self.info1, self.info2, info5])
+        self.filterer.set_search("info")
+        # a title match beats matches in the description
+        ranked = self.filterer.search_ranked()
+        self.assertEquals(ranked[-1], info5)
+        self.assertSameSet(ranked, [self.info1, self.info2, info5])
+        self.assertEquals(len(self.filterer.search_ranked(limit=1)), 1)
+        self.filterer.set_search("two")
+        self.assertEquals(self.filterer.search_ranked(), [self.info2])
+
+class DatabaseSearchFilterTest(SearchFilterTest):
+    # Run the SearchFilterTest tests using a DatabaseItemSearcher, which
+    # searches the backend's index of all items.
+    def setUp(self):
+        SearchFilterTest.setUp(self)
+        self.searcher = DatabaseItemSearcher()
+        self.filterer = SearchFilter(self.searcher)
+
+    def update_info(self, info, name):
+        SearchFilterTest.update_info(self, info, name)
+        models.Item.get_by_id(info.id).set_title(name)
+
+    def test_fallback(self):
+        # If the backend's index isn't ready, we should still get the
+        # correct results.
+        app.search_index = None
+        self.filterer.filter_initial_list([self.info1, self.info2])
+        self.check_search_change("two", [], [self.info1])
+        self.check_search_change("o", [self.info1], [self.info2])
+
+    def test_searcher_search_ranked(self):
+        info5 = self.make_info(u'other', u'one')
+        self.filterer.filter_initial_list([self.info1, self.info2, info5])
+        self.assertEquals(self.searcher.search_ranked('one'),
+                [self.info1.id, info5.id])
+        self.assertEquals(self.searcher.search_ranked('one', limit=1),
+                [self.info1.id])
+        self.assertEquals(self.searcher.search_ranked('one',
+            set([info5.id])), [info5.id])
+        self.assertEquals(self.searcher.search_ranked('two'),
+                [self.info2.id])
+
+    def test_shared_index(self):
+        self.filterer.filter_initial_list([self.info1, self.info2])
+        self.filterer.set_search("info")
+        other_filterer = SearchFilter(self.searcher)
+        other_filterer.set_search("info")
+        other_filterer.filter_initial_list([self.info2, self.info3])
+        # each filter should only see its own items
+        self.assertSameSet(self.filterer.matching_ids,
+                [self.info1.id, self.info2.id])
+        self.assertSameSet(other_filterer.matching_ids,
+                [self.info2.id, self.info3.id])
+        # items should only be stored once
+        self.assertEquals(len(self.searcher), 3)
+        # changes from one filter should be seen in the other
+        self.update_info(self.info2, u'two')
+        self.filterer.filter_changes([], [self.info2], [])
+        self.assertSameSet(other_filterer.set_search("two")[1],
+                [self.info3.id])
+        # removing an item from one list shouldn't remove it from the index
+        self.filterer.filter_changes([], [], [self.info2.id])
+        self.assertSameSet(other_filterer.matching_ids, [self.info2.id])
+        self.assertEquals(len(self.searcher), 3)
+        # reset() should remove our references
+        self.filterer.reset()
+        self.assertEquals(len(self.searcher), 2)
+        other_filterer.reset()
+        self.assertEquals(len(self.searcher), 0)
+
+class ItemListTrackerSearcherTest(MiroTestCase):
+    def test_searchers(self):
+        # lists of database items share a searcher.  Other lists get their
+        # own, since their item ids can collide with database ids.
+        feed_tracker = itemtrack.ItemListTracker(u'feed', 1)
+        playlist_tracker = itemtrack.ItemListTracker(u'playlist', 1)
+        sharing_tracker = itemtrack.ItemListTracker(u'sharing', 1)
+        device_tracker = itemtrack.ItemListTracker(u'device', 1)
+        self.assert_(feed_tracker.search_filter.searcher is
+                itemtrack.database_searcher)
+        self.assert_(playlist_tracker.search_filter.searcher is
+                itemtrack.database_searcher)
+        other_searchers = [sharing_tracker.search_filter.searcher,
+                device_tracker.search_filter.searcher]
+        self.assert_(other_searchers[0] is not other_searchers[1])
+        self.assert_(itemtrack.database_searcher not in other_searchers)
+
+class SearchIndexTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = models.Feed(u'http://example.com/')
+        self.item1 = self.make_item(u'my first item')
+        self.item2 = self.make_item(u'my second item')
+
+    def make_item(self, title):
+        entry = _build_entry(u'http://example.com/', 'video/x-unknown',
+                {'title': title})
+        return models.Item(FeedParserValues(entry), feed_id=self.feed.id)
+
+    def check_search_results(self, search_text, *correct_items):
+        self.assertSameSet(app.search_index.search(search_text),
+                [i.id for i in correct_items])
+
+    def reload_search_index(self):
+        app.search_index.save()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+
+    def count_snapshots(self):
+        app.db.cursor.execute("SELECT COUNT(*) FROM search_index_snapshot")
+        return app.db.cursor.fetchone()[0]
+
+    def test_search(self):
+        self.assertTrue(app.search_index.is_ready())
+        self.check_search_results('my', self.item1, self.item2)
+        self.check_search_results('first', self.item1)
+        self.assertSameSet(app.search_index.search('my',
+            set([self.item2.id])), [self.item2.id])
+
+    def test_changes(self):
+        item3 = self.make_item(u'my third item')
+        self.check_search_results('my', self.item1, self.item2, item3)
+        self.item1.set_title(u'my new title')
+        self.check_search_results('title', self.item1)
+        self.check_search_results('first')
+        self.item2.remove()
+        self.check_search_results('my', self.item1, item3)
+
+    def test_snapshot(self):
+        self.reload_search_index()
+        # the index should be ready right away
+        self.assertTrue(app.search_index.is_ready())
+        self.check_search_results('my', self.item1, self.item2)
+        self.check_search_results('fi', self.item1)
+        # the snapshot is still up to date, so we should keep it
+        self.assertEquals(self.count_snapshots(), 1)
+        # once an item changes, the snapshot is out of date.  We should
+        # delete it until the next save
+        self.item1.set_title(u'my new title')
+        self.assertEquals(self.count_snapshots(), 0)
+        app.search_index.save()
+        self.assertEquals(self.count_snapshots(), 1)
+
+    def test_periodic_save(self):
+        app.search_index.save()
+        self.assert_(app.search_index._save_dc is None)
+        # adding and removing items doesn't make the snapshot out of date,
+        # but we should still save a new one later
+        item3 = self.make_item(u'my third item')
+        self.assertEquals(self.count_snapshots(), 1)
+        self.assert_(app.search_index._save_dc is not None)
+        app.search_index._save_timeout()
+        self.assert_(app.search_index._save_dc is None)
+        # simulate a crash, the index should be loaded from the periodic
+        # snapshot
+        app.db.finish_transaction()
+        self.setup_new_item_info_cache()
+        self.assertTrue(app.search_index.is_ready())
+        self.check_search_results('third', item3)
+
+    def test_save_in_transaction(self):
+        # save() should work while the database has a transaction open and
+        # updates queued up
+        app.db.finish_transaction()
+        self.make_item(u'my third item')
+        self.item1.set_title(u'my new title')
+        self.assert_(app.db._statements_in_transaction)
+        app.search_index.save()
+        self.assertEquals(self.count_snapshots(), 1)
+        app.db.finish_transaction()
+        self.assertEquals(self.count_snapshots(), 1)
+
+    def test_snapshot_out_of_date(self):
+        app.search_index.save()
+        # simulate the snapshot missing changes
+        item3 = self.make_item(u'my third item')
+        self.item2.remove()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+        # we should notice that item2 was removed
+        self.check_search_results('second')
+        # item3 isn't in the snapshot, it should be added from an idle
+        # callback
+        self.assertFalse(app.search_index.is_ready())
+        self.runPendingIdles()
+        self.assertTrue(app.search_index.is_ready())
+        self.check_search_results('third', item3)
+
+    def test_index_removed_item(self):
+        # simulate an item getting removed from the database before we index
+        # it.  get_info() calls failed_soft() for the missing item.
+        app.controller.failed_soft_okay = True
+        app.search_index._unindexed_ids.update([self.item1.id, 12345678])
+        app.search_index.searcher.remove_item(self.item1.id)
+        self.assertFalse(app.search_index.is_ready())
+        app.search_index._index_chunk()
+        # we should drop the bad id, but still index the other one
+        self.assertTrue(app.search_index.is_ready())
+        self.check_search_results('first', self.item1)
+
+    def test_version_mismatch(self):
+        app.search_index.save()
+        app.db.cursor.execute("UPDATE search_index_snapshot "
+                "SET version='BOGUS'")
+        self.setup_new_item_info_cache()
+        self.assertFalse(app.search_index.is_ready())
+        self.runPendingIdles()
+        self.assertTrue(app.search_index.is_ready())
+        self.check_search_results('my', self.item1, self.item2)
+
+    def test_corrupt_snapshot(self):
+        app.search_index.save()
+        app.db.cursor.execute("UPDATE search_index_snapshot "
+                "SET data='BOGUS'")
+        self.setup_new_item_info_cache()
+        self.runPendingIdles()
+        self.assertTrue(app.search_index.is_ready())
+        self.check_search_results('my', self.item1, self.item2)
@@ -60,6 +60,9 @@ class DBInsertCallbackHuman(Human):
         if self.__class__.callback:
             self.__class__.callback(self)
 
+class LazyHuman(Human):
+    pass
+
 class PCFProgramer(Human):
     def setup_new(self, name, age, meters_tall, friends, file, developer,
             high_scores = None):
@@ -101,6 +104,11 @@ class DBInsertCallbackHumanSchema(HumanSchema):
     klass = DBInsertCallbackHuman
     table_name = 'db_insert_callback_human'
 
+class LazyHumanSchema(HumanSchema):
+    klass = LazyHuman
+    table_name = 'lazy_human'
+    lazy_fields = ('meters_tall', 'high_scores')
+
 class PCFProgramerSchema(schema.MultiClassObjectSchema):
     table_name = 'pcf_programmer'
     fields = HumanSchema.fields + [
@@ -120,7 +128,7 @@ class PCFProgramerSchema(schema.MultiClassObjectSchema):
             return PCFProgramer
 
 test_object_schemas = [HumanSchema, PCFProgramerSchema, RestorableHumanSchema,
-        DBInsertCallbackHumanSchema]
+        DBInsertCallbackHumanSchema, LazyHumanSchema]
 
 def upgrade1(cursor):
     cursor.execute("UPDATE human set name='new name'")
@@ -281,6 +289,103 @@ class DiskTest(FakeSchemaTest):
         self.reload_test_database()
         self.check_database()
 
+    def test_update_coalesced(self):
+        app.db.finish_transaction()
+        self.joe.name = u'JO MAMA'
+        self.joe.signal_change()
+        self.joe.age = 15
+        self.joe.signal_change()
+        self.lee.age = 26
+        self.lee.signal_change()
+        # updates should be queued up until the transaction finishes
+        self.assertSameSet(app.db._pending_updates.keys(),
+                [self.joe.id, self.lee.id])
+        app.db.finish_transaction()
+        self.assertEquals(app.db._pending_updates, {})
+        self.reload_test_database()
+        self.check_database()
+
+    def test_update_only_changed_columns(self):
+        app.db.finish_transaction()
+        self.joe.name = u'JO MAMA'
+        self.joe.signal_change()
+        self.assertEquals(set(app.db._pending_updates[self.joe.id][1]),
+                set(['name']))
+        self.reload_test_database()
+        self.check_database()
+
+    def test_update_in_place(self):
+        app.db.finish_transaction()
+        self.joe.high_scores[u'pong'] = 3
+        self.joe.favorite_colors.add(u'green')
+        self.joe.signal_change()
+        self.assertEquals(set(app.db._pending_updates[self.joe.id][1]),
+                set(['high_scores', 'favorite_colors']))
+        self.reload_test_database()
+        self.check_database()
+
+    def test_query_sees_queued_update(self):
+        self.joe.name = u'JO MAMA'
+        self.joe.signal_change()
+        view = RestorableHuman.make_view('name=?', (u'JO MAMA',))
+        self.assertEquals(view.count(), 1)
+        app.db.cursor.execute("SELECT name FROM restorable_human "
+                "WHERE id=?", (self.joe.id,))
+        self.assertEquals(app.db.cursor.fetchone()[0], u'JO MAMA')
+
+    def test_update_missing_row(self):
+        app.db.finish_transaction()
+        self.joe.name = u'JO MAMA'
+        self.joe.signal_change()
+        # delete the row behind the database's back
+        app.db.cursor.execute("DELETE FROM restorable_human WHERE id=?",
+                (self.joe.id,))
+        self.assertRaises(KeyError, app.db.finish_transaction)
+        self.assertEquals(app.db._pending_updates, {})
+
+    def test_update_missing_row_error(self):
+        app.db.finish_transaction()
+        self.lee.name = u'new lee'
+        self.lee.signal_change()
+        self.joe.name = u'JO MAMA'
+        self.joe.signal_change()
+        app.db.cursor.execute("DELETE FROM restorable_human WHERE id=?",
+                (self.joe.id,))
+        # the error should say which object failed
+        try:
+            app.db.flush_pending_updates()
+        except KeyError, e:
+            self.assert_('RestorableHumanSchema' in str(e))
+            self.assert_(str(self.joe.id) in str(e))
+        else:
+            raise AssertionError("KeyError not raised")
+        # the other updates should still run
+        app.db.cursor.execute("SELECT name FROM human WHERE id=?",
+                (self.lee.id,))
+        self.assertEquals(app.db.cursor.fetchone()[0], u'new lee')
+
+    def test_raw_transaction(self):
+        self.joe.name = u'JO MAMA'
+        self.joe.signal_change()
+        # raw_transaction() should work even though our UPDATE starts a
+        # transaction
+        with app.db.raw_transaction() as cursor:
+            cursor.execute("SELECT name FROM restorable_human "
+                    "WHERE id=?", (self.joe.id,))
+            self.assertEquals(cursor.fetchone()[0], u'JO MAMA')
+        self.reload_test_database()
+        self.check_database()
+
+    def test_raw_transaction_rollback(self):
+        app.db.finish_transaction()
+        def run_bad_sql():
+            with app.db.raw_transaction() as cursor:
+                cursor.execute("DELETE FROM human")
+                raise ValueError()
+        self.assertRaises(ValueError, run_bad_sql)
+        self.reload_test_database()
+        self.check_database()
+
     def test_binary_reload(self):
         self.joe.id_code = 'abc'
         self.joe.signal_change()
@@ -472,6 +577,79 @@ class DiskTest(FakeSchemaTest):
         lee_view = Human.make_view("id=?", values=(lee.id,))
         self.assertEquals(lee_view.count(), 0)
 
+class LazyFieldTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        self.lazy_lee = LazyHuman(u"lee", 25, 1.4, [],
+                                  {u'virtual bowling': 212})
+        self.lazy_joe = LazyHuman(u"joe", 14, 1.6, [self.lazy_lee])
+
+    def get_lazy_humans(self):
+        return dict((obj.id, obj) for obj in LazyHuman.make_view())
+
+    def test_lazy_fields(self):
+        self.reload_test_database()
+        lee = self.get_lazy_humans()[self.lazy_lee.id]
+        self.assert_('meters_tall' not in lee.__dict__)
+        self.assert_('high_scores' not in lee.__dict__)
+        self.assertEquals(lee.meters_tall, 1.4)
+        self.assertEquals(lee.high_scores, {u'virtual bowling': 212})
+        # non-lazy schemas should have everything loaded
+        ben = PCFProgramer.make_view().get_singleton()
+        self.assert_('meters_tall' in ben.__dict__)
+        human_lee = Human.make_view().get_singleton()
+        self.assert_('meters_tall' in human_lee.__dict__)
+
+    def test_set_lazy_field_before_load(self):
+        self.reload_test_database()
+        lee = self.get_lazy_humans()[self.lazy_lee.id]
+        lee.meters_tall = 1.5
+        # loading the other lazy fields shouldn't overwrite our value
+        self.assertEquals(lee.high_scores, {u'virtual bowling': 212})
+        self.assertEquals(lee.meters_tall, 1.5)
+        lee.signal_change()
+        self.reload_test_database()
+        lee = self.get_lazy_humans()[self.lazy_lee.id]
+        self.assertEquals(lee.meters_tall, 1.5)
+        self.assertEquals(lee.high_scores, {u'virtual bowling': 212})
+
+    def test_ensure_objects_loaded_lazy(self):
+        self.reload_test_database()
+        # objects that we restore should get their lazy fields loaded
+        app.db.ensure_objects_loaded(LazyHuman, [self.lazy_lee.id],
+                load_lazy=True)
+        lee = app.db.get_obj_by_id(self.lazy_lee.id)
+        self.assert_('meters_tall' in lee.__dict__)
+        # so should objects that are already in memory
+        joe = self.get_lazy_humans()[self.lazy_joe.id]
+        self.assert_('meters_tall' not in joe.__dict__)
+        app.db.ensure_objects_loaded(LazyHuman, [self.lazy_joe.id],
+                load_lazy=True)
+        self.assertEquals(joe.__dict__['meters_tall'], 1.6)
+        self.assertEquals(joe.__dict__['high_scores'], {})
+
+    def test_remove(self):
+        self.reload_test_database()
+        lee = self.get_lazy_humans()[self.lazy_lee.id]
+        lee.remove()
+        # we should still be able to read the lazy fields after the row is
+        # gone
+        self.assertEquals(lee.meters_tall, 1.4)
+        self.assertEquals(lee.high_scores, {u'virtual bowling': 212})
+        self.assertEquals(self.get_lazy_humans().keys(), [self.lazy_joe.id])
+
+    def test_bulk_remove(self):
+        self.reload_test_database()
+        humans = self.get_lazy_humans()
+        app.db.bulk_remove(humans.values())
+        self.assertEquals(LazyHuman.make_view().count(), 0)
+        lee = humans[self.lazy_lee.id]
+        joe = humans[self.lazy_joe.id]
+        self.assertEquals(lee.meters_tall, 1.4)
+        self.assertEquals(lee.high_scores, {u'virtual bowling': 212})
+        self.assertEquals(joe.meters_tall, 1.6)
+        self.assertEquals(joe.high_scores, {})
+
 class ObjectMemoryTest(FakeSchemaTest):
     def test_remove_remove_object_map(self):
         self.reload_test_database()
@@ -1,12 +1,15 @@
 import os
+import threading
 import time
 import Queue
+from StringIO import StringIO
 
 from miro import app
+from miro import feedparservalues
 from miro import subprocessmanager
 from miro import workerprocess
 from miro.plat import resources
-from miro.test.framework import EventLoopTest
+from miro.test.framework import EventLoopTest, MiroTestCase
 
 # setup some test messages/handlers
 class TestSubprocessHandler(subprocessmanager.SubprocessHandler):
@@ -74,6 +77,151 @@ class SawEvent(subprocessmanager.SubprocessResponse):
 
 # Actual tests go below here
 
+class FrameTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.pipe = StringIO()
+        self.writer = subprocessmanager.FrameWriter(self.pipe)
+
+    def read_objs(self, count):
+        self.pipe.seek(0)
+        return [subprocessmanager._load_obj(self.pipe)
+                for i in xrange(count)]
+
+    def test_round_trip(self):
+        objs = [None, 'abc', {'foo': [1, 2.5, u'\u0101']}]
+        for obj in objs:
+            self.writer.add(obj)
+        self.writer.flush()
+        self.assertEquals(self.read_objs(3), objs)
+
+    def test_buffering(self):
+        self.writer.add('abc')
+        self.writer.add('def')
+        # nothing should be written until we flush
+        self.assertEquals(self.pipe.getvalue(), '')
+        self.assert_(self.writer.has_pending())
+        self.writer.flush()
+        self.assert_(not self.writer.has_pending())
+        self.assertEquals(self.read_objs(2), ['abc', 'def'])
+
+    def test_compression(self):
+        big_value = 'a' * (subprocessmanager.COMPRESS_THRESHOLD * 2)
+        self.writer.add(big_value)
+        self.writer.flush()
+        data = self.pipe.getvalue()
+        size, flags = subprocessmanager.FRAME_HEADER.unpack(
+                data[:subprocessmanager.FRAME_HEADER.size])
+        self.assert_(flags & subprocessmanager.FRAME_COMPRESSED)
+        self.assert_(size < len(big_value))
+        self.assertEquals(self.read_objs(1), [big_value])
+
+    def test_small_values_not_compressed(self):
+        self.writer.add('a' * 100)
+        self.writer.flush()
+        data = self.pipe.getvalue()
+        size, flags = subprocessmanager.FRAME_HEADER.unpack(
+                data[:subprocessmanager.FRAME_HEADER.size])
+        self.assertEquals(flags, 0)
+
+    def test_max_buffer_size(self):
+        self.writer.add(os.urandom(subprocessmanager.MAX_BUFFER_SIZE))
+        # we should flush automatically once the buffer gets too big
+        self.assert_(not self.writer.has_pending())
+        self.assertNotEquals(self.pipe.getvalue(), '')
+
+    def test_corrupt_data(self):
+        header = subprocessmanager.FRAME_HEADER.pack(3,
+                subprocessmanager.FRAME_COMPRESSED)
+        self.pipe.write(header + 'abc')
+        self.assertRaises(subprocessmanager.LoadError, self.read_objs, 1)
+
+    def test_truncated_data(self):
+        self.writer.add('abcdef')
+        self.writer.flush()
+        self.pipe.truncate(len(self.pipe.getvalue()) - 1)
+        self.assertRaises(subprocessmanager.LoadError, self.read_objs, 1)
+
+    def test_threads(self):
+        # add objects from several threads at once, we shouldn't lose any
+        def add_objs(thread_num):
+            for i in xrange(200):
+                self.writer.add((thread_num, i))
+                if i % 10 == 0:
+                    self.writer.flush()
+        threads = [threading.Thread(target=add_objs, args=(i,))
+                for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.writer.flush()
+        self.assertSameSet(self.read_objs(800),
+                [(t, i) for t in xrange(4) for i in xrange(200)])
+
+class CountingPipe(StringIO):
+    def __init__(self):
+        StringIO.__init__(self)
+        self.write_count = 0
+
+    def write(self, data):
+        StringIO.write(self, data)
+        self.write_count += 1
+
+class EchoHandler(object):
+    def __init__(self, msg_handler):
+        self.msg_handler = msg_handler
+
+    def handle(self, msg):
+        self.msg_handler.handle(msg)
+
+class SubprocessMessageLoopTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.pipe = CountingPipe()
+        self.msg_handler = subprocessmanager.PipeMessageProxy(self.pipe)
+        self.queue = Queue.Queue()
+        for i in xrange(3):
+            self.queue.put(i)
+        self.queue.put(None)
+        self.old_max_response_delay = subprocessmanager.MAX_RESPONSE_DELAY
+
+    def tearDown(self):
+        self.msg_handler._cancel_flush_timer()
+        subprocessmanager.MAX_RESPONSE_DELAY = self.old_max_response_delay
+        MiroTestCase.tearDown(self)
+
+    def run_loop(self, handler=None):
+        if handler is None:
+            handler = EchoHandler(self.msg_handler)
+        subprocessmanager._subprocess_message_loop(handler, self.queue,
+                self.msg_handler)
+
+    def test_buffer_while_busy(self):
+        subprocessmanager.MAX_RESPONSE_DELAY = 1000
+        self.run_loop()
+        # we always had messages waiting, so nothing should be sent yet
+        self.assertEquals(self.pipe.write_count, 0)
+        self.assert_(self.msg_handler.writer.has_pending())
+
+    def test_flush_after_delay(self):
+        subprocessmanager.MAX_RESPONSE_DELAY = 0.01
+        pipe = self.pipe
+        write_counts = []
+        class SlowEchoHandler(EchoHandler):
+            def handle(self, msg):
+                EchoHandler.handle(self, msg)
+                # simulate a slow handler.  The response should get sent
+                # while we're still working.
+                start = time.time()
+                while pipe.write_count == len(write_counts):
+                    if time.time() - start > 5.0:
+                        break
+                    time.sleep(0.01)
+                write_counts.append(pipe.write_count)
+        self.run_loop(SlowEchoHandler(self.msg_handler))
+        self.assertEquals(write_counts, [1, 2, 3])
+
 class SubprocessManagerTest(EventLoopTest):
     # FIXME: we should have a better way of waiting for the subprocess to do
     # things, than calling runEventLoop() with an arbitrary timeout.
@@ -207,8 +355,10 @@ class WorkerProcessTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
         # override the normal handler class with our own
-        workerprocess._subprocess_manager.handler_class = (
+        workerprocess._worker_pool.handler_class = (
                 UnittestWorkerProcessHandler)
+        workerprocess._task_queue.reset()
+        workerprocess.stats.reset()
         self.result = self.error = None
 
     def callback(self, result):
@@ -230,9 +380,11 @@ class WorkerProcessTest(EventLoopTest):
         self.assertNotEquals(self.result, None)
         self.assertEquals(self.error, None)
         # just do some very basic test to see if the result is correct
-        if self.result['bozo']:
-            raise AssertionError("Feedparser parse error: %s",
-                    self.result['bozo_exception'])
+        self.assert_(isinstance(self.result, feedparservalues.ParsedFeed))
+        self.assertNotEquals(len(self.result.entries), 0)
+        for fp_values in self.result.entries:
+            # we shouldn't send the feedparser entries over the pipe
+            self.assertEquals(fp_values.entry, None)
 
     def test_feedparser_success(self):
         # test feedparser successfully parsing a feed
@@ -252,15 +404,52 @@ class WorkerProcessTest(EventLoopTest):
 
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
-        workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        workerprocess.startup(1)
+        manager = workerprocess._worker_pool.workers[0].manager
+        original_pid = manager.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        manager.process.terminate()
         self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, manager.process.pid)
+        self.check_successful_result()
+
+    def test_crash_with_other_workers(self):
+        # crash one worker out of several, the task should still finish
+        workerprocess.startup(2)
+        self.send_feedparser_task()
+        for worker in workerprocess._worker_pool.workers:
+            if worker.task_ids:
+                worker.manager.process.terminate()
+        self.runEventLoop(4.0)
         self.check_successful_result()
+        for worker in workerprocess._worker_pool.workers:
+            self.assertEquals(worker.task_ids, set())
+
+    def test_least_loaded(self):
+        # tasks should get spread out between the workers
+        workerprocess.startup(3)
+        for i in range(3):
+            workerprocess.run_feedparser('', self.callback, self.errback)
+        workers = workerprocess._worker_pool.workers
+        self.assertEquals([len(w.task_ids) for w in workers], [1, 1, 1])
+        workers[1].task_ids.clear()
+        self.assertEquals(workerprocess._worker_pool.least_loaded_worker(),
+                workers[1])
+        workers[0].task_ids.clear()
+        # ties go to the first worker
+        self.assertEquals(workerprocess._worker_pool.least_loaded_worker(),
+                workers[0])
+
+    def test_stats(self):
+        workerprocess.startup()
+        self.send_feedparser_task()
+        self.runEventLoop(4.0)
+        self.check_successful_result()
+        task_stats = workerprocess.stats.tasks['FeedparserTask']
+        self.assertEquals(task_stats.run_time.count, 1)
+        self.assertEquals(task_stats.latency.count, 1)
+        self.assert_('FeedparserTask' in workerprocess.get_stats_report())
 
     def test_queue_before_start(self):
         # test sending tasks before we start the worker process
@@ -271,3 +460,11 @@ class WorkerProcessTest(EventLoopTest):
         workerprocess.startup()
         self.runEventLoop(4.0)
         self.check_successful_result()
+
+    def test_queue_before_start_spread(self):
+        # tasks queued before startup should get spread out between workers
+        for i in range(4):
+            workerprocess.run_feedparser('', self.callback, self.errback)
+        workerprocess.startup(2)
+        workers = workerprocess._worker_pool.workers
+        self.assertEquals([len(w.task_ids) for w in workers], [2, 2])
@@ -55,7 +55,8 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 if self.start_pos > 0:
                     f.seek(self.start_pos, os.SEEK_CUR)
                 if self.end_pos > 0:
-                    count = self.end_pos - self.start_pos
+                    # the end of a range is inclusive
+                    count = self.end_pos - max(self.start_pos, 0) + 1
                 else:
                     count = -1
                 data = f.read(count)
@@ -78,6 +79,7 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def do_HEAD(self):
         """Serve a HEAD request."""
+        self.server.head_request_count += 1
         if not self.server.allow_head:
             self.send_error(405, "Method not allowed")
             return
@@ -234,7 +236,7 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         fs = os.fstat(f.fileno())
         length = fs[6]
         if self.end_pos > 0:
-            length = min(self.end_pos, length)
+            length = min(self.end_pos + 1, length)
         if self.start_pos > 0:
             length -= self.start_pos
         if 'content-length' not in self.server.headers_to_send:
@@ -309,6 +311,7 @@ class HTTPServer(threading.Thread):
         self.httpserver = BaseHTTPServer.HTTPServer(('', self.port),
                 MiroHTTPRequestHandler)
         self.httpserver.allow_head = True
+        self.httpserver.head_request_count = 0
         self.httpserver.headers_to_send = []
         self.httpserver.port = self.port
         self.httpserver.close_connection = False
@@ -351,6 +354,9 @@ class HTTPServer(threading.Thread):
     def last_info(self):
         return self.httpserver.last_info
 
+    def head_request_count(self):
+        return self.httpserver.head_request_count
+
     def disable_head_requests(self):
         self.httpserver.allow_head = False
 
@@ -4,6 +4,7 @@ import types
 from miro import feed
 from miro import item
 from miro import feedparserutil
+from miro import feedparservalues
 from miro import dialogs
 import framework
 from miro import signals
@@ -32,8 +33,9 @@ class UnicodeFeedTestCase(framework.EventLoopTest):
     def force_feed_parser_callback(self, my_feed):
         # a hack to get the feed to update without eventloop
         feedimpl = my_feed.actualFeed
+        self.parsed = feedparserutil.parse(feedimpl.initialHTML)
         feedimpl.feedparser_callback(
-            feedparserutil.parse(feedimpl.initialHTML))
+            feedparservalues.ParsedFeed(self.parsed))
 
     def is_proper_feed_parser_dict(self, parsed, name="top"):
         if isinstance(parsed, types.DictionaryType):
@@ -87,7 +89,7 @@ class UnicodeFeedTestCase(framework.EventLoopTest):
         my_feed = self.make_feed(u"file://" + self.filename)
         self.force_feed_parser_callback(my_feed)
 
-        self.is_proper_feed_parser_dict(my_feed.actualFeed.parsed)
+        self.is_proper_feed_parser_dict(self.parsed)
 
         # We need to explicitly check that the type is unicode because
         # Python automatically converts bytes strings to unicode
@@ -27,18 +27,32 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
-"""```workerprocess.py``` -- Miro worker subprocess
+"""```workerprocess.py``` -- Miro worker subprocesses
 
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
-tasks to this process.  See #17328 for more details.  Right now this just
+tasks to worker processes.  See #17328 for more details.  Right now this just
 includes feedparser, but we could pretty easily extend this to other tasks.
+
+We run a pool of worker processes (see prefs.WORKER_PROCESS_COUNT) and send
+each task to the worker with the fewest tasks in progress.
 """
 
 import itertools
+import logging
+import time
 
+from miro import app
+from miro import eventloopstats
 from miro import feedparserutil
+from miro import feedparservalues
+from miro import prefs
 from miro import subprocessmanager
 from miro import util
+from miro.plat.utils import get_logical_cpu_count
+
+# When WORKER_PROCESS_COUNT is 0, we start one worker per CPU, but no more
+# than this.  Each worker is a separate python process, so they aren't free.
+AUTO_WORKER_LIMIT = 4
 
 # define messages/handlers
 
@@ -55,39 +69,159 @@ class FeedparserTask(TaskMessage):
         self.html = html
 
 class TaskResult(subprocessmanager.SubprocessResponse):
-    def __init__(self, task_id, result):
+    def __init__(self, task_id, result, run_time):
         self.task_id = task_id
         self.result = result
+        # time it took to run the task in the worker process
+        self.run_time = run_time
 
 class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
     def call_handler(self, method, msg):
+        start = time.time()
         try:
             # normally we send the result of our handler method back
             rv = method(msg)
         except StandardError, e:
             # if something breaks, we send the Exception back
             rv = e
-        TaskResult(msg.task_id, rv).send_to_main_process()
+        TaskResult(msg.task_id, rv, time.time() - start).send_to_main_process()
 
     def handle_feedparser_task(self, msg):
-        parsed_feed =  feedparserutil.parse(msg.html)
-        # bozo_exception is sometimes C object that is not picklable.  We
-        # don't use it anyways, so just unset the value
-        parsed_feed['bozo_exception'] = None
-        return parsed_feed
+        # Send back a ParsedFeed rather than the feedparser result.  It's
+        # much smaller, and the backend doesn't have to calculate the item
+        # values for each entry.
+        return feedparservalues.ParsedFeed(feedparserutil.parse(msg.html))
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
+    def __init__(self, worker):
+        subprocessmanager.SubprocessResponder.__init__(self)
+        self.worker = worker
+
     def on_startup(self):
-        _task_queue.run_pending_tasks()
+        # This gets called when the worker starts and when it restarts
+        # after a crash.
+        _task_queue.worker_started(self.worker)
 
     def handle_task_result(self, msg):
-        _task_queue.process_result(msg)
+        _task_queue.process_result(self.worker, msg)
+
+# Manage worker processes
+
+class Worker(object):
+    """A single worker process.
+
+    :ivar task_ids: ids of the tasks that we've sent to the worker and
+        haven't gotten results for
+    """
+    def __init__(self, index, handler_class):
+        self.index = index
+        self.task_ids = set()
+        # don't install a handler for TaskMessage, TaskQueue picks which
+        # worker gets each task.
+        self.manager = subprocessmanager.SubprocessManager(None,
+                WorkerProcessResponder(self), handler_class)
+
+    def __repr__(self):
+        return '<Worker %s (%d tasks)>' % (self.index, len(self.task_ids))
+
+    def is_running(self):
+        return self.manager.is_running
+
+    def send_task(self, msg):
+        self.task_ids.add(msg.task_id)
+        self.manager.send_message(msg)
+
+class WorkerPool(object):
+    """Manages our worker processes."""
+    def __init__(self):
+        self.handler_class = WorkerProcessHandler
+        self.workers = []
+        # True while we are starting our workers
+        self.starting = False
+
+    def worker_count(self):
+        count = int(app.config.get(prefs.WORKER_PROCESS_COUNT))
+        if count <= 0:
+            count = min(get_logical_cpu_count(), AUTO_WORKER_LIMIT)
+        return max(count, 1)
+
+    def startup(self, count=None):
+        if self.workers:
+            return
+        if count is None:
+            count = self.worker_count()
+        self.workers = [Worker(i, self.handler_class) for i in xrange(count)]
+        self.starting = True
+        try:
+            for worker in self.workers:
+                worker.manager.start()
+        finally:
+            self.starting = False
+        # now that all workers are running, spread out any queued tasks
+        _task_queue.dispatch_unassigned()
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.manager.shutdown()
+        self.workers = []
+
+    def least_loaded_worker(self):
+        """Get the running worker with the fewest tasks in progress.
+
+        :returns: Worker object, or None if no workers are running
+        """
+        best = None
+        for worker in self.workers:
+            if worker.is_running() and (best is None or
+                    len(worker.task_ids) < len(best.task_ids)):
+                best = worker
+        return best
+
+# Keep track of how long tasks take
+
+class TaskStats(object):
+    """Timing statistics for worker tasks.
+
+    For each type of task we track:
+
+    * queue delay: the time between adding the task and the worker starting
+      to run it.  This includes waiting for workers to start up and for
+      results to get back to the main process.
+    * run time: the time the worker spent running the task
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # maps task class names to eventloopstats.CallStats objects.  Their
+        # latency histogram holds the queue delay.
+        self.tasks = {}
+
+    def record_task(self, name, queue_delay, run_time):
+        try:
+            task_stats = self.tasks[name]
+        except KeyError:
+            task_stats = self.tasks[name] = eventloopstats.CallStats()
+        task_stats.latency.add(queue_delay)
+        task_stats.run_time.add(run_time)
+
+    def get_report(self):
+        """Get a text report of the statistics."""
+        lines = []
+        for name in sorted(self.tasks):
+            task_stats = self.tasks[name]
+            lines.append(name)
+            lines.append('    run time:    %s' %
+                    task_stats.run_time.format())
+            lines.append('    queue delay: %s' %
+                    task_stats.latency.format())
+        return '\n'.join(lines)
 
 # Manage task queue
 
 class TaskQueue(object):
     def __init__(self):
-        # maps task_ids to (msg, callback, errback) tuples
+        # maps task_ids to (msg, callback, errback, start_time) tuples
         self.tasks_in_progress = {}
 
     def reset(self):
@@ -95,39 +229,91 @@ class TaskQueue(object):
 
     def add_task(self, msg, callback, errback):
         """Add a new task to the queue."""
-        self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
-        if _subprocess_manager.is_running:
-            msg.send_to_process()
+        self.tasks_in_progress[msg.task_id] = (msg, callback, errback,
+                time.time())
+        self._dispatch(msg)
 
-    def process_result(self, reply):
-        """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+    def _dispatch(self, msg):
+        """Send a task to the least loaded worker.
+
+        If no workers are running, we leave the task unassigned and send it
+        once a worker starts.
+        """
+        worker = _worker_pool.least_loaded_worker()
+        if worker is not None:
+            worker.send_task(msg)
+
+    def _unassigned_tasks(self):
+        assigned = set()
+        for worker in _worker_pool.workers:
+            assigned.update(worker.task_ids)
+        task_ids = [task_id for task_id in self.tasks_in_progress
+                if task_id not in assigned]
+        # send tasks in the order they were added
+        task_ids.sort()
+        return [self.tasks_in_progress[task_id][0] for task_id in task_ids]
+
+    def process_result(self, worker, reply):
+        """Process a TaskResult from a worker."""
+        worker.task_ids.discard(reply.task_id)
+        try:
+            msg, callback, errback, start_time = self.tasks_in_progress.pop(
+                    reply.task_id)
+        except KeyError:
+            # We re-dispatched the task after a worker crashed and already
+            # got the result from another worker.
+            logging.warn("Got result for unknown task: %s", reply.task_id)
+            return
+        queue_delay = max(time.time() - start_time - reply.run_time, 0.0)
+        stats.record_task(msg.__class__.__name__, queue_delay,
+                reply.run_time)
         if isinstance(reply.result, Exception):
             errback(reply.result)
         else:
             callback(reply.result)
 
-    def run_pending_tasks(self):
-        """Rerun all tasks in the queue."""
-        for msg, callback, errback in self.tasks_in_progress.values():
-            msg.send_to_process()
+    def worker_started(self, worker):
+        """Handle a worker starting up.
+
+        If the worker is restarting after a crash, the tasks that we sent it
+        are lost, so we send them out again.  We also send out any tasks
+        that we couldn't send before because no workers were running.
+        """
+        worker.task_ids.clear()
+        if not _worker_pool.starting:
+            self.dispatch_unassigned()
+
+    def dispatch_unassigned(self):
+        """Send out tasks that aren't assigned to a running worker."""
+        for msg in self._unassigned_tasks():
+            self._dispatch(msg)
 
 _task_queue = TaskQueue()
+_worker_pool = WorkerPool()
+# timing statistics for worker tasks.  See get_stats_report()
+stats = TaskStats()
 
-# Manage subprocess
-_subprocess_manager = subprocessmanager.SubprocessManager(TaskMessage,
-        WorkerProcessResponder(), WorkerProcessHandler)
+def startup(count=None):
+    """Startup the worker processes.
 
-def startup():
-    """Startup the worker process."""
-    _subprocess_manager.start()
+    :param count: number of workers to start.  By default we use
+        prefs.WORKER_PROCESS_COUNT.
+    """
+    _worker_pool.startup(count)
 
 def shutdown():
-    """Shutdown the worker process."""
-    _subprocess_manager.shutdown()
+    """Shutdown the worker processes."""
+    _worker_pool.shutdown()
+
+def get_stats_report():
+    """Get a text report of the worker task timing statistics."""
+    return stats.get_report()
 
 # API for sending tasks
 def run_feedparser(html, callback, errback):
-    """Run feedparser on a chunk of html."""
+    """Run feedparser on a chunk of html.
+
+    callback will be passed a feedparservalues.ParsedFeed object.
+    """
     msg = FeedparserTask(html)
     _task_queue.add_task(msg, callback, errback)
@@ -126,8 +126,12 @@ class OSXApplication(Application, signals.SignalEmitter):
         eventloop.connect('thread-did-start', self.endLoop)
         eventloop.connect('begin-loop', self.beginLoop)
         eventloop.connect('end-loop', self.endLoop)
-        moviedata.movie_data_updater.connect('begin-loop', self.beginLoop)
-        moviedata.movie_data_updater.connect('end-loop', self.endLoop)
+        # the movie data updater runs several threads, so we keep the
+        # autorelease pools in its thread-local loop context
+        moviedata.movie_data_updater.connect('begin-loop',
+                lambda updater, context: self.beginLoop(context))
+        moviedata.movie_data_updater.connect('end-loop',
+                lambda updater, context: self.endLoop(context))
         httpclient.register_on_start(
             lambda cm: cm.connect('begin-loop', self.beginLoop))
         httpclient.register_on_start(